@@ -13,6 +13,7 @@ from motor.motor_asyncio import AsyncIOMotorCollection
 
 LOCATION_SERVICE_URL = os.getenv("LOCATION_SERVICE_URL", "http://locationservice:8000")
 USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://userservice:8000")
+TRIP_SERVICE_URL = os.getenv("TRIP_SERVICE_URL", "http://tripservice:8000")
 
 #Helper
 
@@ -248,4 +249,19 @@ async def notify_location_service_offline(driver_id: str):
     except httpx.RequestError as e:
         print(f"DriverService: Không thể kết nối đến LocationService để báo offline: {e}")
     except Exception as e:
-        print(f"DriverService: Lỗi không xác định khi báo offline: {e}")
\ No newline at end of file
+        print(f"DriverService: Lỗi không xác định khi báo offline: {e}")
+
+async def notify_trip_service_driver_updated(driver_id: str):
+    """Báo TripService xóa cache thông tin tài xế sau khi hồ sơ thay đổi."""
+    url = f"{TRIP_SERVICE_URL}/internal/drivers/{driver_id}/invalidate"
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.post(url, timeout=5.0)
+            response.raise_for_status()
+            print(f"DriverService: Đã báo TripService xóa cache tài xế {driver_id}.")
+    except httpx.HTTPStatusError as e:
+        print(f"DriverService: Lỗi khi báo TripService xóa cache (HTTP {e.response.status_code}): {e.response.text}")
+    except httpx.RequestError as e:
+        print(f"DriverService: Không thể kết nối đến TripService để xóa cache: {e}")
+    except Exception as e:
+        print(f"DriverService: Lỗi không xác định khi báo TripService xóa cache: {e}")
@@ -1,6 +1,7 @@
 # DriverService/main.py
-from fastapi import FastAPI, HTTPException, status, Depends
+from fastapi import FastAPI, HTTPException, status, Depends, BackgroundTasks
 from fastapi.security import OAuth2PasswordBearer 
+from fastapi.responses import ORJSONResponse
 import crud
 import schemas
 import models
@@ -10,7 +11,7 @@ from typing import Optional, Annotated
 import os 
 from jose import JWTError, jwt 
 
-app = FastAPI(title="UIT-Go Driver Service")
+app = FastAPI(title="UIT-Go Driver Service", default_response_class=ORJSONResponse)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -122,11 +123,14 @@ async def get_my_driver_profile(current_driver: models.Driver = Depends(get_curr
 @app.put("/drivers/me", response_model=schemas.DriverResponse)
 async def update_my_driver_profile(
     update_data: schemas.DriverUpdate,
+    background_tasks: BackgroundTasks,
     current_driver: models.Driver = Depends(get_current_driver)
 ):
     updated_driver = await crud.update_driver_profile(current_driver.id, update_data)
     if not updated_driver:
         raise HTTPException(status_code=400, detail="Không thể cập nhật hồ sơ tài xế")
+    # TripService cache thông tin tài xế -> báo xóa cache sau khi trả response
+    background_tasks.add_task(crud.notify_trip_service_driver_updated, current_driver.id)
     return updated_driver
 
 @app.post("/drivers/me/online", response_model=schemas.DriverResponse)
@@ -1,4 +1,5 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query, Body
+from fastapi.responses import ORJSONResponse
 from typing import List, Dict
 import crud
 import schemas
@@ -9,7 +10,7 @@ import json
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="UIT-Go Location Service (Redis + WebSocket)", version="1.0.0")
+app = FastAPI(title="UIT-Go Location Service (Redis + WebSocket)", version="1.0.0", default_response_class=ORJSONResponse)
 
 @app.get("/")
 async def root():
@@ -61,6 +62,18 @@ class TripConnectionManager:
             if driver_ws:
                 await driver_ws.send_json(message)
 
+    async def send_to(self, trip_id: str, user_type: str, message: dict) -> bool:
+        websocket = self.active_rooms.get(trip_id, {}).get(user_type)
+        if not websocket:
+            return False
+        try:
+            await websocket.send_json(message)
+            return True
+        except Exception as e:
+            logger.warning(f"Phòng {trip_id}: Lỗi khi gửi cho {user_type}: {e}")
+            self.disconnect(trip_id, user_type)
+            return False
+
 trip_manager = TripConnectionManager()
 
 
@@ -230,3 +243,15 @@ async def notify_trip_participant(
         return {"message": f"Đã gửi thông báo cho driver trong phòng {trip_id}"}
     else:
         raise HTTPException(status_code=400, detail="user_type phải là 'driver' hoặc 'passenger'")
+
+
+@app.post("/notify/trips/batch")
+async def notify_trip_events(request: schemas.TripEventBatchRequest = Body(...)):
+    """Nhận một lô sự kiện chuyến đi từ TripService và đẩy vào các phòng WebSocket tương ứng."""
+    sent_count = 0
+    for event in request.events:
+        for user_type in event.user_types:
+            if user_type in ("driver", "passenger") and await trip_manager.send_to(event.trip_id, user_type, event.payload):
+                sent_count += 1
+    logger.info(f"NotifyTripEvents: Nhận {len(request.events)} sự kiện, đã gửi {sent_count} tin nhắn.")
+    return {"message": f"Đã gửi {sent_count} tin nhắn.", "event_count": len(request.events), "sent_count": sent_count}
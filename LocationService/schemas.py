@@ -19,3 +19,11 @@ class NotificationRequest(BaseModel):
 
 class SingleNotificationRequest(BaseModel):
     payload: Dict[str, Any] = Field(..., description="Nội dung JSON để gửi qua WebSocket")
+
+class TripEvent(BaseModel):
+    trip_id: str
+    user_types: List[str] = Field(default=["passenger", "driver"], description="Người nhận trong phòng chuyến đi")
+    payload: Dict[str, Any] = Field(..., description="Nội dung JSON để gửi qua WebSocket")
+
+class TripEventBatchRequest(BaseModel):
+    events: List[TripEvent] = Field(..., description="Danh sách sự kiện chuyến đi (gom theo lô từ TripService)")
@@ -7,6 +7,7 @@ import asyncio
 import logging
 import httpx
 import uuid
+import base64
 from datetime import datetime, timezone
 from typing import Dict, Optional, Any
 from urllib.parse import urlencode, quote_plus
@@ -17,8 +18,14 @@ import models
 import schemas
 
 # Import các hàm lấy collection từ database.py
-from database import get_wallets_collection, get_transactions_collection
+from database import get_wallets_collection, get_transactions_collection, run_in_transaction
+import ledger
+import pricing
+from trip_cache import trip_cache
+import trip_notifier
 from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 # --- Cấu hình Logging ---
 logging.basicConfig(level=logging.INFO)
@@ -31,7 +38,6 @@ VNP_URL = os.getenv("VNP_URL")
 TRIP_SERVICE_URL = os.getenv("TRIP_SERVICE_URL", "http://tripservice:8000")
 # Bỏ đọc BASE_URL trực tiếp ở đây
 # DRIVER_SERVICE_URL = os.getenv("DRIVER_SERVICE_URL")
-APP_COMMISSION_RATE = 0.20
 
 # === [HÀM MỚI] Lấy Base URL linh hoạt ===
 def _get_base_url() -> str:
@@ -117,7 +123,8 @@ async def process_vnpay_payment(request: schemas.ProcessPaymentRequest) -> Dict:
                 transaction_id=order_id,
                 user_id=request.user_id, # Đảm bảo user_id có trong ProcessPaymentRequest
                 trip_id=request.trip_id,
-                amount=request.amount,
+                driver_id=request.driver_id, # Lưu sẵn để callback VNPay không phải gọi TripService
+                amount=request.amount, # Cước thực tế của chuyến
                 transaction_type=models.TransactionType.PAYMENT,
                 payment_method="VNPAY",
                 status=models.TransactionStatus.PENDING,
@@ -139,57 +146,204 @@ async def process_vnpay_payment(request: schemas.ProcessPaymentRequest) -> Dict:
         return {"status": "FAILED", "message": "Có lỗi xảy ra khi tạo yêu cầu thanh toán."}
 
 
-# --- Các hàm khác (get_or_create_wallet, top_up_driver_wallet, handle_vnpay_return) ---
-# --- GIỮ NGUYÊN NHƯ CODE CŨ CỦA BẠN ---
+# --- Ví tài xế: mọi thay đổi số dư đi qua _apply_wallet_change (upsert + ghi giao dịch) ---
 # Lưu ý: Hàm handle_vnpay_return (xử lý IPN/Return) cũng cần được kiểm tra
 #       và đảm bảo logic cộng tiền, gọi TripService hoạt động đúng.
 
 async def get_or_create_wallet(driver_id: str) -> Optional[Dict[str, Any]]:
-    # ... (Giữ nguyên code của bạn) ...
+    """Lấy ví của tài xế, tạo ví rỗng nếu chưa có (một lệnh upsert duy nhất)."""
     wallets_coll: Optional[AsyncIOMotorCollection] = await get_wallets_collection()
     if wallets_coll is None:
         logger.error("Lỗi: Không lấy được wallets_collection trong get_or_create_wallet")
         return None
-    wallet_data = await wallets_coll.find_one({"driver_id": driver_id})
-    if not wallet_data:
-        logger.info(f"PaymentService: Tạo ví mới cho tài xế {driver_id}")
-        new_wallet = models.DriverWallet(driver_id=driver_id)
-        insert_data = new_wallet.model_dump(by_alias=True, exclude={"id"})
-        await wallets_coll.insert_one(insert_data)
+    now = datetime.now(timezone.utc)
+    try:
+        wallet_data = await wallets_coll.find_one_and_update(
+            {"driver_id": driver_id},
+            {"$setOnInsert": {"balance": 0.0, "created_at": now, "updated_at": now}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Hai request cùng tạo ví lần đầu: bên thua đọc lại ví bên thắng đã tạo
         wallet_data = await wallets_coll.find_one({"driver_id": driver_id})
     if wallet_data and "_id" in wallet_data:
         wallet_data["_id"] = str(wallet_data["_id"])
     return wallet_data
 
 
-async def top_up_driver_wallet(request: schemas.TopUpRequest) -> Optional[Dict[str, Any]]:
-    # ... (Giữ nguyên code của bạn, chỉ thêm logger) ...
+def _is_wallet_upsert_race(error: DuplicateKeyError) -> bool:
+    """Trùng khóa do hai lệnh upsert cùng tạo ví lần đầu (unique driver_id), không phải trùng transaction_id."""
+    return "driver_id" in ((error.details or {}).get("keyPattern") or {})
+
+
+async def _apply_wallet_change(
+    driver_id: str,
+    amount: float,
+    entry: models.Transaction,
+    require_balance: bool = False
+) -> Optional[Dict[str, Any]]:
+    """
+    Cộng/trừ số dư ví (upsert, tạo ví nếu chưa có), ghi posting vào sổ cái (ledger.py) và
+    giao dịch tương ứng vào 'transactions' trong cùng một Mongo transaction. Trả về ví sau khi cập nhật.
+    require_balance: chỉ trừ khi ví tồn tại và đủ số dư (không upsert); không đủ thì trả về None.
+
+    Dòng giao dịch (unique transaction_id) được ghi TRƯỚC khi $inc số dư, nên nó là chốt chặn:
+    khi không có transaction (MongoDB standalone, CosmosDB) giao dịch trùng ném DuplicateKeyError
+    trước khi ví hay sổ cái bị động đến. Nếu tiến trình chết giữa hai bước, dòng giao dịch còn lại
+    không có balance_after (ví chưa đổi) để đối soát tìm ra.
+    """
     wallets_coll: Optional[AsyncIOMotorCollection] = await get_wallets_collection()
     transactions_coll: Optional[AsyncIOMotorCollection] = await get_transactions_collection()
     if wallets_coll is None or transactions_coll is None:
-        logger.error("Lỗi: Không lấy được collection trong top_up_driver_wallet")
+        logger.error(f"Không lấy được collection để cập nhật ví tài xế {driver_id}")
         return None
-    wallet = await get_or_create_wallet(request.driver_id)
-    if not wallet: return None
-    update_result = await wallets_coll.update_one(
-        {"driver_id": request.driver_id},
-        {"$inc": {"balance": request.amount}, "$set": {"updated_at": datetime.now(timezone.utc)}}
-    )
-    if update_result.modified_count == 1:
-        top_up_transaction = models.Transaction(
-            user_id=request.driver_id,
-            transaction_type=models.TransactionType.TOPUP,
-            amount=request.amount,
-            status=models.TransactionStatus.SUCCESS,
-            description=request.note
+
+    async def _update_wallet(session, now):
+        wallet_filter: Dict[str, Any] = {"driver_id": driver_id}
+        if require_balance:
+            wallet_filter["balance"] = {"$gte": -amount}
+        return await wallets_coll.find_one_and_update(
+            wallet_filter,
+            {
+                "$inc": {"balance": amount, "ledger_seq": 1},
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"created_at": now}
+            },
+            upsert=not require_balance,
+            return_document=ReturnDocument.AFTER,
+            session=session
         )
-        await transactions_coll.insert_one(top_up_transaction.model_dump(by_alias=True, exclude={"id"}))
-        updated_wallet = await wallets_coll.find_one({"driver_id": request.driver_id})
-        if updated_wallet and "_id" in updated_wallet:
-            updated_wallet["_id"] = str(updated_wallet["_id"])
-        return updated_wallet
-    else:
-        logger.error(f"Lỗi khi cập nhật số dư cho ví của tài xế {request.driver_id}")
+
+    async def _mutate(session):
+        now = datetime.now(timezone.utc)
+        await transactions_coll.insert_one(entry.model_dump(by_alias=True, exclude={"id"}), session=session)
+        try:
+            wallet = await _update_wallet(session, now)
+        except DuplicateKeyError as e:
+            if session is not None or not _is_wallet_upsert_race(e):
+                raise
+            # Không có transaction: giao dịch đã được giữ chỗ, chỉ chạy lại lệnh cập nhật (ví đã có)
+            wallet = await _update_wallet(session, now)
+        if wallet is None:
+            # Không đủ số dư: trả lại chỗ đã giữ để lần sau có thể thử lại
+            await transactions_coll.delete_one({"transaction_id": entry.transaction_id}, session=session)
+            return None
+        await ledger.append_postings([ledger.build_posting(
+            posting_id=entry.transaction_id,
+            driver_id=driver_id,
+            amount=amount,
+            transaction_type=entry.transaction_type,
+            seq=wallet["ledger_seq"],
+            balance_after=wallet["balance"],
+            trip_id=entry.trip_id,
+            created_at=now
+        )], session=session)
+        await transactions_coll.update_one(
+            {"transaction_id": entry.transaction_id},
+            {"$set": {"wallet_id": str(wallet["_id"]), "balance_after": wallet["balance"]}},
+            session=session
+        )
+        return wallet
+
+    try:
+        wallet = await run_in_transaction(_mutate)
+    except DuplicateKeyError as e:
+        if not _is_wallet_upsert_race(e):
+            raise
+        # Upsert đồng thời lần đầu cho cùng tài xế: transaction đã bị hủy toàn bộ, chạy lại sẽ là update thường
+        wallet = await run_in_transaction(_mutate)
+    if wallet and "_id" in wallet:
+        wallet["_id"] = str(wallet["_id"])
+    return wallet
+
+
+async def debit_driver_wallet(driver_id: str, amount: float, transaction_id: str, description: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Trừ tiền ví tài xế khi chi trả (PAYOUT). Trả về None nếu ví không tồn tại hoặc không đủ số dư.
+    transaction_id đã được ghi trước đó (lần chạy trước/đồng thời đã trừ) thì không trừ lần hai, trả về ví hiện tại.
+    """
+    payout_transaction = models.Transaction(
+        transaction_id=transaction_id,
+        user_id=driver_id,
+        transaction_type=models.TransactionType.PAYOUT,
+        amount=-amount,
+        status=models.TransactionStatus.SUCCESS,
+        description=description
+    )
+    try:
+        wallet = await _apply_wallet_change(driver_id, -amount, payout_transaction, require_balance=True)
+    except DuplicateKeyError:
+        logger.info(f"Giao dịch chi trả {transaction_id} cho tài xế {driver_id} đã được ghi trước đó, bỏ qua.")
+        return await get_or_create_wallet(driver_id)
+    except Exception as e:
+        logger.error(f"Lỗi khi trừ tiền ví tài xế {driver_id}: {e}", exc_info=True)
+        return None
+    if wallet is None:
+        logger.warning(f"Không thể chi trả {amount} cho tài xế {driver_id}: ví không tồn tại hoặc không đủ số dư.")
+    return wallet
+
+
+# Field trả về cho màn hình lịch sử (bỏ các field VNPay / lỗi nội bộ)
+TRANSACTION_HISTORY_PROJECTION = {
+    "transaction_id": 1, "transaction_type": 1, "amount": 1, "balance_after": 1,
+    "trip_id": 1, "status": 1, "description": 1, "created_at": 1,
+}
+
+
+def encode_history_cursor(transaction: Dict[str, Any]) -> str:
+    raw = f"{transaction['created_at'].isoformat()}|{transaction['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_history_cursor(cursor: str) -> tuple:
+    """Trả về (created_at, _id) của giao dịch cuối trang trước; ValueError nếu cursor hỏng."""
+    try:
+        created_at, raw_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(created_at), ObjectId(raw_id) if ObjectId.is_valid(raw_id) else raw_id
+    except Exception as e:
+        raise ValueError("Cursor không hợp lệ") from e
+
+
+async def get_wallet_transactions(
+    driver_id: str,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    transaction_type: Optional[models.TransactionType] = None
+) -> Dict[str, Any]:
+    """
+    Lịch sử giao dịch của tài xế, mới nhất trước, phân trang theo cursor (created_at, _id)
+    dùng index user_id + created_at + _id, không skip.
+    """
+    transactions_coll: Optional[AsyncIOMotorCollection] = await get_transactions_collection()
+    query: Dict[str, Any] = {"user_id": driver_id}
+    if transaction_type is not None:
+        query["transaction_type"] = transaction_type.value
+    if cursor:
+        created_at, last_id = decode_history_cursor(cursor)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": last_id}},
+        ]
+    items = await transactions_coll.find(query, TRANSACTION_HISTORY_PROJECTION).sort(
+        [("created_at", -1), ("_id", -1)]
+    ).limit(limit + 1).to_list(length=limit + 1)
+    next_cursor = encode_history_cursor(items[limit - 1]) if len(items) > limit else None
+    return {"items": items[:limit], "next_cursor": next_cursor}
+
+
+async def top_up_driver_wallet(request: schemas.TopUpRequest) -> Optional[Dict[str, Any]]:
+    top_up_transaction = models.Transaction(
+        user_id=request.driver_id,
+        transaction_type=models.TransactionType.TOPUP,
+        amount=request.amount,
+        status=models.TransactionStatus.SUCCESS,
+        description=request.note
+    )
+    try:
+        return await _apply_wallet_change(request.driver_id, request.amount, top_up_transaction)
+    except Exception as e:
+        logger.error(f"Lỗi khi cập nhật số dư cho ví của tài xế {request.driver_id}: {e}", exc_info=True)
         return None
 
 async def handle_vnpay_return(vnpay_response_data: Dict[str, Any]) -> bool:
@@ -223,97 +377,69 @@ async def handle_vnpay_return(vnpay_response_data: Dict[str, Any]) -> bool:
     vnp_response_code = vnpay_response_data.get('vnp_ResponseCode')
     if not order_id: return False
 
-    transaction = await transactions_coll.find_one({"transaction_id": order_id, "status": models.TransactionStatus.PENDING})
+    new_status = models.TransactionStatus.SUCCESS if vnp_response_code == '00' else models.TransactionStatus.FAILED
+    # Chuyển PENDING -> trạng thái mới trong một lệnh nguyên tử: chỉ lượt thắng mới cộng tiền,
+    # IPN trùng (kể cả khi khóa trong ipn_dedup đã hết hạn) không thể cộng lần hai
+    transaction = await transactions_coll.find_one_and_update(
+        {"transaction_id": order_id, "status": models.TransactionStatus.PENDING},
+        {"$set": {
+            "status": new_status,
+            "vnpay_response_code": vnp_response_code,
+            "vnpay_transaction_no": vnp_transaction_no,
+            "updated_at": datetime.now(timezone.utc)
+        }},
+        return_document=ReturnDocument.BEFORE
+    )
     if not transaction:
         logger.warning(f"PaymentService: Không tìm thấy giao dịch PENDING {order_id} hoặc đã xử lý.")
-        # Kiểm tra xem có phải đã SUCCESS không (do IPN chạy trước)
-        existing = await transactions_coll.find_one({"transaction_id": order_id})
+        # Kiểm tra xem có phải đã xử lý không (do IPN chạy trước)
+        existing = await transactions_coll.find_one({"transaction_id": order_id}, {"_id": 1})
         return existing is not None # Trả về True nếu giao dịch đã tồn tại (đã xử lý)
+    logger.info(f"PaymentService: Đã cập nhật giao dịch {order_id} thành {new_status}")
 
-    new_status = models.TransactionStatus.FAILED
-    if vnp_response_code == '00':
-        new_status = models.TransactionStatus.SUCCESS
+    if new_status == models.TransactionStatus.SUCCESS:
         # === [THÊM LOGIC TÍNH TOÁN VÀ CỘNG TIỀN CHO TÀI XẾ] ===
         trip_id = transaction.get("trip_id")
         # Lấy số tiền gốc khách hàng trả (đã lưu trong transaction)
         total_fare = transaction.get("amount")
 
-        if trip_id and total_fare:
-            # Gọi TripService lấy chi tiết chuyến đi (để lấy driver_id)
-            trip_details = await get_trip_details(trip_id)
+        driver_id = transaction.get("driver_id")
+        fare_to_process = total_fare
 
+        if trip_id and total_fare and not driver_id:
+            # Giao dịch cũ không lưu driver_id: hỏi TripService (qua cache TTL)
+            trip_details = await trip_cache.get_or_fetch(trip_id, get_trip_details)
             if trip_details and trip_details.get("driver_id"):
                 driver_id = trip_details["driver_id"]
                 # Lấy cước phí thực tế từ TripService nếu có (chính xác hơn)
-                actual_fare_from_trip = trip_details.get("fare", {}).get("actual")
-                fare_to_process = actual_fare_from_trip if actual_fare_from_trip else total_fare
-
-                # Tính toán hoa hồng và thu nhập tài xế
-                commission = fare_to_process * APP_COMMISSION_RATE
-                driver_earning = fare_to_process - commission
-                logger.info(f"Chuyến {trip_id}: Cước {fare_to_process}, Hoa hồng {commission}, Tài xế {driver_id} nhận {driver_earning}")
-
-                # Gọi hàm cộng tiền vào ví tài xế
-                credit_success = await credit_driver_wallet(driver_id, driver_earning, trip_id)
-                if not credit_success:
-                     logger.error(f"Lỗi nghiêm trọng: Không thể cộng tiền cho tài xế {driver_id} (chuyến {trip_id}) sau khi thanh toán thành công.")
-                     # Cần có cơ chế xử lý lỗi này (ví dụ: retry, báo cáo...)
-            else:
-                 logger.error(f"Không thể lấy driver_id hoặc chi tiết cho chuyến {trip_id} để cộng tiền.")
-        else:
+                fare_to_process = (trip_details.get("fare") or {}).get("actual") or total_fare
+
+        if not (trip_id and total_fare):
              logger.error(f"Thiếu trip_id hoặc amount trong transaction {order_id} để xử lý doanh thu.")
+        elif not driver_id:
+             logger.error(f"Không thể lấy driver_id hoặc chi tiết cho chuyến {trip_id} để cộng tiền.")
+        else:
+            # Tính toán hoa hồng và thu nhập tài xế
+            commission = fare_to_process * pricing.get_plan().commission_rate
+            driver_earning = fare_to_process - commission
+            logger.info(f"Chuyến {trip_id}: Cước {fare_to_process}, Hoa hồng {commission}, Tài xế {driver_id} nhận {driver_earning}")
+
+            # Gọi hàm cộng tiền vào ví tài xế
+            credit_success = await credit_driver_wallet(driver_id, driver_earning, trip_id)
+            if not credit_success:
+                 logger.error(f"Lỗi nghiêm trọng: Không thể cộng tiền cho tài xế {driver_id} (chuyến {trip_id}) sau khi thanh toán thành công.")
+                 # Cần có cơ chế xử lý lỗi này (ví dụ: retry, báo cáo...)
         # === [HẾT PHẦN LOGIC THÊM] ===
-        
-    update_result = await transactions_coll.update_one(
-        {"transaction_id": order_id, "status": models.TransactionStatus.PENDING}, # Thêm status PENDING vào query
-        {"$set": {
-            "status": new_status,
-            "vnpay_response_code": vnp_response_code,
-            "vnpay_transaction_no": vnp_transaction_no,
-            "updated_at": datetime.now(timezone.utc)
-        }}
-    )
-
-    if update_result.modified_count == 1:
-        logger.info(f"PaymentService: Đã cập nhật giao dịch {order_id} thành {new_status}")
-        # Gọi TripService lần nữa nếu là SUCCESS (đã làm ở trên)
-        return True
-    else:
-        logger.error(f"PaymentService: Lỗi khi cập nhật giao dịch {order_id} (có thể đã được IPN xử lý trước).")
-        # Kiểm tra lại xem có phải đã SUCCESS không
-        check_again = await transactions_coll.find_one({"transaction_id": order_id, "status": models.TransactionStatus.SUCCESS})
-        return check_again is not None # Trả về True nếu nó đã Success rồi
+    return True
 
 # === [THÊM HÀM HELPER GỌI TRIP SERVICE] ===
 async def notify_trip_service_payment_status(trip_id: str, transaction_id: str, status: models.TransactionStatus):
-    """Gọi TripService để cập nhật trạng thái thanh toán của chuyến đi."""
-    TRIP_SERVICE_URL = os.getenv("TRIP_SERVICE_URL") # Đọc URL TripService
-    if not TRIP_SERVICE_URL:
-        logger.error("TRIP_SERVICE_URL chưa được cấu hình. Không thể thông báo trạng thái thanh toán.")
-        return
-
-    # Endpoint này cần được tạo bên TripService
-    url = f"{TRIP_SERVICE_URL}/trips/{trip_id}/payment" 
-    payload = {
-        "status": status.value, # "SUCCESS" hoặc "FAILED"
-        "transaction_id": transaction_id
-        # Có thể thêm paid_at nếu cần
-        # "paid_at": datetime.now(timezone.utc).isoformat() if status == models.TransactionStatus.SUCCESS else None
-    }
-    
-    logger.info(f"Đang thông báo trạng thái thanh toán ({status.value}) cho TripService (chuyến {trip_id})...")
+    """Xếp thông báo trạng thái thanh toán cho TripService vào outbox (trip_notifier gửi lại đến khi thành công)."""
     try:
-        async with httpx.AsyncClient() as client:
-            # Dùng PUT để cập nhật
-            response = await client.put(url, json=payload, timeout=10.0)
-            response.raise_for_status()
-            logger.info(f"Thông báo trạng thái thanh toán cho TripService thành công.")
-    except httpx.RequestError as e:
-        logger.error(f"Lỗi kết nối đến TripService để thông báo thanh toán: {e}")
-    except httpx.HTTPStatusError as e:
-        logger.error(f"TripService trả lỗi khi cập nhật thanh toán: {e.response.status_code} - {e.response.text}")
+        await trip_notifier.enqueue_payment_status(trip_id, transaction_id, status.value)
+        logger.info(f"Đã xếp thông báo trạng thái thanh toán ({status.value}) cho TripService (chuyến {trip_id}).")
     except Exception as e:
-         logger.error(f"Lỗi không xác định khi thông báo thanh toán cho TripService: {e}")
+        logger.error(f"Lỗi khi xếp thông báo thanh toán cho TripService (chuyến {trip_id}): {e}")
 
 # (Bạn có thể cần thêm các hàm helper khác như credit_driver_wallet nếu logic đó nằm ở đây)
 # === [THÊM 2 HÀM HELPER MỚI NÀY] ===
@@ -327,14 +453,13 @@ async def get_trip_details(trip_id: str) -> Optional[Dict[str, Any]]:
     url = f"{TRIP_SERVICE_URL}/trips/{trip_id}"
     logger.info(f"Đang gọi TripService để lấy chi tiết chuyến đi {trip_id} tại {url}...")
     try:
-        async with httpx.AsyncClient() as client:
-            # Giả sử API này không cần xác thực đặc biệt khi gọi nội bộ
-            # Nếu cần Service Token, bạn cần thêm logic lấy token tương tự TripService
-            response = await client.get(url, timeout=5.0)
-            response.raise_for_status() 
-            trip_data = response.json()
-            logger.info(f"Lấy chi tiết chuyến đi {trip_id} thành công.")
-            return trip_data
+        # Giả sử API này không cần xác thực đặc biệt khi gọi nội bộ
+        # Nếu cần Service Token, bạn cần thêm logic lấy token tương tự TripService
+        response = await trip_notifier.get_http_client().get(url, timeout=5.0)
+        response.raise_for_status()
+        trip_data = response.json()
+        logger.info(f"Lấy chi tiết chuyến đi {trip_id} thành công.")
+        return trip_data
     except httpx.RequestError as e:
         logger.error(f"Lỗi kết nối đến TripService để lấy chi tiết chuyến đi: {e}")
     except httpx.HTTPStatusError as e:
@@ -343,69 +468,66 @@ async def get_trip_details(trip_id: str) -> Optional[Dict[str, Any]]:
          logger.error(f"Lỗi không xác định khi lấy chi tiết chuyến đi: {e}")
     return None
 
-async def credit_driver_wallet(driver_id: str, amount: float, trip_id: str) -> bool:
-    """Cộng tiền vào ví tài xế (do PaymentService quản lý) và ghi log giao dịch."""
-    wallets_coll: Optional[AsyncIOMotorCollection] = await get_wallets_collection()
-    transactions_coll: Optional[AsyncIOMotorCollection] = await get_transactions_collection()
-    if wallets_coll is None or transactions_coll is None:
-        logger.error(f"Không lấy được collection trong credit_driver_wallet cho driver {driver_id}")
-        return False
-
-    # Lấy hoặc tạo ví
-    wallet = await get_or_create_wallet(driver_id)
-    if not wallet:
-        logger.error(f"Không thể lấy hoặc tạo ví cho driver {driver_id} để cộng tiền.")
-        return False
-
-    # Thực hiện cộng tiền
+async def credit_driver_wallet(driver_id: str, amount: float, trip_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Cộng tiền vào ví tài xế (do PaymentService quản lý) và ghi log giao dịch. Trả về ví sau khi cộng.
+    Idempotent theo chuyến: giao dịch EARNING có transaction_id cố định "EARNING_<trip_id>" (unique index)
+    được ghi trước khi cộng số dư, nên job/callback chạy lại (hoặc hai worker cùng nhận một job)
+    không cộng tiền lần hai mà chỉ trả về ví hiện tại.
+    """
+    earning_id = f"EARNING_{trip_id}"
+    earning_transaction = models.Transaction(
+        transaction_id=earning_id,
+        user_id=driver_id, # Giao dịch thuộc về tài xế
+        trip_id=trip_id,
+        transaction_type=models.TransactionType.EARNING, # Loại giao dịch mới
+        amount=amount, # Số tiền tài xế thực nhận
+        status=models.TransactionStatus.SUCCESS,
+        description=f"Thu nhập từ chuyến đi {trip_id}"
+    )
     try:
-        update_result = await wallets_coll.update_one(
-            {"driver_id": driver_id},
-            {"$inc": {"balance": amount}, "$set": {"updated_at": datetime.now(timezone.utc)}}
-        )
-
-        if update_result.modified_count == 1:
-            # Ghi lại giao dịch EARNING (Thu nhập)
-            earning_transaction = models.Transaction(
-                user_id=driver_id, # Giao dịch thuộc về tài xế
-                trip_id=trip_id,
-                transaction_type=models.TransactionType.EARNING, # Loại giao dịch mới
-                amount=amount, # Số tiền tài xế thực nhận
-                status=models.TransactionStatus.SUCCESS,
-                description=f"Thu nhập từ chuyến đi {trip_id}"
-            )
-            await transactions_coll.insert_one(earning_transaction.model_dump(by_alias=True, exclude={"id"}))
-            logger.info(f"Đã cộng {amount} vào ví tài xế {driver_id} cho chuyến {trip_id}.")
-            return True
-        else:
-            logger.error(f"Lỗi không mong muốn: Không thể cập nhật số dư cho ví của tài xế {driver_id} (modified_count=0).")
-            return False
+        wallet = await _apply_wallet_change(driver_id, amount, earning_transaction)
+    except DuplicateKeyError:
+        # Lần chạy trước/đồng thời đã giữ EARNING_<trip_id> (unique index): số dư không bị động đến
+        logger.info(f"Chuyến {trip_id} đã được cộng tiền cho tài xế {driver_id} trước đó, bỏ qua.")
+        return await get_or_create_wallet(driver_id)
     except Exception as e:
         logger.error(f"Lỗi khi cộng tiền vào ví tài xế {driver_id}: {e}", exc_info=True)
-        return False
+        return None
+    if wallet:
+        logger.info(f"Đã cộng {amount} vào ví tài xế {driver_id} cho chuyến {trip_id}.")
+    return wallet
 # === [HẾT PHẦN THÊM] ===
 
 # === [TRIP COMPLETION AND MOCK BANKING FUNCTIONS] ===
 
-def calculate_trip_fare(distance_km: float, base_rate_per_km: float = 5000.0, commission_rate: float = 0.20) -> schemas.TripFareCalculation:
+def calculate_trip_fare(
+    distance_km: float,
+    vehicle_type: Optional[str] = None,
+    requested_at: Optional[datetime] = None,
+    surge_multiplier: float = 1.0
+) -> schemas.TripFareCalculation:
     """
-    Tính toán cước phí chuyến đi dựa trên khoảng cách.
-    - 5,000 VND cho mỗi km
-    - 20% hoa hồng cho ứng dụng
+    Tính toán cước phí chuyến đi theo bảng giá dùng chung với TripService (pricing.py):
+    loại xe, khung giờ lúc đặt chuyến, hệ số surge, cước tối thiểu và hoa hồng ứng dụng.
     """
-    total_fare = distance_km * base_rate_per_km
-    commission_amount = total_fare * commission_rate
-    driver_earning = total_fare - commission_amount
-
+    fare = pricing.quote(distance_km, vehicle_type, requested_at, surge_multiplier)
     return schemas.TripFareCalculation(
         distance_km=distance_km,
-        base_fare=base_rate_per_km,
-        total_fare=total_fare,
-        commission_rate=commission_rate,
-        commission_amount=commission_amount,
-        driver_earning=driver_earning
+        vehicle_type=fare.vehicle_type,
+        base_fare=fare.base_fare,
+        per_km_rate=fare.per_km_rate,
+        surge_multiplier=fare.surge_multiplier,
+        total_fare=fare.total_fare,
+        commission_rate=fare.commission_rate,
+        commission_amount=fare.commission_amount,
+        driver_earning=fare.driver_earning,
+        pricing_version=fare.plan_version
     )
 
+def calculate_request_fare(request: schemas.TripCompletionRequest) -> schemas.TripFareCalculation:
+    return calculate_trip_fare(request.distance_km, request.vehicle_type, request.requested_at, request.surge_multiplier)
+
 async def process_mock_bank_transfer(request: schemas.MockBankTransferRequest) -> schemas.MockBankTransferResponse:
     """
     Mock banking system - giả lập chuyển khoản ngân hàng.
@@ -445,22 +567,59 @@ async def process_mock_bank_transfer(request: schemas.MockBankTransferRequest) -
             timestamp=datetime.now(timezone.utc)
         )
 
-async def process_trip_completion_payment(request: schemas.TripCompletionRequest) -> schemas.TripCompletionResponse:
+async def find_trip_completion_payment(trip_id: str, payment_method: str) -> Optional[Dict[str, Any]]:
+    """Giao dịch PAYMENT thành công đã lưu cho chuyến (lần chạy trước của job), nếu có."""
+    transactions_coll: Optional[AsyncIOMotorCollection] = await get_transactions_collection()
+    return await transactions_coll.find_one(
+        {
+            "trip_id": trip_id,
+            "transaction_type": models.TransactionType.PAYMENT.value,
+            "payment_method": payment_method,
+            "status": models.TransactionStatus.SUCCESS.value
+        },
+        {"transaction_id": 1}
+    )
+
+async def process_trip_completion_payment(
+    request: schemas.TripCompletionRequest,
+    fare_details: Optional[schemas.TripFareCalculation] = None
+) -> schemas.TripCompletionResponse:
     """
     Xử lý thanh toán khi tài xế hoàn thành chuyến đi.
     Hỗ trợ cả chuyển khoản ngân hàng (mock) và tiền mặt.
+
+    Chạy trong worker payment_jobs (giao ít nhất một lần), nên phải chạy lại được an toàn:
+    giao dịch PAYMENT thành công được lưu TRƯỚC khi cộng ví và được dùng lại ở lần chạy sau
+    (không chuyển khoản lần hai), còn cộng ví idempotent theo "EARNING_<trip_id>".
+    Lỗi hệ thống (lưu giao dịch, cộng ví) được ném ra để payment_jobs thử lại job.
+    fare_details: báo giá đã chốt lúc xếp hàng job; không có thì tính theo bảng giá hiện tại.
     """
-    try:
-        # Bước 1: Tính toán cước phí
-        fare_details = calculate_trip_fare(request.distance_km)
-        logger.info(f"Chuyến {request.trip_id}: Quãng đường {request.distance_km:.1f}km, Tổng cước: {fare_details.total_fare:,.0f} VNĐ, Tài xế nhận: {fare_details.driver_earning:,.0f} VNĐ")
+    # Bước 1: Tính toán cước phí
+    fare_details = fare_details or calculate_request_fare(request)
+    logger.info(f"Chuyến {request.trip_id}: Quãng đường {request.distance_km:.1f}km, Tổng cước: {fare_details.total_fare:,.0f} VNĐ, Tài xế nhận: {fare_details.driver_earning:,.0f} VNĐ")
+
+    # Bước 2: Xử lý thanh toán theo phương thức (bỏ qua nếu lần chạy trước đã thanh toán xong)
+    bank_transfer_result = None
+    payment_method = request.payment_method.upper()
+    if payment_method not in ("BANK_TRANSFER", "CASH"):
+        return schemas.TripCompletionResponse(
+            success=False,
+            trip_id=request.trip_id,
+            fare_details=fare_details,
+            payment_method=request.payment_method,
+            payment_status="FAILED",
+            message="Phương thức thanh toán không hợp lệ. Chỉ hỗ trợ BANK_TRANSFER hoặc CASH."
+        )
 
-        # Bước 2: Xử lý thanh toán theo phương thức
-        bank_transfer_result = None
+    existing_payment = await find_trip_completion_payment(request.trip_id, request.payment_method)
+    if existing_payment:
+        transaction_id = existing_payment["transaction_id"]
+        logger.info(f"Chuyến {request.trip_id} đã thanh toán ({transaction_id}) ở lần chạy trước, tiếp tục cộng ví.")
+    else:
         payment_status = "FAILED"
         transaction_id = None
 
-        if request.payment_method.upper() == "BANK_TRANSFER":
+        if payment_method == "BANK_TRANSFER":
             # Xử lý chuyển khoản ngân hàng (mock)
             if not request.user_bank_info:
                 return schemas.TripCompletionResponse(
@@ -484,49 +643,13 @@ async def process_trip_completion_payment(request: schemas.TripCompletionRequest
             if bank_transfer_result.success:
                 payment_status = "SUCCESS"
                 transaction_id = bank_transfer_result.transaction_id
-            else:
-                payment_status = "FAILED"
 
-        elif request.payment_method.upper() == "CASH":
+        else:
             # Thanh toán tiền mặt - mặc định thành công (tài xế xác nhận đã nhận tiền)
             payment_status = "SUCCESS"
             transaction_id = f"CASH_{uuid.uuid4().hex[:16].upper()}"
 
-        else:
-            return schemas.TripCompletionResponse(
-                success=False,
-                trip_id=request.trip_id,
-                fare_details=fare_details,
-                payment_method=request.payment_method,
-                payment_status="FAILED",
-                message="Phương thức thanh toán không hợp lệ. Chỉ hỗ trợ BANK_TRANSFER hoặc CASH."
-            )
-
-        # Bước 3: Nếu thanh toán thành công, cộng tiền vào ví tài xế
-        driver_wallet_updated = False
-        new_driver_balance = None
-
-        if payment_status == "SUCCESS":
-            # Lấy hoặc tạo ví cho tài xế
-            wallet_success = await credit_driver_wallet(
-                driver_id=request.driver_id,
-                amount=fare_details.driver_earning,
-                trip_id=request.trip_id
-            )
-
-            if wallet_success:
-                driver_wallet_updated = True
-                # Lấy số dư mới
-                wallet = await get_or_create_wallet(request.driver_id)
-                if wallet:
-                    new_driver_balance = wallet.get("balance", 0.0)
-
-                logger.info(f"Đã cộng {fare_details.driver_earning:,.0f} VNĐ vào ví tài xế {request.driver_id}")
-            else:
-                logger.error(f"Lỗi: Không thể cộng tiền vào ví tài xế {request.driver_id}")
-                payment_status = "PARTIAL_SUCCESS"  # Thanh toán thành công nhưng cộng tiền thất bại
-
-        # Bước 4: Lưu giao dịch vào database
+        # Bước 3: Lưu giao dịch vào database (trước khi cộng ví, để lần chạy lại không thanh toán lần hai)
         await save_trip_completion_transaction(
             trip_id=request.trip_id,
             user_id=request.user_id,
@@ -537,36 +660,53 @@ async def process_trip_completion_payment(request: schemas.TripCompletionRequest
             transaction_id=transaction_id
         )
 
-        # Bước 5: Thông báo cho TripService về trạng thái thanh toán
-        if payment_status in ["SUCCESS", "PARTIAL_SUCCESS"]:
+        if payment_status != "SUCCESS":
             await notify_trip_service_payment_status(
                 trip_id=request.trip_id,
                 transaction_id=transaction_id or "",
-                status=models.TransactionStatus.SUCCESS if payment_status == "SUCCESS" else models.TransactionStatus.FAILED
+                status=models.TransactionStatus.FAILED
+            )
+            return schemas.TripCompletionResponse(
+                success=False,
+                trip_id=request.trip_id,
+                fare_details=fare_details,
+                payment_method=request.payment_method,
+                payment_status=payment_status,
+                transaction_id=transaction_id,
+                bank_transfer_result=bank_transfer_result,
+                message=bank_transfer_result.message if bank_transfer_result else None
             )
 
-        return schemas.TripCompletionResponse(
-            success=payment_status in ["SUCCESS", "PARTIAL_SUCCESS"],
-            trip_id=request.trip_id,
-            fare_details=fare_details,
-            payment_method=request.payment_method,
-            payment_status=payment_status,
-            transaction_id=transaction_id,
-            bank_transfer_result=bank_transfer_result,
-            driver_wallet_updated=driver_wallet_updated,
-            new_driver_balance=new_driver_balance
-        )
+    # Bước 4: Cộng tiền vào ví tài xế (tạo ví nếu chưa có), nhận lại ví với số dư mới
+    wallet = await credit_driver_wallet(
+        driver_id=request.driver_id,
+        amount=fare_details.driver_earning,
+        trip_id=request.trip_id
+    )
+    if not wallet:
+        # Đã thu tiền nhưng chưa cộng được ví: ném lỗi để payment_jobs thử lại (cộng ví idempotent)
+        raise RuntimeError(f"Không thể cộng tiền vào ví tài xế {request.driver_id} cho chuyến {request.trip_id}")
+    logger.info(f"Đã cộng {fare_details.driver_earning:,.0f} VNĐ vào ví tài xế {request.driver_id}")
+
+    # Bước 5: Thông báo cho TripService về trạng thái thanh toán
+    # (chạy trong worker của payment_jobs nên TripService chỉ biết kết quả qua callback này)
+    await notify_trip_service_payment_status(
+        trip_id=request.trip_id,
+        transaction_id=transaction_id,
+        status=models.TransactionStatus.SUCCESS
+    )
 
-    except Exception as e:
-        logger.error(f"Lỗi trong process_trip_completion_payment: {e}", exc_info=True)
-        return schemas.TripCompletionResponse(
-            success=False,
-            trip_id=request.trip_id,
-            fare_details=calculate_trip_fare(request.distance_km),  # Vẫn tính fare để client biết
-            payment_method=request.payment_method,
-            payment_status="FAILED",
-            message=f"Lỗi hệ thống: {str(e)}"
-        )
+    return schemas.TripCompletionResponse(
+        success=True,
+        trip_id=request.trip_id,
+        fare_details=fare_details,
+        payment_method=request.payment_method,
+        payment_status="SUCCESS",
+        transaction_id=transaction_id,
+        bank_transfer_result=bank_transfer_result,
+        driver_wallet_updated=True,
+        new_driver_balance=wallet.get("balance", 0.0)
+    )
 
 async def save_trip_completion_transaction(
     trip_id: str,
@@ -577,29 +717,24 @@ async def save_trip_completion_transaction(
     payment_status: str,
     transaction_id: Optional[str] = None
 ):
-    """Lưu giao dịch hoàn thành chuyến đi vào database"""
+    """Lưu giao dịch hoàn thành chuyến đi vào database (lỗi được ném ra để job thử lại)."""
     transactions_coll: Optional[AsyncIOMotorCollection] = await get_transactions_collection()
     if transactions_coll is None:
-        logger.error("Không thể lấy transactions_collection để lưu giao dịch chuyến đi")
-        return
-
-    try:
-        transaction = models.Transaction(
-            transaction_id=transaction_id or f"TRIP_{uuid.uuid4().hex[:16].upper()}",
-            user_id=user_id,
-            trip_id=trip_id,
-            amount=fare_details.total_fare,
-            transaction_type=models.TransactionType.PAYMENT,
-            payment_method=payment_method,
-            status=models.TransactionStatus.SUCCESS if payment_status == "SUCCESS" else models.TransactionStatus.FAILED,
-            description=f"Thanh toán chuyến đi {trip_id} ({payment_method})"
-        )
-
-        await transactions_coll.insert_one(transaction.model_dump(by_alias=True, exclude={"id"}))
-        logger.info(f"Đã lưu giao dịch chuyến đi {trip_id} với trạng thái {payment_status}")
-
-    except Exception as e:
-        logger.error(f"Lỗi khi lưu giao dịch chuyến đi {trip_id}: {e}", exc_info=True)
+        raise RuntimeError("Không thể lấy transactions_collection để lưu giao dịch chuyến đi")
+
+    transaction = models.Transaction(
+        transaction_id=transaction_id or f"TRIP_{uuid.uuid4().hex[:16].upper()}",
+        user_id=user_id,
+        driver_id=driver_id,
+        trip_id=trip_id,
+        amount=fare_details.total_fare,
+        transaction_type=models.TransactionType.PAYMENT,
+        payment_method=payment_method,
+        status=models.TransactionStatus.SUCCESS if payment_status == "SUCCESS" else models.TransactionStatus.FAILED,
+        description=f"Thanh toán chuyến đi {trip_id} ({payment_method})"
+    )
+    await transactions_coll.insert_one(transaction.model_dump(by_alias=True, exclude={"id"}))
+    logger.info(f"Đã lưu giao dịch chuyến đi {trip_id} với trạng thái {payment_status}")
 
 # === [END TRIP COMPLETION AND MOCK BANKING FUNCTIONS] ===
 
@@ -1,8 +1,11 @@
 # PaymentService/database.py
 import os
 import motor.motor_asyncio
+import redis.asyncio as redis
 from dotenv import load_dotenv
 import logging
+from typing import Any, Awaitable, Callable, Optional
+from pymongo.errors import ConfigurationError, OperationFailure
 # Import trực tiếp các kiểu dữ liệu
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorCollection
 
@@ -35,6 +38,23 @@ except Exception as e:
     client = None
     database = None
 
+# Redis là tùy chọn: chỉ bật khi có REDIS_HOST (khóa/đánh dấu IPN dùng chung giữa các replica)
+REDIS_HOST = os.getenv("REDIS_HOST")
+REDIS_KEY = os.getenv("REDIS_KEY", None)
+REDIS_PORT = os.getenv("REDIS_PORT", "6380")
+
+redis_client = None
+if REDIS_HOST:
+    try:
+        if REDIS_KEY:
+            redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_KEY, ssl=True, decode_responses=True)
+        else:
+            redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+        logger.info(f"PaymentService: Đã khởi tạo Redis client tại {REDIS_HOST}:{REDIS_PORT}")
+    except Exception as e:
+        logger.error(f"PaymentService: Lỗi khi khởi tạo Redis: {e}")
+        redis_client = None
+
 # --- CÁC HÀM LẤY COLLECTION ---
 # Các hàm này giờ chỉ cần kiểm tra xem database có None không
 
@@ -50,20 +70,170 @@ async def get_transactions_collection() -> AsyncIOMotorCollection:
         raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
     return database.get_collection("transactions")
 
+async def get_payment_jobs_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'payment_jobs' (hàng đợi xử lý thanh toán hoàn thành chuyến)."""
+    if database is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return database.get_collection("payment_jobs")
+
+async def get_ledger_entries_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'ledger_entries' (sổ cái kép, chỉ ghi thêm)."""
+    if database is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return database.get_collection("ledger_entries")
+
+async def get_ledger_snapshots_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'ledger_snapshots' (số dư ví chụp định kỳ theo seq)."""
+    if database is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return database.get_collection("ledger_snapshots")
+
+async def get_settlements_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'settlements' (bản quyết toán theo ngày và tài xế)."""
+    if database is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return database.get_collection("settlements")
+
+async def get_settlement_runs_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'settlement_runs' (checkpoint của mỗi lần quyết toán)."""
+    if database is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return database.get_collection("settlement_runs")
+
+async def get_ipn_receipts_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'ipn_receipts' (khóa + kết quả IPN VNPay khi không có Redis)."""
+    if database is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return database.get_collection("ipn_receipts")
+
+async def get_trip_notifications_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'trip_notifications' (outbox trạng thái thanh toán gửi TripService)."""
+    if database is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return database.get_collection("trip_notifications")
+
+async def get_reconciliation_issues_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'reconciliation_issues' (sai lệch tìm thấy khi đối soát giao dịch với TripService)."""
+    if database is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return database.get_collection("reconciliation_issues")
+
+# --- TRANSACTION (có fallback cho MongoDB standalone / CosmosDB) ---
+# IllegalOperation (20): standalone không hỗ trợ transaction; CommandNotSupported (115): CosmosDB
+_TRANSACTION_UNSUPPORTED_CODES = {20, 115}
+_transactions_supported: Optional[bool] = None
+TRANSACTION_MAX_ATTEMPTS = 3
+
+def _is_transaction_unsupported(error: Exception) -> bool:
+    if isinstance(error, ConfigurationError):
+        return True
+    return isinstance(error, OperationFailure) and (
+        error.code in _TRANSACTION_UNSUPPORTED_CODES or "Transaction numbers" in str(error)
+    )
+
+async def run_in_transaction(callback: Callable[[Optional[Any]], Awaitable[Any]]) -> Any:
+    """
+    Chạy callback(session) trong một Mongo transaction.
+    Nếu deployment không hỗ trợ transaction, chạy callback(None) (từng lệnh riêng lẻ)
+    và nhớ lại để các lần sau không thử nữa.
+    """
+    global _transactions_supported
+    if client is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    attempt = 0
+    while _transactions_supported is not False:
+        attempt += 1
+        try:
+            async with await client.start_session() as session:
+                async with session.start_transaction():
+                    result = await callback(session)
+            _transactions_supported = True
+            return result
+        except (ConfigurationError, OperationFailure) as e:
+            # Write conflict giữa hai transaction cùng sửa một ví: chạy lại toàn bộ
+            if isinstance(e, OperationFailure) and e.has_error_label("TransientTransactionError") and attempt < TRANSACTION_MAX_ATTEMPTS:
+                continue
+            if _transactions_supported or not _is_transaction_unsupported(e):
+                raise
+            logger.warning(f"PaymentService: MongoDB không hỗ trợ transaction ({e}), chuyển sang ghi tuần tự.")
+            _transactions_supported = False
+    return await callback(None)
+
 # --- HÀM TẠO INDEX (Vẫn cần gọi khi startup) ---
+def _same_keys(index_key, keys) -> bool:
+    keys = [(keys, 1)] if isinstance(keys, str) else list(keys)
+    return [(field, int(direction)) for field, direction in index_key] == keys
+
+async def _ensure_unique_index(collection: AsyncIOMotorCollection, keys, **kwargs):
+    """
+    Index unique mà tính đúng đắn phụ thuộc vào (chống cộng tiền hai lần, trùng job, trùng seq sổ cái).
+    Không tạo được (vd. CosmosDB chỉ cho tạo unique index khi collection rỗng) thì chấp nhận index unique
+    cùng key đã có sẵn; không có thì ném lỗi để service không khởi động mà thiếu chốt chặn.
+    """
+    try:
+        await collection.create_index(keys, unique=True, background=True, **kwargs)
+        return
+    except Exception as e:
+        try:
+            existing = await collection.index_information()
+        except Exception:
+            existing = {}
+        if any(info.get("unique") and _same_keys(info["key"], keys) for info in existing.values()):
+            logger.warning(f"PaymentService: Không tạo lại được index unique {keys} trên {collection.name}, dùng index sẵn có: {e}")
+            return
+        logger.critical(f"PaymentService: Thiếu index unique {keys} trên {collection.name}: {e}")
+        raise
+
+async def _ensure_index(collection: AsyncIOMotorCollection, keys, **kwargs):
+    """Index chỉ phục vụ hiệu năng: lỗi thì ghi log, không chặn các index còn lại."""
+    try:
+        await collection.create_index(keys, background=True, **kwargs)
+    except Exception as e:
+        logger.error(f"PaymentService: Lỗi tạo index {keys} trên {collection.name}: {e}")
+
 async def create_payment_indexes():
-    """Tạo các index cần thiết (nên gọi khi ứng dụng khởi động)."""
+    """
+    Tạo các index cần thiết (gọi khi ứng dụng khởi động).
+    Thiếu index unique thì ném lỗi: startup thất bại thay vì chạy worker mà không có chốt chống trùng.
+    """
     if database is None:
         logger.warning("PaymentService: Không thể tạo index vì kết nối DB thất bại.")
         return
-    try:
-        wallets_coll = await get_wallets_collection() # Gọi hàm get để chắc chắn db không None
-        await wallets_coll.create_index("driver_id", unique=True, background=True)
-        
-        transactions_coll = await get_transactions_collection()
-        await transactions_coll.create_index("trip_id", background=True)
-        # Thêm index khác nếu cần (ví dụ: status, created_at cho transaction)
-        
-        logger.info("PaymentService: Đã tạo/đảm bảo index.")
-    except Exception as e:
-        logger.error(f"PaymentService: Lỗi tạo index: {e}")
\ No newline at end of file
+    wallets_coll = await get_wallets_collection() # Gọi hàm get để chắc chắn db không None
+    transactions_coll = await get_transactions_collection()
+    ledger_coll = await get_ledger_entries_collection()
+    jobs_coll = await get_payment_jobs_collection()
+
+    # Chốt chặn idempotency: một ví mỗi tài xế, một giao dịch mỗi transaction_id (EARNING_/PAYOUT_...),
+    # một job mỗi chuyến, seq liên tục theo ví (tài khoản đối ứng không có seq)
+    await _ensure_unique_index(wallets_coll, "driver_id")
+    await _ensure_unique_index(
+        transactions_coll, "transaction_id", partialFilterExpression={"transaction_id": {"$type": "string"}}
+    )
+    await _ensure_unique_index(jobs_coll, "trip_id")
+    await _ensure_unique_index(
+        ledger_coll, [("account", 1), ("seq", 1)], partialFilterExpression={"seq": {"$exists": True}}
+    )
+
+    await _ensure_index(transactions_coll, "trip_id")
+    # Lịch sử giao dịch theo người dùng/tài xế (phân trang theo created_at, _id)
+    await _ensure_index(transactions_coll, [("user_id", 1), ("created_at", -1), ("_id", -1)])
+    await _ensure_index(transactions_coll, [("status", 1), ("created_at", -1)])
+    # Đối soát (reconcile_payments.py): chỉ quét giao dịch chưa có reconciled_at
+    await _ensure_index(transactions_coll, [("status", 1), ("reconciled_at", 1), ("created_at", 1)])
+    # Quyết toán: EARNING thành công theo ngày, gom theo tài xế
+    await _ensure_index(transactions_coll, [("transaction_type", 1), ("status", 1), ("created_at", 1), ("user_id", 1)])
+
+    await _ensure_index(ledger_coll, "posting_id")
+    await _ensure_index(await get_ledger_snapshots_collection(), [("account", 1), ("seq", -1)])
+
+    settlements_coll = await get_settlements_collection()
+    await _ensure_index(settlements_coll, [("settlement_date", 1), ("status", 1)])
+    await _ensure_index(settlements_coll, [("driver_id", 1), ("settlement_date", -1)])
+
+    await _ensure_index(await get_ipn_receipts_collection(), "expires_at", expireAfterSeconds=0)
+    await _ensure_index(jobs_coll, [("status", 1), ("available_at", 1)])
+    await _ensure_index(await get_trip_notifications_collection(), [("status", 1), ("available_at", 1)])
+    await _ensure_index(await get_reconciliation_issues_collection(), [("resolved", 1), ("kind", 1), ("detected_at", -1)])
+
+    logger.info("PaymentService: Đã tạo/đảm bảo index.")
\ No newline at end of file
@@ -0,0 +1,152 @@
+# PaymentService/ipn_dedup.py
+"""
+Chống xử lý trùng IPN VNPay theo vnp_TxnRef.
+
+VNPay gửi lại IPN khi chưa nhận được phản hồi kịp thời, nên cùng một đơn có thể tới nhiều lần,
+kể cả song song trên các replica khác nhau. Mỗi TxnRef chỉ được xử lý một lượt:
+- IPN trùng trên CÙNG replica chờ chung một Future với lượt đang chạy.
+- Replica khác: khóa ngắn hạn (IPN_LOCK_SECONDS) bảo đảm chỉ một nơi xử lý; nơi còn lại poll
+  đánh dấu "đã xử lý" tới IPN_WAIT_SECONDS, quá hạn thì trả lỗi để VNPay gửi lại sau.
+- Sau khi xử lý thành công, phản hồi được lưu IPN_MARKER_TTL_SECONDS; các lần gửi lại trả
+  ngay từ đánh dấu, không kiểm tra chữ ký, không đọc DB, không gọi TripService.
+Chỉ phản hồi "00" được lưu; lượt xử lý lỗi sẽ nhả khóa để lần gửi lại chạy lại từ đầu.
+
+Store dùng Redis nếu có REDIS_HOST, ngược lại dùng collection 'ipn_receipts' (TTL index).
+"""
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from database import redis_client, get_ipn_receipts_collection
+
+logger = logging.getLogger(__name__)
+
+IPN_LOCK_SECONDS = int(os.getenv("IPN_LOCK_SECONDS", "30"))
+IPN_MARKER_TTL_SECONDS = int(os.getenv("IPN_MARKER_TTL_SECONDS", str(7 * 24 * 3600)))
+IPN_WAIT_SECONDS = float(os.getenv("IPN_WAIT_SECONDS", "5"))
+IPN_POLL_INTERVAL_SECONDS = 0.2
+
+RETRY_LATER_RESPONSE = {"RspCode": "99", "Message": "Processing, retry later"}
+
+
+class RedisIpnStore:
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def get_processed(self, txn_ref: str) -> Optional[Dict[str, str]]:
+        raw = await self.redis.get(f"ipn:done:{txn_ref}")
+        return json.loads(raw) if raw else None
+
+    async def lock(self, txn_ref: str) -> bool:
+        return bool(await self.redis.set(f"ipn:lock:{txn_ref}", "1", nx=True, ex=IPN_LOCK_SECONDS))
+
+    async def mark_processed(self, txn_ref: str, response: Dict[str, str]):
+        await self.redis.set(f"ipn:done:{txn_ref}", json.dumps(response), ex=IPN_MARKER_TTL_SECONDS)
+        await self.redis.delete(f"ipn:lock:{txn_ref}")
+
+    async def unlock(self, txn_ref: str):
+        await self.redis.delete(f"ipn:lock:{txn_ref}")
+
+
+class MongoIpnStore:
+    """Một document/TxnRef: state LOCKED (hết hạn theo locked_until) hoặc DONE kèm response."""
+
+    async def get_processed(self, txn_ref: str) -> Optional[Dict[str, str]]:
+        receipts = await get_ipn_receipts_collection()
+        record = await receipts.find_one({"_id": txn_ref, "state": "DONE"}, {"response": 1})
+        return record["response"] if record else None
+
+    async def lock(self, txn_ref: str) -> bool:
+        receipts = await get_ipn_receipts_collection()
+        now = datetime.now(timezone.utc)
+        try:
+            # Chiếm document mới, hoặc document LOCKED đã hết hạn khóa (replica trước chết giữa chừng)
+            await receipts.update_one(
+                {"_id": txn_ref, "state": "LOCKED", "locked_until": {"$lt": now}},
+                {"$set": {
+                    "locked_until": now + timedelta(seconds=IPN_LOCK_SECONDS),
+                    "expires_at": now + timedelta(seconds=IPN_MARKER_TTL_SECONDS)
+                }},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def mark_processed(self, txn_ref: str, response: Dict[str, str]):
+        receipts = await get_ipn_receipts_collection()
+        await receipts.update_one(
+            {"_id": txn_ref},
+            {"$set": {
+                "state": "DONE",
+                "response": response,
+                "expires_at": datetime.now(timezone.utc) + timedelta(seconds=IPN_MARKER_TTL_SECONDS)
+            }, "$unset": {"locked_until": ""}}
+        )
+
+    async def unlock(self, txn_ref: str):
+        receipts = await get_ipn_receipts_collection()
+        await receipts.delete_one({"_id": txn_ref, "state": "LOCKED"})
+
+
+class IpnDeduplicator:
+    def __init__(self, store):
+        self.store = store
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def run(self, txn_ref: Optional[str], handler: Callable[[], Awaitable[Dict[str, str]]]) -> Dict[str, str]:
+        """Chạy handler tối đa một lượt thành công cho mỗi TxnRef; trả về phản hồi cho VNPay."""
+        if not txn_ref:
+            return await handler()
+
+        processed = await self.store.get_processed(txn_ref)
+        if processed is not None:
+            logger.info(f"IPN {txn_ref}: Đã xử lý trước đó, trả lại phản hồi đã lưu.")
+            return processed
+
+        local = self._inflight.get(txn_ref)
+        if local is not None:
+            return await asyncio.shield(local)
+
+        if not await self.store.lock(txn_ref):
+            return await self._wait_for_processed(txn_ref)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[txn_ref] = future
+        try:
+            response = await handler()
+        except BaseException as e:
+            await asyncio.shield(self.store.unlock(txn_ref))
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # đánh dấu đã lấy exception (tránh warning khi không ai chờ)
+            raise
+        else:
+            if response.get("RspCode") == "00":
+                await self.store.mark_processed(txn_ref, response)
+            else:
+                await self.store.unlock(txn_ref)
+            future.set_result(response)
+            return response
+        finally:
+            self._inflight.pop(txn_ref, None)
+
+    async def _wait_for_processed(self, txn_ref: str) -> Dict[str, str]:
+        deadline = asyncio.get_running_loop().time() + IPN_WAIT_SECONDS
+        while asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(IPN_POLL_INTERVAL_SECONDS)
+            processed = await self.store.get_processed(txn_ref)
+            if processed is not None:
+                return processed
+        logger.warning(f"IPN {txn_ref}: Replica khác vẫn đang xử lý, yêu cầu VNPay gửi lại sau.")
+        return RETRY_LATER_RESPONSE
+
+
+ipn_deduplicator = IpnDeduplicator(RedisIpnStore(redis_client) if redis_client is not None else MongoIpnStore())
@@ -0,0 +1,165 @@
+# PaymentService/ledger.py
+"""
+Sổ cái kép (double-entry), chỉ ghi thêm, cho ví tài xế.
+
+Mỗi thay đổi số dư là một "posting" gồm các bút toán có tổng bằng 0 trong 'ledger_entries':
+tài khoản ví 'wallet:<driver_id>' (+/-) và một tài khoản đối ứng (doanh thu chuyến đi,
+tiền nạp, chi trả ngân hàng...). Bút toán của ví mang số thứ tự 'seq' liên tục theo ví
+(lấy từ 'ledger_seq' được $inc cùng lệnh cập nhật balance), kèm balance_after.
+
+Cứ LEDGER_SNAPSHOT_INTERVAL bút toán, ví được chụp số dư vào 'ledger_snapshots', nên
+balance_at() và reconcile_wallet() chỉ cộng các bút toán sau snapshot gần nhất.
+"""
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from pymongo import DESCENDING
+
+import models
+from database import get_ledger_entries_collection, get_ledger_snapshots_collection, get_wallets_collection
+
+logger = logging.getLogger(__name__)
+
+LEDGER_SNAPSHOT_INTERVAL = int(os.getenv("LEDGER_SNAPSHOT_INTERVAL", "100"))
+
+# Tài khoản đối ứng cho từng loại giao dịch làm thay đổi ví
+COUNTER_ACCOUNTS = {
+    models.TransactionType.EARNING: "platform:trip_earnings",
+    models.TransactionType.TOPUP: "external:topup",
+    models.TransactionType.PAYOUT: "external:bank_payout",
+}
+
+
+def wallet_account(driver_id: str) -> str:
+    return f"wallet:{driver_id}"
+
+
+def build_posting(
+    posting_id: str,
+    driver_id: str,
+    amount: float,
+    transaction_type: models.TransactionType,
+    seq: int,
+    balance_after: float,
+    trip_id: Optional[str] = None,
+    created_at: Optional[datetime] = None
+) -> List[Dict[str, Any]]:
+    """Hai bút toán (ví và tài khoản đối ứng) có tổng bằng 0 cho một thay đổi số dư ví."""
+    created_at = created_at or datetime.now(timezone.utc)
+    common = {
+        "posting_id": posting_id,
+        "transaction_type": transaction_type.value,
+        "trip_id": trip_id,
+        "created_at": created_at,
+    }
+    return [
+        {
+            "_id": uuid.uuid4().hex,
+            "account": wallet_account(driver_id),
+            "amount": amount,
+            "seq": seq,
+            "balance_after": balance_after,
+            **common
+        },
+        {
+            "_id": uuid.uuid4().hex,
+            "account": COUNTER_ACCOUNTS[transaction_type],
+            "amount": -amount,
+            **common
+        },
+    ]
+
+
+def snapshot_due(seq: int, interval: int = LEDGER_SNAPSHOT_INTERVAL) -> bool:
+    return interval > 0 and seq % interval == 0
+
+
+def _snapshot(account: str, seq: int, balance: float, taken_at: datetime) -> Dict[str, Any]:
+    return {"_id": f"{account}:{seq}", "account": account, "seq": seq, "balance": balance, "taken_at": taken_at}
+
+
+async def append_postings(postings: Iterable[List[Dict[str, Any]]], session=None) -> int:
+    """
+    Ghi một hoặc nhiều posting bằng một insert_many, kèm snapshot cho các ví đến hạn.
+    Trả về số bút toán đã ghi.
+    """
+    entries = [entry for posting in postings for entry in posting]
+    if not entries:
+        return 0
+    entries_coll = await get_ledger_entries_collection()
+    await entries_coll.insert_many(entries, ordered=True, session=session)
+
+    snapshots = []
+    for entry in entries:
+        if "seq" not in entry:
+            continue
+        opening_balance = entry["balance_after"] - entry["amount"]
+        if entry["seq"] == 1 and abs(opening_balance) >= 0.01:
+            # Ví có số dư từ trước khi có sổ cái: ghi snapshot mở đầu (seq 0)
+            snapshots.append(_snapshot(entry["account"], 0, opening_balance, entry["created_at"]))
+        if snapshot_due(entry["seq"]):
+            snapshots.append(_snapshot(entry["account"], entry["seq"], entry["balance_after"], entry["created_at"]))
+    if snapshots:
+        snapshots_coll = await get_ledger_snapshots_collection()
+        await snapshots_coll.insert_many(snapshots, ordered=False, session=session)
+    return len(entries)
+
+
+async def _latest_snapshot(account: str, at: Optional[datetime] = None) -> Dict[str, Any]:
+    snapshots_coll = await get_ledger_snapshots_collection()
+    query: Dict[str, Any] = {"account": account}
+    if at is not None:
+        query["taken_at"] = {"$lte": at}
+    snapshot = await snapshots_coll.find_one(query, sort=[("seq", DESCENDING)])
+    return snapshot or {"seq": 0, "balance": 0.0}
+
+
+async def _sum_since(account: str, after_seq: int, at: Optional[datetime] = None) -> Dict[str, Any]:
+    entries_coll = await get_ledger_entries_collection()
+    match: Dict[str, Any] = {"account": account, "seq": {"$gt": after_seq}}
+    if at is not None:
+        match["created_at"] = {"$lte": at}
+    rows = await entries_coll.aggregate([
+        {"$match": match},
+        {"$group": {"_id": None, "total": {"$sum": "$amount"}, "count": {"$sum": 1}}}
+    ]).to_list(length=1)
+    return rows[0] if rows else {"total": 0.0, "count": 0}
+
+
+async def balance_at(driver_id: str, at: datetime) -> float:
+    """Số dư ví tại thời điểm 'at': snapshot gần nhất trước 'at' + các bút toán sau nó."""
+    account = wallet_account(driver_id)
+    snapshot = await _latest_snapshot(account, at)
+    since = await _sum_since(account, snapshot["seq"], at)
+    return snapshot["balance"] + since["total"]
+
+
+async def reconcile_wallet(driver_id: str) -> Dict[str, Any]:
+    """So số dư ví với sổ cái (chỉ quét bút toán sau snapshot gần nhất) và kiểm tra seq liên tục."""
+    account = wallet_account(driver_id)
+    wallets_coll = await get_wallets_collection()
+    wallet = await wallets_coll.find_one({"driver_id": driver_id}, {"balance": 1, "ledger_seq": 1}) or {}
+    snapshot = await _latest_snapshot(account)
+    since = await _sum_since(account, snapshot["seq"])
+
+    ledger_balance = snapshot["balance"] + since["total"]
+    wallet_balance = wallet.get("balance", 0.0)
+    wallet_seq = wallet.get("ledger_seq", 0)
+    if wallet_seq == 0:
+        # Ví chưa có thay đổi nào từ khi có sổ cái: số dư hiện tại chính là số dư mở đầu
+        ledger_balance = wallet_balance
+    missing_entries = (wallet_seq - snapshot["seq"]) - since["count"]
+    return {
+        "driver_id": driver_id,
+        "wallet_balance": wallet_balance,
+        "ledger_balance": ledger_balance,
+        "difference": round(wallet_balance - ledger_balance, 2),
+        "ledger_seq": wallet_seq,
+        "snapshot_seq": snapshot["seq"],
+        "entries_scanned": since["count"],
+        "missing_entries": missing_entries,
+        "balanced": abs(wallet_balance - ledger_balance) < 0.01 and missing_entries == 0,
+    }
@@ -1,11 +1,14 @@
 # PaymentService/main.py (Đã sửa đổi)
 
 import os
+import asyncio
 import hashlib
 import hmac
 import logging
-from fastapi import FastAPI, HTTPException, status, Request, Depends # <-- Thêm Request, Depends
-from typing import List, AsyncGenerator, Dict, Any # <-- Thêm AsyncGenerator, Dict, Any
+from datetime import datetime
+from fastapi import FastAPI, HTTPException, status, Request, Depends, Query # <-- Thêm Request, Depends
+from fastapi.responses import ORJSONResponse
+from typing import List, AsyncGenerator, Dict, Any, Optional # <-- Thêm AsyncGenerator, Dict, Any
 from urllib.parse import parse_qsl, quote_plus
 from contextlib import asynccontextmanager # <-- Thêm asynccontextmanager
 
@@ -13,6 +16,11 @@ from contextlib import asynccontextmanager # <-- Thêm asynccontextmanager
 import crud
 import schemas
 import models
+import payment_jobs
+import trip_notifier
+import ledger
+import settlement
+from ipn_dedup import ipn_deduplicator
 # --- Sửa cách import database và thêm hàm tạo index ---
 from database import create_payment_indexes, get_wallets_collection, get_transactions_collection
 
@@ -24,11 +32,19 @@ logger = logging.getLogger(__name__)
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     logger.info("PaymentService: Đang khởi động...")
-    # Gọi hàm tạo index khi startup
+    # Gọi hàm tạo index khi startup; thiếu index unique thì ném lỗi, worker không được khởi động
     await create_payment_indexes()
+    # Worker xử lý hàng đợi thanh toán hoàn thành chuyến (payment_jobs)
+    worker_tasks = payment_jobs.start_workers()
+    # Gửi trạng thái thanh toán cho TripService từ outbox (trip_notifications)
+    worker_tasks.append(asyncio.create_task(trip_notifier.run_flusher()))
     logger.info("PaymentService: Khởi động hoàn tất.")
     yield # Ứng dụng chạy ở đây
     logger.info("PaymentService: Đang tắt...")
+    for task in worker_tasks:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+    await trip_notifier.close_http_client()
     # (Không cần đóng kết nối MongoDB rõ ràng với motor)
     logger.info("PaymentService: Tắt hoàn tất.")
 
@@ -37,11 +53,11 @@ app = FastAPI(
     title="UIT-Go Payment Service",
     description="Microservice để xử lý thanh toán.",
     version="1.1.0",
-    lifespan=lifespan # <-- Thêm lifespan
+    lifespan=lifespan, # <-- Thêm lifespan
+    default_response_class=ORJSONResponse
 )
 
 # --- Các biến và hằng số (Giữ nguyên) ---
-APP_COMMISSION_RATE = 0.20
 # DRIVER_SERVICE_URL = os.getenv("DRIVER_SERVICE_URL") # Chỉ cần trong crud.py
 
 # === ENDPOINTS CHO VÍ (WALLET) ===
@@ -64,6 +80,35 @@ async def top_up_driver_wallet_endpoint(request: schemas.TopUpRequest):
         raise HTTPException(status_code=500, detail="Lỗi khi nạp tiền vào ví.")
     return updated_wallet
 
+@app.get("/v1/wallets/{driver_id}/balance-at", tags=["Wallet"])
+async def get_wallet_balance_at(driver_id: str, at: datetime):
+    """Số dư ví tại một thời điểm, tính từ sổ cái (snapshot gần nhất + bút toán sau đó)."""
+    balance = await ledger.balance_at(driver_id, at)
+    return {"driver_id": driver_id, "at": at, "balance": balance}
+
+@app.get("/v1/wallets/{driver_id}/reconcile", tags=["Wallet"])
+async def reconcile_driver_wallet(driver_id: str):
+    """Đối soát số dư ví với sổ cái."""
+    return await ledger.reconcile_wallet(driver_id)
+
+@app.get("/v1/wallets/{driver_id}/settlements", response_model=List[schemas.SettlementItem], tags=["Wallet"])
+async def get_driver_settlements(driver_id: str, limit: int = Query(30, ge=1, le=100)):
+    """Các bản quyết toán gần nhất của tài xế (do settlement.py tạo)."""
+    return await settlement.get_driver_settlements(driver_id, limit)
+
+@app.get("/v1/wallets/{driver_id}/transactions", response_model=schemas.TransactionPage, tags=["Wallet"])
+async def get_wallet_transactions(
+    driver_id: str,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="next_cursor của trang trước"),
+    transaction_type: Optional[models.TransactionType] = None
+):
+    """Lịch sử giao dịch của tài xế, mới nhất trước, phân trang theo cursor."""
+    try:
+        return await crud.get_wallet_transactions(driver_id, limit, cursor, transaction_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # === ENDPOINTS CHO THANH TOÁN (PAYMENT) ===
 
 @app.post("/v1/payment/process", response_model=schemas.PaymentLinkResponse, tags=["Payment"])
@@ -97,20 +142,22 @@ async def handle_vnpay_ipn(request: Request):
     vnp_txn_ref = ipn_data.get('vnp_TxnRef')
     logger.info(f"Nhận được IPN callback từ VNPay cho TxnRef: {vnp_txn_ref}. Data: {ipn_data}")
 
-    # Gọi hàm crud để xử lý (hàm này đã có kiểm tra hash và cập nhật DB)
-    success = await crud.handle_vnpay_return(ipn_data)
+    async def process_ipn() -> Dict[str, str]:
+        # Gọi hàm crud để xử lý (hàm này đã có kiểm tra hash và cập nhật DB)
+        success = await crud.handle_vnpay_return(ipn_data)
 
-    # Phản hồi cho VNPAY theo yêu cầu
-    if success:
-        logger.info(f"Xử lý IPN thành công cho TxnRef: {vnp_txn_ref}")
-        return {"RspCode": "00", "Message": "Confirm Success"}
-    else:
+        # Phản hồi cho VNPAY theo yêu cầu
+        if success:
+            logger.info(f"Xử lý IPN thành công cho TxnRef: {vnp_txn_ref}")
+            return {"RspCode": "00", "Message": "Confirm Success"}
         # Nếu crud.handle_vnpay_return trả về False (lỗi hash, lỗi DB, hoặc giao dịch không hợp lệ)
         # Vẫn cần trả về lỗi cho VNPAY biết để họ có thể thử gửi lại IPN
         logger.error(f"Xử lý IPN thất bại cho TxnRef: {vnp_txn_ref}")
-        # Mã lỗi '99' hoặc mã lỗi cụ thể hơn nếu có thể xác định
         # Quan trọng: KHÔNG trả về 00 nếu xử lý phía bạn lỗi, VNPAY sẽ gửi lại IPN
         return {"RspCode": "99", "Message": "Unknown error"}
+
+    # IPN trùng/song song cho cùng TxnRef chỉ chạy một lượt; lần gửi lại trả từ đánh dấu đã xử lý
+    return await ipn_deduplicator.run(vnp_txn_ref, process_ipn)
 # === [HẾT ENDPOINT IPN] ===
 
 # === [SỬA ĐỔI HOÀN TOÀN ENDPOINT NÀY] ===
@@ -163,29 +210,37 @@ async def handle_vnpay_return_message(request: Request):
 
 # === ENDPOINTS CHO TRIP COMPLETION ===
 
-@app.post("/v1/trip-completion/complete", response_model=schemas.TripCompletionResponse, tags=["Trip Completion"])
+@app.post("/v1/trip-completion/complete", response_model=schemas.PaymentJobResponse, status_code=status.HTTP_202_ACCEPTED, tags=["Trip Completion"])
 async def complete_trip_payment(request: schemas.TripCompletionRequest):
     """
-    Xử lý thanh toán khi tài xế hoàn thành chuyến đi.
-    Hỗ trợ cả chuyển khoản ngân hàng (mock) và tiền mặt.
+    Xếp hàng thanh toán khi tài xế hoàn thành chuyến đi (chuyển khoản giả lập hoặc tiền mặt).
+    Trả về job_id ngay; kết quả xem qua GET /v1/payment-jobs/{job_id},
+    TripService được báo qua PUT /trips/{trip_id}/payment khi xử lý xong.
     """
     logger.info(f"Nhận yêu cầu hoàn thành chuyến đi: {request.trip_id}, phương thức: {request.payment_method}")
-
-    result = await crud.process_trip_completion_payment(request)
-
-    if result.success:
-        logger.info(f"Xử lý thanh toán chuyến {request.trip_id} thành công")
-    else:
-        logger.error(f"Xử lý thanh toán chuyến {request.trip_id} thất bại: {result.payment_status}")
-
-    return result
+    job = await payment_jobs.enqueue_trip_completion(request)
+    logger.info(f"Chuyến {request.trip_id}: job thanh toán {job['_id']} ({job['status']})")
+    return payment_jobs.to_response(job)
+
+@app.get("/v1/payment-jobs/{job_id}", response_model=schemas.PaymentJobResponse, tags=["Trip Completion"])
+async def get_payment_job(job_id: str):
+    """Trạng thái và kết quả của job thanh toán hoàn thành chuyến."""
+    job = await payment_jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job thanh toán.")
+    return payment_jobs.to_response(job)
 
 @app.post("/v1/trip-completion/calculate-fare", response_model=schemas.TripFareCalculation, tags=["Trip Completion"])
-async def calculate_trip_fare(distance_km: float, base_rate_per_km: float = 5000.0, commission_rate: float = 0.20):
+async def calculate_trip_fare(
+    distance_km: float,
+    vehicle_type: Optional[str] = None,
+    requested_at: Optional[datetime] = None,
+    surge_multiplier: float = Query(1.0, gt=0)
+):
     """
-    Tính toán cước phí chuyến đi dựa trên khoảng cách.
+    Tính toán cước phí chuyến đi theo bảng giá dùng chung (loại xe, khung giờ, surge).
     """
-    fare_details = crud.calculate_trip_fare(distance_km, base_rate_per_km, commission_rate)
+    fare_details = crud.calculate_trip_fare(distance_km, vehicle_type, requested_at, surge_multiplier)
     return fare_details
 
 # === END ROOT ENDPOINTS ===
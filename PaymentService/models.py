@@ -1,6 +1,6 @@
 import uuid
 from datetime import datetime, timezone
-from typing import Optional
+from typing import Any, Dict, Optional
 from enum import Enum
 from pydantic import BaseModel, Field
 
@@ -8,12 +8,19 @@ class TransactionType(str, Enum):
     PAYMENT = "PAYMENT"
     TOPUP = "TOPUP"
     EARNING ="EARNING"
+    PAYOUT = "PAYOUT"
 
 class TransactionStatus(str, Enum):
     PENDING = "PENDING"
     SUCCESS = "SUCCESS"
     FAILED = "FAILED"
 
+class PaymentJobStatus(str, Enum):
+    QUEUED = "QUEUED"
+    PROCESSING = "PROCESSING"
+    SUCCEEDED = "SUCCEEDED"
+    FAILED = "FAILED"
+
 class Wallet(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), alias="_id")
     user_id: str = Field(..., unique=True)
@@ -36,13 +43,39 @@ class DriverWallet(BaseModel):
 
 class Transaction(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), alias="_id")
-    wallet_id: str = Field(...)
+    transaction_id: str = Field(default_factory=lambda: f"TXN_{uuid.uuid4().hex[:16].upper()}")
+    user_id: Optional[str] = None  # Hành khách (PAYMENT) hoặc tài xế (TOPUP/EARNING)
+    wallet_id: Optional[str] = None  # Ví bị thay đổi (chỉ có với TOPUP/EARNING)
     transaction_type: TransactionType = Field(...)
     amount: float = Field(...)
+    balance_after: Optional[float] = None  # Số dư ví ngay sau giao dịch
     trip_id: Optional[str] = None
+    driver_id: Optional[str] = None  # Tài xế nhận thu nhập (lưu sẵn trên giao dịch PAYMENT PENDING)
+    payment_method: Optional[str] = None
     status: TransactionStatus = Field(...)
+    description: Optional[str] = None
+    vnpay_txnref: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     error_message: Optional[str] = None
 
     class Config:
-        populate_by_name = True
\ No newline at end of file
+        populate_by_name = True
+
+class PaymentJob(BaseModel):
+    """Job thanh toán hoàn thành chuyến trong collection 'payment_jobs' (mỗi chuyến một job)."""
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex, alias="_id")
+    trip_id: str = Field(...)
+    payload: Dict[str, Any] = Field(...)  # TripCompletionRequest
+    fare_details: Optional[Dict[str, Any]] = None  # TripFareCalculation chốt lúc xếp hàng (kèm pricing_version)
+    status: PaymentJobStatus = PaymentJobStatus.QUEUED
+    attempts: int = 0
+    available_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    locked_until: Optional[datetime] = None
+    result: Optional[Dict[str, Any]] = None  # TripCompletionResponse
+    error: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+    class Config:
+        populate_by_name = True
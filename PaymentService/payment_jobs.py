@@ -0,0 +1,212 @@
+# PaymentService/payment_jobs.py
+"""
+Hàng đợi bền (MongoDB, collection 'payment_jobs') cho thanh toán hoàn thành chuyến đi.
+
+/v1/trip-completion/complete chỉ ghi job rồi trả job_id ngay; các worker nền lấy job bằng
+find_one_and_update (nguyên tử, nên chạy nhiều worker / nhiều replica đều an toàn), gọi
+crud.process_trip_completion_payment (chuyển khoản giả lập, cộng ví, thông báo TripService qua
+PUT /trips/{trip_id}/payment) và lưu kết quả để tra cứu qua GET /v1/payment-jobs/{job_id}.
+Job được giao ít nhất một lần (nhận lại khi hết hạn khóa), nên process_trip_completion_payment phải
+idempotent; mọi lỗi hệ thống của nó (kể cả cộng ví thất bại) được thử lại với backoff.
+
+Cước (fare_details, kèm pricing_version) được chốt theo bảng giá lúc xếp hàng và lưu trên job:
+GET trả về đúng báo giá đó và worker thu đúng số tiền đó, kể cả khi bảng giá đổi trong lúc chờ.
+
+Mỗi chuyến đi chỉ có một job (unique index trip_id): gửi lại yêu cầu hoàn thành trả về job cũ,
+trừ khi job cũ đã FAILED thì được xếp hàng lại. Job bị kẹt (worker chết giữa chừng) được worker
+khác nhận lại sau PAYMENT_JOB_VISIBILITY_SECONDS.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import crud
+import models
+import schemas
+from database import get_payment_jobs_collection
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_WORKERS = int(os.getenv("PAYMENT_WORKERS", "4"))
+PAYMENT_JOB_POLL_SECONDS = float(os.getenv("PAYMENT_JOB_POLL_SECONDS", "0.5"))
+PAYMENT_JOB_VISIBILITY_SECONDS = int(os.getenv("PAYMENT_JOB_VISIBILITY_SECONDS", "60"))
+PAYMENT_JOB_MAX_ATTEMPTS = int(os.getenv("PAYMENT_JOB_MAX_ATTEMPTS", "5"))
+
+
+def _retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=min(2 ** attempts, 60))
+
+
+def job_fare(job: Dict[str, Any]) -> schemas.TripFareCalculation:
+    """Báo giá đã chốt của job (job cũ chưa lưu báo giá thì tính theo bảng giá hiện tại)."""
+    if job.get("fare_details"):
+        return schemas.TripFareCalculation(**job["fare_details"])
+    return crud.calculate_request_fare(schemas.TripCompletionRequest(**job["payload"]))
+
+
+def to_response(job: Dict[str, Any]) -> schemas.PaymentJobResponse:
+    return schemas.PaymentJobResponse(
+        job_id=job["_id"],
+        trip_id=job["trip_id"],
+        status=job["status"],
+        attempts=job.get("attempts", 0),
+        fare_details=job_fare(job),
+        result=job.get("result"),
+        error=job.get("error"),
+        created_at=job["created_at"],
+        updated_at=job["updated_at"]
+    )
+
+
+async def enqueue_trip_completion(request: schemas.TripCompletionRequest) -> Dict[str, Any]:
+    """Ghi job cho chuyến đi (idempotent theo trip_id) và trả về document job."""
+    jobs_coll = await get_payment_jobs_collection()
+    job = models.PaymentJob(
+        trip_id=request.trip_id,
+        payload=request.model_dump(mode="json"),
+        fare_details=crud.calculate_request_fare(request).model_dump(mode="json")
+    )
+    try:
+        existing = await jobs_coll.find_one_and_update(
+            {"trip_id": request.trip_id},
+            {"$setOnInsert": job.model_dump(by_alias=True)},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        existing = await jobs_coll.find_one({"trip_id": request.trip_id})
+
+    if existing["status"] == models.PaymentJobStatus.FAILED.value:
+        now = datetime.now(timezone.utc)
+        # Cùng yêu cầu thì giữ báo giá cũ (có thể đã thu tiền theo báo giá đó); yêu cầu khác thì báo giá mới
+        fare_details = existing.get("fare_details") if existing["payload"] == job.payload else None
+        requeued = await jobs_coll.find_one_and_update(
+            {"_id": existing["_id"], "status": models.PaymentJobStatus.FAILED.value},
+            {
+                "$set": {
+                    "status": models.PaymentJobStatus.QUEUED.value,
+                    "payload": job.payload,
+                    "fare_details": fare_details or job.fare_details,
+                    "attempts": 0,
+                    "available_at": now,
+                    "result": None,
+                    "error": None,
+                    "updated_at": now
+                }
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        existing = requeued or existing
+        logger.info(f"PaymentJobs: Xếp hàng lại job {existing['_id']} cho chuyến {request.trip_id}.")
+    return existing
+
+
+async def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    jobs_coll = await get_payment_jobs_collection()
+    return await jobs_coll.find_one({"_id": job_id})
+
+
+async def claim_next_job(worker_id: str) -> Optional[Dict[str, Any]]:
+    """Nhận một job đến hạn (hoặc job PROCESSING đã hết hạn khóa) cho worker_id."""
+    jobs_coll = await get_payment_jobs_collection()
+    now = datetime.now(timezone.utc)
+    return await jobs_coll.find_one_and_update(
+        {
+            "$or": [
+                {"status": models.PaymentJobStatus.QUEUED.value, "available_at": {"$lte": now}},
+                {"status": models.PaymentJobStatus.PROCESSING.value, "locked_until": {"$lt": now}}
+            ]
+        },
+        {
+            "$set": {
+                "status": models.PaymentJobStatus.PROCESSING.value,
+                "worker_id": worker_id,
+                "locked_until": now + timedelta(seconds=PAYMENT_JOB_VISIBILITY_SECONDS),
+                "updated_at": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("available_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def _finish(job: Dict[str, Any], worker_id: str, update: Dict[str, Any]):
+    jobs_coll = await get_payment_jobs_collection()
+    update["updated_at"] = datetime.now(timezone.utc)
+    update["locked_until"] = None
+    # Chỉ ghi nếu job vẫn do worker này giữ (không bị worker khác nhận lại vì hết hạn khóa)
+    await jobs_coll.update_one(
+        {"_id": job["_id"], "worker_id": worker_id, "status": models.PaymentJobStatus.PROCESSING.value},
+        {"$set": update}
+    )
+
+
+async def _notify_final_failure(job: Dict[str, Any]):
+    """Báo TripService khi job bỏ cuộc: SUCCESS nếu khách đã thanh toán (chỉ còn cộng ví lỗi), ngược lại FAILED."""
+    try:
+        payment = await crud.find_trip_completion_payment(job["trip_id"], job["payload"]["payment_method"])
+    except Exception as e:
+        logger.error(f"PaymentJobs: Không tra được giao dịch của chuyến {job['trip_id']}: {e}")
+        payment = None
+    await crud.notify_trip_service_payment_status(
+        trip_id=job["trip_id"],
+        transaction_id=payment["transaction_id"] if payment else "",
+        status=models.TransactionStatus.SUCCESS if payment else models.TransactionStatus.FAILED
+    )
+
+
+async def process_job(job: Dict[str, Any], worker_id: str):
+    try:
+        request = schemas.TripCompletionRequest(**job["payload"])
+        result = await crud.process_trip_completion_payment(request, job_fare(job))
+    except Exception as e:
+        attempts = job.get("attempts", 1)
+        if attempts >= PAYMENT_JOB_MAX_ATTEMPTS:
+            logger.error(f"PaymentJobs: Job {job['_id']} thất bại sau {attempts} lần: {e}", exc_info=True)
+            await _finish(job, worker_id, {"status": models.PaymentJobStatus.FAILED.value, "error": str(e)})
+            await _notify_final_failure(job)
+        else:
+            logger.warning(f"PaymentJobs: Job {job['_id']} lỗi (lần {attempts}), sẽ thử lại: {e}")
+            await _finish(job, worker_id, {
+                "status": models.PaymentJobStatus.QUEUED.value,
+                "available_at": datetime.now(timezone.utc) + _retry_delay(attempts),
+                "error": str(e)
+            })
+        return
+
+    status = models.PaymentJobStatus.SUCCEEDED if result.success else models.PaymentJobStatus.FAILED
+    await _finish(job, worker_id, {
+        "status": status.value,
+        "result": result.model_dump(mode="json"),
+        "error": None if result.success else (result.message or result.payment_status)
+    })
+    logger.info(f"PaymentJobs: Job {job['_id']} (chuyến {job['trip_id']}) -> {status.value}")
+
+
+async def run_worker(worker_id: str):
+    logger.info(f"PaymentJobs: Worker {worker_id} bắt đầu.")
+    while True:
+        try:
+            job = await claim_next_job(worker_id)
+            if job is None:
+                await asyncio.sleep(PAYMENT_JOB_POLL_SECONDS)
+                continue
+            await process_job(job, worker_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"PaymentJobs: Worker {worker_id} lỗi: {e}", exc_info=True)
+            await asyncio.sleep(PAYMENT_JOB_POLL_SECONDS)
+
+
+def start_workers(count: int = PAYMENT_WORKERS) -> list:
+    """Tạo các task worker cho lifespan (hủy khi tắt ứng dụng)."""
+    prefix = uuid.uuid4().hex[:8]
+    return [asyncio.create_task(run_worker(f"{prefix}-{i}")) for i in range(count)]
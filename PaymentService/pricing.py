@@ -0,0 +1,171 @@
+# pricing.py
+"""
+Bảng giá cước dùng chung cho TripService (ước tính khi đặt chuyến) và PaymentService (cước
+thực tế, hoa hồng khi hoàn thành chuyến). File này được chép NGUYÊN VĂN vào cả hai service
+(mỗi service là một Docker build context riêng); tests/test_tripservice_pricing.py kiểm tra hai bản giống hệt.
+
+Bảng giá (plan) là JSON có version, đọc từ PRICING_PLAN_FILE (k8s: ConfigMap 'pricing-plan');
+không cấu hình thì dùng DEFAULT_PLAN. Ví dụ:
+
+    {
+      "version": "2026-10-19",
+      "commission_rate": 0.20,            # hoa hồng ứng dụng (trên tổng cước)
+      "rounding": 1000,                   # làm tròn tổng cước (VNĐ)
+      "utc_offset_hours": 7,              # giờ địa phương của các khung giờ
+      "default_vehicle_type": "4_SEATER", # dùng khi loại xe không có trong plan
+      "vehicle_types": {
+        "2_SEATER": {"base_fare": 15000, "per_km": 8000, "minimum_fare": 15000}, ...
+      },
+      "time_bands": [                     # [start_hour, end_hour), có thể qua nửa đêm (22 -> 5)
+        {"start_hour": 7, "end_hour": 9, "multiplier": 1.2, "vehicle_types": ["4_SEATER"]}
+      ]
+    }
+
+Khi nạp, plan được "biên dịch" thành bảng tra 24 giờ cho từng loại xe (cước mở cửa và giá/km
+đã nhân hệ số khung giờ), nên mỗi lần tính cước chỉ là vài phép tra dict/tuple và nhân cộng.
+get_plan() kiểm tra mtime của file tối đa mỗi PRICING_RELOAD_SECONDS giây và biên dịch lại khi
+file đổi (không cần khởi động lại); file lỗi thì giữ plan đang dùng.
+"""
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PRICING_PLAN_FILE = os.getenv("PRICING_PLAN_FILE")
+PRICING_RELOAD_SECONDS = float(os.getenv("PRICING_RELOAD_SECONDS", "30"))
+
+DEFAULT_PLAN: Dict[str, Any] = {
+    "version": "default-2026-10-19",
+    "commission_rate": 0.20,
+    "rounding": 1000,
+    "utc_offset_hours": 7,
+    "default_vehicle_type": "4_SEATER",
+    "vehicle_types": {
+        "2_SEATER": {"base_fare": 15000, "per_km": 8000, "minimum_fare": 15000},   # 2 chỗ
+        "4_SEATER": {"base_fare": 20000, "per_km": 10000, "minimum_fare": 20000},  # 4 chỗ
+        "7_SEATER": {"base_fare": 30000, "per_km": 15000, "minimum_fare": 30000},  # 7 chỗ
+    },
+    "time_bands": [],
+}
+
+
+class FareQuote(NamedTuple):
+    plan_version: str
+    vehicle_type: str
+    base_fare: float
+    per_km_rate: float
+    time_multiplier: float
+    surge_multiplier: float
+    total_fare: float
+    commission_rate: float
+    commission_amount: float
+    driver_earning: float
+
+
+class _VehicleTable(NamedTuple):
+    # hours[h] = (cước mở cửa, giá/km, hệ số khung giờ) cho giờ địa phương h
+    hours: Tuple[Tuple[float, float, float], ...]
+    minimum_fare: float
+
+
+class CompiledPlan:
+    def __init__(self, config: Dict[str, Any]):
+        self.version = str(config["version"])
+        self.commission_rate = float(config.get("commission_rate", 0.20))
+        if not 0 <= self.commission_rate < 1:
+            raise ValueError(f"commission_rate không hợp lệ: {self.commission_rate}")
+        self.rounding = float(config.get("rounding", 1000)) or 1.0
+        self.utc_offset = timedelta(hours=float(config.get("utc_offset_hours", 7)))
+
+        vehicle_configs = config["vehicle_types"]
+        if not vehicle_configs:
+            raise ValueError("Plan phải có ít nhất một loại xe")
+        multipliers = {vehicle_type: [1.0] * 24 for vehicle_type in vehicle_configs}
+        for band in config.get("time_bands", []):
+            start, end = int(band["start_hour"]) % 24, int(band["end_hour"]) % 24
+            hours = range(start, end) if start < end else [*range(start, 24), *range(0, end)]
+            for vehicle_type in band.get("vehicle_types") or vehicle_configs:
+                for hour in hours:
+                    multipliers[vehicle_type][hour] = float(band["multiplier"])
+
+        self.tables: Dict[str, _VehicleTable] = {}
+        for vehicle_type, vehicle in vehicle_configs.items():
+            base_fare, per_km = float(vehicle["base_fare"]), float(vehicle["per_km"])
+            self.tables[vehicle_type] = _VehicleTable(
+                hours=tuple((base_fare * m, per_km * m, m) for m in multipliers[vehicle_type]),
+                minimum_fare=float(vehicle.get("minimum_fare", base_fare))
+            )
+        self.default_vehicle_type = config.get("default_vehicle_type") or next(iter(self.tables))
+        if self.default_vehicle_type not in self.tables:
+            raise ValueError(f"default_vehicle_type không có trong plan: {self.default_vehicle_type}")
+
+    def quote(
+        self,
+        distance_km: float,
+        vehicle_type: Any = None,
+        at: Optional[datetime] = None,
+        surge_multiplier: float = 1.0
+    ) -> FareQuote:
+        """Tính cước cho quãng đường (km), loại xe, thời điểm đặt chuyến (mặc định: bây giờ) và hệ số surge."""
+        vehicle_type = getattr(vehicle_type, "value", vehicle_type)
+        if vehicle_type not in self.tables:
+            vehicle_type = self.default_vehicle_type
+        table = self.tables[vehicle_type]
+        at = at or datetime.now(timezone.utc)
+        if at.tzinfo is None:
+            at = at.replace(tzinfo=timezone.utc)
+        base_fare, per_km_rate, time_multiplier = table.hours[(at + self.utc_offset).hour]
+
+        fare = max((base_fare + distance_km * per_km_rate) * surge_multiplier, table.minimum_fare)
+        total_fare = round(fare / self.rounding) * self.rounding
+        commission_amount = total_fare * self.commission_rate
+        return FareQuote(
+            plan_version=self.version,
+            vehicle_type=vehicle_type,
+            base_fare=base_fare,
+            per_km_rate=per_km_rate,
+            time_multiplier=time_multiplier,
+            surge_multiplier=surge_multiplier,
+            total_fare=total_fare,
+            commission_rate=self.commission_rate,
+            commission_amount=commission_amount,
+            driver_earning=total_fare - commission_amount
+        )
+
+
+_plan = CompiledPlan(DEFAULT_PLAN)
+_plan_mtime: Optional[int] = None
+_next_check = 0.0
+
+
+def load_plan(path: str) -> CompiledPlan:
+    with open(path, "r", encoding="utf-8") as f:
+        return CompiledPlan(json.load(f))
+
+
+def get_plan() -> CompiledPlan:
+    """Plan đang dùng; nạp lại từ PRICING_PLAN_FILE nếu file đã thay đổi."""
+    global _plan, _plan_mtime, _next_check
+    if not PRICING_PLAN_FILE:
+        return _plan
+    now = time.monotonic()
+    if now < _next_check:
+        return _plan
+    _next_check = now + PRICING_RELOAD_SECONDS
+    try:
+        mtime = os.stat(PRICING_PLAN_FILE).st_mtime_ns
+        if mtime != _plan_mtime:
+            _plan = load_plan(PRICING_PLAN_FILE)
+            _plan_mtime = mtime
+            logger.info(f"Pricing: Đã nạp bảng giá {_plan.version} từ {PRICING_PLAN_FILE}")
+    except Exception as e:
+        logger.error(f"Pricing: Không nạp được bảng giá từ {PRICING_PLAN_FILE}, giữ bảng giá {_plan.version}: {e}")
+    return _plan
+
+
+def quote(distance_km: float, vehicle_type: Any = None, at: Optional[datetime] = None, surge_multiplier: float = 1.0) -> FareQuote:
+    return get_plan().quote(distance_km, vehicle_type, at, surge_multiplier)
@@ -0,0 +1,238 @@
+# PaymentService/reconcile_payments.py
+"""
+Đối soát giao dịch thanh toán chuyến đi với TripService.
+
+Đọc theo cursor các giao dịch PAYMENT đang PENDING/FAILED tạo trước (bây giờ - --older-than-minutes)
+và chưa được đối soát (index status+reconciled_at+created_at), mỗi lô RECONCILE_BATCH_SIZE giao dịch:
+1. lấy các chuyến đi liên quan bằng một lời gọi POST /internal/trips/batch của TripService;
+2. so từng giao dịch với chuyến đi:
+   - PENDING quá hạn (khách bỏ dở thanh toán VNPay)        -> chuyển FAILED (EXPIRED)
+   - TripService báo đã thanh toán bằng chính giao dịch này -> ghi nhận STATUS_MISMATCH (cần xem tay,
+                                                              không tự cộng/trừ tiền)
+   - số tiền khác fare.actual của chuyến                    -> ghi nhận AMOUNT_MISMATCH
+   - không tìm thấy chuyến                                  -> ghi nhận TRIP_NOT_FOUND
+   - giao dịch FAILED nhưng chuyến vẫn chờ thanh toán       -> gửi lại trạng thái FAILED cho TripService
+3. ghi sửa đổi của lô bằng bulk_write: 'reconciliation_issues' (upsert theo "<transaction _id>:<loại>",
+   chạy lại không tạo trùng), rồi chuyển PENDING -> FAILED (chỉ khi vẫn PENDING: callback VNPay có thể
+   vừa ghi SUCCESS), đọc lại trạng thái và chỉ báo FAILED cho TripService qua outbox 'trip_notifications'
+   khi giao dịch thực sự đang FAILED, cuối cùng đóng dấu reconciled_at.
+Mọi giao dịch đã xét được đóng dấu reconciled_at và bị loại khỏi các lượt sau, nên giao dịch FAILED
+không bị quét lại mãi, và giao dịch vừa chuyển PENDING -> FAILED không quay lại trong cùng lượt chạy.
+Dừng giữa chừng thì lô chưa đóng dấu được xét lại ở lần chạy sau (các ghi chép đều idempotent; giao dịch
+đã chuyển FAILED mà chưa kịp báo sẽ được báo ở lần đó).
+Bộ nhớ chỉ giữ một lô, nên chạy được trên hàng triệu giao dịch. --older-than-minutes phải lớn hơn
+thời hạn thanh toán của link VNPay, để không hủy giao dịch khách vẫn còn có thể trả.
+
+Chạy trong container PaymentService (cần MONGODB_URL, TRIP_SERVICE_URL), ví dụ:
+    python reconcile_payments.py                       # giao dịch cũ hơn 60 phút
+    python reconcile_payments.py --older-than-minutes 1440 --dry-run
+"""
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from pymongo import UpdateOne
+
+import models
+import trip_notifier
+from database import get_reconciliation_issues_collection, get_transactions_collection
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "500"))
+RECONCILE_FETCH_ATTEMPTS = 3
+TRIP_BATCH_LIMIT = 500  # Giới hạn của POST /internal/trips/batch bên TripService
+AMOUNT_TOLERANCE = 1.0  # VNĐ
+
+TRANSACTION_PROJECTION = {
+    "transaction_id": 1, "trip_id": 1, "amount": 1, "status": 1, "payment_method": 1, "created_at": 1
+}
+
+
+class IssueKind:
+    EXPIRED = "EXPIRED"
+    STATUS_MISMATCH = "STATUS_MISMATCH"
+    AMOUNT_MISMATCH = "AMOUNT_MISMATCH"
+    TRIP_NOT_FOUND = "TRIP_NOT_FOUND"
+
+
+def build_query(cutoff: datetime) -> Dict[str, Any]:
+    return {
+        "status": {"$in": [models.TransactionStatus.PENDING.value, models.TransactionStatus.FAILED.value]},
+        "created_at": {"$lt": cutoff},
+        "transaction_type": models.TransactionType.PAYMENT.value,
+        "reconciled_at": None,  # chưa đối soát (field không có hoặc null)
+    }
+
+
+def reconcile_transaction(transaction: Dict[str, Any], trip: Optional[Dict[str, Any]]) -> Tuple[List[str], Optional[str]]:
+    """
+    So một giao dịch với chuyến đi. Trả về (các loại sai lệch, trạng thái cần báo lại cho TripService).
+    Chỉ IssueKind.EXPIRED làm đổi trạng thái giao dịch; các loại khác chỉ được ghi nhận.
+    """
+    if trip is None:
+        return [IssueKind.TRIP_NOT_FOUND], None
+
+    issues = []
+    payment = trip.get("payment") or {}
+    trip_payment_status = payment.get("status")
+    paid_with_this = payment.get("transaction_id") == transaction.get("transaction_id")
+
+    if trip_payment_status == models.TransactionStatus.SUCCESS.value and paid_with_this:
+        issues.append(IssueKind.STATUS_MISMATCH)
+    elif transaction["status"] == models.TransactionStatus.PENDING.value:
+        issues.append(IssueKind.EXPIRED)
+
+    actual_fare = (trip.get("fare") or {}).get("actual")
+    if actual_fare is not None and abs(transaction.get("amount", 0) - actual_fare) >= AMOUNT_TOLERANCE:
+        issues.append(IssueKind.AMOUNT_MISMATCH)
+
+    notify_status = None
+    now_failed = IssueKind.EXPIRED in issues or transaction["status"] == models.TransactionStatus.FAILED.value
+    if now_failed and trip_payment_status in (None, models.TransactionStatus.PENDING.value) and (
+        payment.get("transaction_id") in (None, transaction.get("transaction_id"))
+    ):
+        notify_status = models.TransactionStatus.FAILED.value
+    return issues, notify_status
+
+
+async def fetch_trips(trip_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Lấy chuyến đi theo lô từ TripService (tối đa TRIP_BATCH_LIMIT id mỗi lời gọi, có thử lại)."""
+    trips: Dict[str, Dict[str, Any]] = {}
+    url = f"{trip_notifier.TRIP_SERVICE_URL}/internal/trips/batch"
+    for start in range(0, len(trip_ids), TRIP_BATCH_LIMIT):
+        chunk = trip_ids[start:start + TRIP_BATCH_LIMIT]
+        for attempt in range(1, RECONCILE_FETCH_ATTEMPTS + 1):
+            try:
+                response = await trip_notifier.get_http_client().post(url, json={"trip_ids": chunk})
+                response.raise_for_status()
+                trips.update((trip["_id"], trip) for trip in response.json()["trips"])
+                break
+            except (httpx.RequestError, httpx.HTTPStatusError) as e:
+                if attempt == RECONCILE_FETCH_ATTEMPTS:
+                    raise
+                logger.warning(f"Reconcile: Lỗi lấy chuyến đi từ TripService (lần {attempt}): {e}")
+                await asyncio.sleep(2 ** attempt)
+    return trips
+
+
+async def reconcile_batch(transactions: List[Dict[str, Any]], run_id: str, dry_run: bool = False) -> Dict[str, int]:
+    trip_ids = list(dict.fromkeys(t["trip_id"] for t in transactions if t.get("trip_id")))
+    trips = await fetch_trips(trip_ids)
+
+    now = datetime.now(timezone.utc)
+    counts: Dict[str, int] = {"scanned": len(transactions), "notified": 0}
+    expire_ops, issue_ops, notifications = [], [], []
+    for transaction in transactions:
+        issues, notify_status = reconcile_transaction(transaction, trips.get(transaction.get("trip_id")))
+        for kind in issues:
+            counts[kind] = counts.get(kind, 0) + 1
+            trip = trips.get(transaction.get("trip_id")) or {}
+            issue_ops.append(UpdateOne(
+                {"_id": f"{transaction['_id']}:{kind}"},
+                {
+                    "$set": {
+                        "kind": kind,
+                        "transaction_id": transaction.get("transaction_id"),
+                        "trip_id": transaction.get("trip_id"),
+                        "transaction_status": transaction["status"],
+                        "amount": transaction.get("amount"),
+                        "trip_fare_actual": (trip.get("fare") or {}).get("actual"),
+                        "trip_payment": trip.get("payment"),
+                        "run_id": run_id,
+                        "detected_at": now
+                    },
+                    "$setOnInsert": {"resolved": False}
+                },
+                upsert=True
+            ))
+        if IssueKind.EXPIRED in issues:
+            expire_ops.append(UpdateOne(
+                {"_id": transaction["_id"], "status": models.TransactionStatus.PENDING.value},
+                {"$set": {
+                    "status": models.TransactionStatus.FAILED.value,
+                    "description": "Đối soát: thanh toán quá hạn, chuyển FAILED",
+                    "updated_at": now
+                }}
+            ))
+        if notify_status:
+            notifications.append((transaction, notify_status))
+
+    if dry_run:
+        counts["notified"] = len(notifications)
+        return counts
+    if issue_ops:
+        issues_coll = await get_reconciliation_issues_collection()
+        await issues_coll.bulk_write(issue_ops, ordered=False)
+    transactions_coll = await get_transactions_collection()
+    if expire_ops:
+        await transactions_coll.bulk_write(expire_ops, ordered=False)
+    if notifications:
+        # Đọc lại sau khi chuyển trạng thái: giao dịch không còn FAILED (vd. callback VNPay vừa ghi SUCCESS)
+        # thì không báo FAILED cho TripService
+        failed_ids = {
+            doc["_id"] async for doc in transactions_coll.find(
+                {"_id": {"$in": [t["_id"] for t, _ in notifications]},
+                 "status": models.TransactionStatus.FAILED.value},
+                {"_id": 1}
+            )
+        }
+        confirmed = [
+            (t["trip_id"], t.get("transaction_id") or "", status)
+            for t, status in notifications if t["_id"] in failed_ids
+        ]
+        counts["notified"] = len(confirmed)
+        await trip_notifier.enqueue_payment_statuses(confirmed)
+    # Đóng dấu sau cùng: lỗi ở các bước trên thì cả lô được xét lại lần sau
+    await transactions_coll.bulk_write(
+        [UpdateOne({"_id": t["_id"]}, {"$set": {"reconciled_at": now}}) for t in transactions], ordered=False
+    )
+    return counts
+
+
+async def reconcile(older_than_minutes: int, batch_size: int = RECONCILE_BATCH_SIZE, dry_run: bool = False) -> Dict[str, int]:
+    """Đối soát mọi giao dịch PENDING/FAILED chưa đối soát, cũ hơn older_than_minutes, từng lô batch_size."""
+    transactions_coll = await get_transactions_collection()
+    started_at = datetime.now(timezone.utc)
+    run_id = started_at.strftime("%Y%m%dT%H%M%SZ")
+    cutoff = started_at - timedelta(minutes=older_than_minutes)
+    cursor = transactions_coll.find(build_query(cutoff), TRANSACTION_PROJECTION, batch_size=batch_size)
+
+    totals: Dict[str, int] = {}
+    batch: List[Dict[str, Any]] = []
+
+    async def flush():
+        for key, value in (await reconcile_batch(batch, run_id, dry_run)).items():
+            totals[key] = totals.get(key, 0) + value
+        logger.info(f"Reconcile {run_id}: Đã xét {totals['scanned']} giao dịch: {totals}")
+        batch.clear()
+
+    async for transaction in cursor:
+        batch.append(transaction)
+        if len(batch) >= batch_size:
+            await flush()
+    if batch:
+        await flush()
+    logger.info(f"Reconcile {run_id}: Xong{' (dry-run, không ghi)' if dry_run else ''}: {totals or {'scanned': 0}}")
+    return totals
+
+
+async def _main(older_than_minutes: int, batch_size: int, dry_run: bool):
+    try:
+        await reconcile(older_than_minutes, batch_size, dry_run)
+    finally:
+        await trip_notifier.close_http_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Đối soát giao dịch thanh toán PENDING/FAILED với TripService")
+    parser.add_argument("--older-than-minutes", type=int, default=60)
+    parser.add_argument("--batch-size", type=int, default=RECONCILE_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="Chỉ báo cáo, không ghi sửa đổi")
+    args = parser.parse_args()
+    asyncio.run(_main(args.older_than_minutes, args.batch_size, args.dry_run))
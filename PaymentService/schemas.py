@@ -1,17 +1,45 @@
 from pydantic import BaseModel, Field, ConfigDict
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from datetime import datetime
 # from models import TransactionStatus # Không cần thiết nếu không dùng trực tiếp ở đây
 
 class TopUpRequest(BaseModel):
-    user_id: str
+    driver_id: str
     amount: float = Field(..., gt=0)
+    note: Optional[str] = None
 
 class WalletResponse(BaseModel):
-    user_id: str
+    driver_id: str
     balance: float
     updated_at: datetime
 
+class TransactionItem(BaseModel):
+    transaction_id: str
+    transaction_type: str
+    amount: float
+    balance_after: Optional[float] = None
+    trip_id: Optional[str] = None
+    status: str
+    description: Optional[str] = None
+    created_at: datetime
+
+class SettlementItem(BaseModel):
+    settlement_id: str = Field(validation_alias="_id")  # "<settlement_date>:<driver_id>"
+    settlement_date: str
+    status: str  # "PENDING", "PAID", "FAILED"
+    net_payout: float
+    gross_fare: float
+    commission: float
+    transaction_count: int
+    trip_count: int
+    payout_attempts: int = 0
+    paid_at: Optional[datetime] = None
+    updated_at: datetime
+
+class TransactionPage(BaseModel):
+    items: List[TransactionItem]
+    next_cursor: Optional[str] = None  # Truyền lại vào ?cursor= để lấy trang tiếp theo
+
 class ProcessPaymentRequest(BaseModel):
     trip_id: str
     user_id: str
@@ -28,16 +56,23 @@ class TripCompletionRequest(BaseModel):
     driver_id: str
     user_id: str
     distance_km: float
+    vehicle_type: Optional[str] = None  # "2_SEATER" / "4_SEATER" / "7_SEATER" (None: loại mặc định của bảng giá)
+    surge_multiplier: float = Field(default=1.0, gt=0)
+    requested_at: Optional[datetime] = None  # Giờ đặt chuyến, để chọn khung giờ giống lúc ước tính
     payment_method: str  # "BANK_TRANSFER" or "CASH"
     user_bank_info: Optional[Dict[str, Any]] = None  # For bank transfer
 
 class TripFareCalculation(BaseModel):
     distance_km: float
-    base_fare: float = Field(default=5000.0)  # 5,000 VND per km
+    vehicle_type: Optional[str] = None
+    base_fare: float  # Cước mở cửa (đã nhân hệ số khung giờ)
+    per_km_rate: float  # Giá mỗi km (đã nhân hệ số khung giờ)
+    surge_multiplier: float = 1.0
     total_fare: float
-    commission_rate: float = Field(default=0.20)  # 20% commission
+    commission_rate: float
     commission_amount: float
     driver_earning: float
+    pricing_version: Optional[str] = None  # Version bảng giá đã dùng
 
 class MockBankTransferRequest(BaseModel):
     from_account: str
@@ -62,3 +97,15 @@ class TripCompletionResponse(BaseModel):
     driver_wallet_updated: bool = False
     new_driver_balance: Optional[float] = None
     message: Optional[str] = None
+
+
+class PaymentJobResponse(BaseModel):
+    job_id: str
+    trip_id: str
+    status: str  # "QUEUED", "PROCESSING", "SUCCEEDED", "FAILED"
+    attempts: int = 0
+    fare_details: TripFareCalculation
+    result: Optional[TripCompletionResponse] = None
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
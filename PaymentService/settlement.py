@@ -0,0 +1,235 @@
+# PaymentService/settlement.py
+"""
+Quyết toán cuối ngày cho tài xế.
+
+Bước 1 (settle): một aggregation trên 'transactions' gom các giao dịch EARNING thành công trong
+ngày theo tài xế (user_id), chạy với allowDiskUse và đọc theo cursor; mỗi SETTLEMENT_BATCH_SIZE
+tài xế được ghi vào 'settlements' bằng một bulk_write (upsert theo "<ngày>:<driver_id>") rồi lưu
+checkpoint (driver_id cuối cùng) vào 'settlement_runs'. Bộ nhớ chỉ giữ một lô; chạy lại cùng ngày
+sẽ tiếp tục từ checkpoint.
+
+Bước 2 (--payout): chi trả từng bản ghi PENDING: trừ ví (PAYOUT, ghi sổ cái đối ứng
+'external:bank_payout') rồi đánh dấu PAID; ví không đủ số dư -> FAILED. Chạy lại chỉ xử lý
+bản ghi còn PENDING; thêm --retry-failed để chi trả lại cả bản ghi FAILED (vd: sau khi ví đã
+được nạp thêm). Giao dịch PAYOUT_<id> (transaction_id cố định, unique) được ghi trước khi trừ số dư,
+nên lần chạy lại sau khi chết giữa chừng hay hai lần --payout chạy chồng nhau không trừ ví hai lần,
+kể cả trên MongoDB không hỗ trợ transaction.
+
+Hoa hồng không được lưu trong giao dịch EARNING nên được suy ra từ commission_rate của bảng giá (pricing.py):
+cước gộp = thu nhập / (1 - tỉ lệ), hoa hồng = cước gộp - thu nhập.
+
+Chạy trong container PaymentService (cần MONGODB_URL), ví dụ sau nửa đêm (UTC):
+    python settlement.py                       # quyết toán hôm qua
+    python settlement.py --date 2026-10-18 --payout
+    python settlement.py --date 2026-10-18 --payout --retry-failed
+"""
+import argparse
+import asyncio
+import logging
+import os
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import crud
+import models
+import pricing
+from database import get_settlements_collection, get_settlement_runs_collection, get_transactions_collection
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SETTLEMENT_BATCH_SIZE = int(os.getenv("SETTLEMENT_BATCH_SIZE", "1000"))
+# Field trả cho tài xế (schemas.SettlementItem); không đọc các field khác như trip_ids của bản ghi cũ
+SETTLEMENT_PROJECTION = {
+    "settlement_date": 1, "status": 1, "net_payout": 1, "gross_fare": 1, "commission": 1,
+    "transaction_count": 1, "trip_count": 1, "payout_attempts": 1, "paid_at": 1, "updated_at": 1,
+}
+
+
+class SettlementStatus:
+    PENDING = "PENDING"
+    PAID = "PAID"
+    FAILED = "FAILED"
+
+
+def day_bounds(settlement_date: date) -> tuple:
+    start = datetime.combine(settlement_date, time.min, tzinfo=timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+def build_pipeline(settlement_date: date, after_driver_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    start, end = day_bounds(settlement_date)
+    match: Dict[str, Any] = {
+        "transaction_type": models.TransactionType.EARNING.value,
+        "status": models.TransactionStatus.SUCCESS.value,
+        "created_at": {"$gte": start, "$lt": end},
+    }
+    if after_driver_id is not None:
+        match["user_id"] = {"$gt": after_driver_id}
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": "$user_id",
+            "net_earnings": {"$sum": "$amount"},
+            "transaction_count": {"$sum": 1},
+            "trip_ids": {"$addToSet": "$trip_id"},
+        }},
+        {"$project": {"net_earnings": 1, "transaction_count": 1, "trip_count": {"$size": "$trip_ids"}}},
+        {"$sort": {"_id": 1}},
+    ]
+
+
+def settlement_record(settlement_date: date, row: Dict[str, Any], commission_rate: float, now: datetime) -> Dict[str, Any]:
+    net = round(row["net_earnings"], 2)
+    gross = round(net / (1 - commission_rate), 2) if commission_rate < 1 else net
+    return {
+        "settlement_date": settlement_date.isoformat(),
+        "driver_id": row["_id"],
+        "net_payout": net,
+        "gross_fare": gross,
+        "commission": round(gross - net, 2),
+        "transaction_count": row["transaction_count"],
+        "trip_count": row["trip_count"],
+        "updated_at": now,
+    }
+
+
+def _upsert(settlement_date: date, record: Dict[str, Any]) -> UpdateOne:
+    # Bản ghi đã PAID không bị tính lại; bản ghi mới bắt đầu ở PENDING
+    return UpdateOne(
+        {"_id": f"{settlement_date.isoformat()}:{record['driver_id']}", "status": {"$ne": SettlementStatus.PAID}},
+        {"$set": record, "$setOnInsert": {"status": SettlementStatus.PENDING, "created_at": record["updated_at"]}},
+        upsert=True
+    )
+
+
+async def settle_day(settlement_date: date, batch_size: int = SETTLEMENT_BATCH_SIZE) -> Dict[str, Any]:
+    """Tính và ghi bản quyết toán cho mọi tài xế có thu nhập trong ngày. Tiếp tục từ checkpoint nếu có."""
+    transactions_coll = await get_transactions_collection()
+    settlements_coll = await get_settlements_collection()
+    runs_coll = await get_settlement_runs_collection()
+    run_id = settlement_date.isoformat()
+
+    run = await runs_coll.find_one({"_id": run_id}) or {}
+    if run.get("status") == "DONE":
+        logger.info(f"Settlement {run_id}: Đã quyết toán xong trước đó.")
+        return run
+    last_driver_id = run.get("last_driver_id")
+    totals = {
+        "drivers": run.get("drivers", 0),
+        "net_payout": run.get("net_payout", 0.0),
+        "commission": run.get("commission", 0.0),
+    }
+    if last_driver_id:
+        logger.info(f"Settlement {run_id}: Tiếp tục sau tài xế {last_driver_id} ({totals['drivers']} đã xử lý).")
+
+    async def flush(ops: List[UpdateOne], batch_last_driver_id: str):
+        if ops:
+            try:
+                await settlements_coll.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                # Upsert trùng _id = bản ghi đã PAID từ trước, giữ nguyên; lỗi khác thì dừng
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+        await runs_coll.update_one(
+            {"_id": run_id},
+            {"$set": {"status": "RUNNING", "last_driver_id": batch_last_driver_id, **totals,
+                      "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    commission_rate = pricing.get_plan().commission_rate
+    cursor = transactions_coll.aggregate(
+        build_pipeline(settlement_date, last_driver_id), allowDiskUse=True, batchSize=batch_size
+    )
+    ops: List[UpdateOne] = []
+    now = datetime.now(timezone.utc)
+    async for row in cursor:
+        if row["_id"] is None:
+            continue
+        record = settlement_record(settlement_date, row, commission_rate, now)
+        ops.append(_upsert(settlement_date, record))
+        totals["drivers"] += 1
+        totals["net_payout"] = round(totals["net_payout"] + record["net_payout"], 2)
+        totals["commission"] = round(totals["commission"] + record["commission"], 2)
+        last_driver_id = row["_id"]
+        if len(ops) >= batch_size:
+            await flush(ops, last_driver_id)
+            logger.info(f"Settlement {run_id}: Đã ghi {totals['drivers']} bản quyết toán.")
+            ops = []
+            now = datetime.now(timezone.utc)
+    await flush(ops, last_driver_id)
+
+    await runs_coll.update_one({"_id": run_id}, {"$set": {"status": "DONE", "finished_at": datetime.now(timezone.utc)}})
+    logger.info(
+        f"Settlement {run_id}: Xong {totals['drivers']} tài xế, chi trả {totals['net_payout']:,.0f} VNĐ, "
+        f"hoa hồng {totals['commission']:,.0f} VNĐ."
+    )
+    return {"_id": run_id, "status": "DONE", **totals}
+
+
+async def get_driver_settlements(driver_id: str, limit: int = 30) -> List[Dict[str, Any]]:
+    """Các bản quyết toán gần nhất của tài xế (index driver_id + settlement_date)."""
+    settlements_coll = await get_settlements_collection()
+    return await settlements_coll.find({"driver_id": driver_id}, SETTLEMENT_PROJECTION).sort(
+        "settlement_date", -1
+    ).limit(limit).to_list(length=limit)
+
+
+async def payout_day(settlement_date: date, batch_size: int = SETTLEMENT_BATCH_SIZE, retry_failed: bool = False) -> Dict[str, int]:
+    """Chi trả các bản quyết toán PENDING (và FAILED nếu retry_failed) của ngày: trừ ví tài xế và ghi sổ cái."""
+    settlements_coll = await get_settlements_collection()
+    statuses = [SettlementStatus.PENDING] + ([SettlementStatus.FAILED] if retry_failed else [])
+    counts = {"paid": 0, "failed": 0}
+    last_id = ""
+    while True:
+        batch = await settlements_coll.find({
+            "settlement_date": settlement_date.isoformat(),
+            "status": {"$in": statuses},
+            "_id": {"$gt": last_id},
+        }).sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+        if not batch:
+            break
+        results = []
+        for record in batch:
+            # transaction_id cố định theo bản quyết toán: lần chạy trước đã trừ ví nhưng chưa kịp
+            # đánh dấu PAID thì debit_driver_wallet không trừ lần nữa mà trả về ví hiện tại
+            transaction_id = f"PAYOUT_{record['_id']}"
+            paid = record["net_payout"] <= 0
+            if not paid:
+                paid = await crud.debit_driver_wallet(
+                    record["driver_id"], record["net_payout"], transaction_id,
+                    description=f"Chi trả quyết toán ngày {record['settlement_date']}"
+                ) is not None
+            status = SettlementStatus.PAID if paid else SettlementStatus.FAILED
+            counts["paid" if status == SettlementStatus.PAID else "failed"] += 1
+            results.append(UpdateOne(
+                {"_id": record["_id"], "status": record["status"]},
+                {
+                    "$set": {"status": status, "paid_at": datetime.now(timezone.utc) if status == SettlementStatus.PAID else None},
+                    "$inc": {"payout_attempts": 1}
+                }
+            ))
+        await settlements_coll.bulk_write(results, ordered=False)
+        last_id = batch[-1]["_id"]
+        logger.info(f"Payout {settlement_date}: {counts['paid']} PAID, {counts['failed']} FAILED.")
+    return counts
+
+
+async def _main(settlement_date: date, payout: bool, batch_size: int, retry_failed: bool = False):
+    await settle_day(settlement_date, batch_size)
+    if payout:
+        await payout_day(settlement_date, batch_size, retry_failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quyết toán thu nhập tài xế theo ngày (UTC)")
+    parser.add_argument("--date", type=date.fromisoformat, default=datetime.now(timezone.utc).date() - timedelta(days=1))
+    parser.add_argument("--payout", action="store_true", help="Chi trả (trừ ví) sau khi quyết toán")
+    parser.add_argument("--retry-failed", action="store_true", help="Khi --payout: chi trả lại cả bản ghi FAILED")
+    parser.add_argument("--batch-size", type=int, default=SETTLEMENT_BATCH_SIZE)
+    args = parser.parse_args()
+    asyncio.run(_main(args.date, args.payout, args.batch_size, args.retry_failed))
@@ -0,0 +1,54 @@
+# PaymentService/trip_cache.py
+"""
+Cache LRU + TTL trong bộ nhớ cho chi tiết chuyến đi đọc từ TripService.
+
+Chỉ là đường dự phòng cho callback VNPay khi giao dịch PENDING không lưu sẵn driver_id
+(giao dịch tạo trước khi process_vnpay_payment lưu các field này), để IPN/Return gửi lại
+nhiều lần không gọi TripService mỗi lần.
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+TRIP_CACHE_TTL_SECONDS = int(os.getenv("TRIP_CACHE_TTL_SECONDS", "300"))
+TRIP_CACHE_MAX_ENTRIES = int(os.getenv("TRIP_CACHE_MAX_ENTRIES", "1000"))
+
+
+class TripDetailsCache:
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    def get(self, trip_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(trip_id)
+        if entry is None:
+            return None
+        expires_at, details = entry
+        if expires_at < time.monotonic():
+            del self._entries[trip_id]
+            return None
+        self._entries.move_to_end(trip_id)
+        return details
+
+    def set(self, trip_id: str, details: Dict[str, Any]):
+        self._entries[trip_id] = (time.monotonic() + self.ttl_seconds, details)
+        self._entries.move_to_end(trip_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_fetch(
+        self,
+        trip_id: str,
+        fetch: Callable[[str], Awaitable[Optional[Dict[str, Any]]]]
+    ) -> Optional[Dict[str, Any]]:
+        details = self.get(trip_id)
+        if details is None:
+            details = await fetch(trip_id)
+            if details is not None:
+                self.set(trip_id, details)
+        return details
+
+
+trip_cache = TripDetailsCache(TRIP_CACHE_TTL_SECONDS, TRIP_CACHE_MAX_ENTRIES)
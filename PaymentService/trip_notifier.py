@@ -0,0 +1,204 @@
+# PaymentService/trip_notifier.py
+"""
+Gửi trạng thái thanh toán cho TripService qua outbox bền (collection 'trip_notifications').
+
+crud.notify_trip_service_payment_status chỉ ghi (upsert theo trip_id) rồi trả về ngay, nên
+TripService chậm/chết không làm chậm worker thanh toán hay callback VNPay. Một flusher nền
+(chạy trong lifespan) lấy tối đa NOTIFY_BATCH_SIZE thông báo đến hạn, gửi song song bằng một
+httpx.AsyncClient dùng chung (giữ kết nối keep-alive), rồi ghi kết quả cả lô bằng một bulk_write:
+- gửi thành công: xóa document;
+- lỗi: thử lại sau 2^attempts giây (tối đa NOTIFY_MAX_BACKOFF_SECONDS); quá NOTIFY_MAX_ATTEMPTS
+  lần thì chuyển DEAD (vẫn giữ lại để tra cứu / gửi lại thủ công).
+
+Mỗi chuyến chỉ có một document: cập nhật mới cho cùng chuyến ghi đè payload và tăng 'version',
+nên nhiều cập nhật dồn lại chỉ gửi trạng thái mới nhất. Nếu cập nhật mới đến trong lúc đang gửi
+bản cũ, document không bị xóa (so khớp version) và sẽ được gửi lại.
+Khóa ngắn hạn (locked_by/locked_until) cho phép nhiều replica cùng chạy flusher.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from pymongo import DeleteOne, UpdateOne
+
+from database import get_trip_notifications_collection
+
+logger = logging.getLogger(__name__)
+
+TRIP_SERVICE_URL = os.getenv("TRIP_SERVICE_URL", "http://tripservice:8000")
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", "50"))
+NOTIFY_POLL_SECONDS = float(os.getenv("NOTIFY_POLL_SECONDS", "1"))
+NOTIFY_LOCK_SECONDS = int(os.getenv("NOTIFY_LOCK_SECONDS", "30"))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "20"))
+NOTIFY_MAX_BACKOFF_SECONDS = int(os.getenv("NOTIFY_MAX_BACKOFF_SECONDS", "300"))
+NOTIFY_TIMEOUT_SECONDS = float(os.getenv("NOTIFY_TIMEOUT_SECONDS", "10"))
+
+
+class NotificationStatus:
+    PENDING = "PENDING"
+    DEAD = "DEAD"
+
+
+_http_client: Optional[httpx.AsyncClient] = None
+_wakeup: Optional[asyncio.Event] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Client HTTP dùng chung cho các lời gọi TripService (pool kết nối keep-alive)."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=NOTIFY_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=NOTIFY_BATCH_SIZE, max_keepalive_connections=NOTIFY_BATCH_SIZE)
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def _get_wakeup() -> asyncio.Event:
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    return _wakeup
+
+
+def _retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=min(2 ** attempts, NOTIFY_MAX_BACKOFF_SECONDS))
+
+
+def _enqueue_op(trip_id: str, transaction_id: str, status: str, now: datetime) -> UpdateOne:
+    return UpdateOne(
+        {"_id": trip_id},
+        {
+            "$set": {
+                "payload": {"status": status, "transaction_id": transaction_id},
+                "status": NotificationStatus.PENDING,
+                "attempts": 0,
+                "available_at": now,
+                "last_error": None,
+                "updated_at": now
+            },
+            "$inc": {"version": 1},
+            "$setOnInsert": {"created_at": now}
+        },
+        upsert=True
+    )
+
+
+async def enqueue_payment_status(trip_id: str, transaction_id: str, status: str):
+    """Ghi (hoặc ghi đè) thông báo trạng thái thanh toán của chuyến; flusher sẽ gửi ngay sau đó."""
+    await enqueue_payment_statuses([(trip_id, transaction_id, status)])
+
+
+async def enqueue_payment_statuses(updates: List[Tuple[str, str, str]]):
+    """Ghi nhiều thông báo (trip_id, transaction_id, status) bằng một bulk_write."""
+    if not updates:
+        return
+    notifications = await get_trip_notifications_collection()
+    now = datetime.now(timezone.utc)
+    await notifications.bulk_write([_enqueue_op(*update, now) for update in updates], ordered=False)
+    _get_wakeup().set()
+
+
+async def claim_batch(token: str, limit: int = NOTIFY_BATCH_SIZE) -> List[Dict[str, Any]]:
+    """Khóa tối đa 'limit' thông báo đến hạn cho lượt flush 'token' và trả về chúng."""
+    notifications = await get_trip_notifications_collection()
+    now = datetime.now(timezone.utc)
+    due = {
+        "status": NotificationStatus.PENDING,
+        "available_at": {"$lte": now},
+        "$or": [{"locked_until": None}, {"locked_until": {"$lt": now}}]
+    }
+    candidates = await notifications.find(due, {"_id": 1}).sort("available_at", 1).limit(limit).to_list(length=limit)
+    if not candidates:
+        return []
+    ids = [doc["_id"] for doc in candidates]
+    await notifications.update_many(
+        {"_id": {"$in": ids}, **due},
+        {"$set": {"locked_by": token, "locked_until": now + timedelta(seconds=NOTIFY_LOCK_SECONDS)}}
+    )
+    return await notifications.find({"_id": {"$in": ids}, "locked_by": token}).to_list(length=limit)
+
+
+async def deliver(notification: Dict[str, Any]) -> Optional[str]:
+    """PUT /trips/{trip_id}/payment; trả về None nếu thành công, ngược lại là mô tả lỗi."""
+    url = f"{TRIP_SERVICE_URL}/trips/{notification['_id']}/payment"
+    try:
+        response = await get_http_client().put(url, json=notification["payload"])
+        response.raise_for_status()
+        return None
+    except httpx.HTTPStatusError as e:
+        return f"HTTP {e.response.status_code}: {e.response.text[:200]}"
+    except httpx.RequestError as e:
+        return f"{type(e).__name__}: {e}"
+
+
+def _result_ops(notification: Dict[str, Any], token: str, error: Optional[str], now: datetime) -> list:
+    current = {"_id": notification["_id"], "locked_by": token, "version": notification.get("version")}
+    if error is None:
+        ops = [DeleteOne(current)]
+    else:
+        attempts = notification.get("attempts", 0) + 1
+        update = {"attempts": attempts, "last_error": error, "updated_at": now, "locked_by": None, "locked_until": None}
+        if attempts >= NOTIFY_MAX_ATTEMPTS:
+            update["status"] = NotificationStatus.DEAD
+        else:
+            update["available_at"] = now + _retry_delay(attempts)
+        ops = [UpdateOne(current, {"$set": update})]
+    # Có cập nhật mới hơn trong lúc gửi: chỉ nhả khóa để lượt sau gửi bản mới
+    ops.append(UpdateOne({"_id": notification["_id"], "locked_by": token}, {"$set": {"locked_by": None, "locked_until": None}}))
+    return ops
+
+
+async def flush_once(limit: int = NOTIFY_BATCH_SIZE) -> Dict[str, int]:
+    """Gửi một lô thông báo đến hạn. Trả về số lượng đã gửi / lỗi."""
+    token = uuid.uuid4().hex
+    batch = await claim_batch(token, limit)
+    counts = {"claimed": len(batch), "delivered": 0, "failed": 0}
+    if not batch:
+        return counts
+    errors = await asyncio.gather(*(deliver(notification) for notification in batch))
+
+    now = datetime.now(timezone.utc)
+    ops = []
+    for notification, error in zip(batch, errors):
+        if error is None:
+            counts["delivered"] += 1
+        else:
+            counts["failed"] += 1
+            logger.warning(f"TripNotifier: Gửi trạng thái thanh toán chuyến {notification['_id']} lỗi (lần {notification.get('attempts', 0) + 1}): {error}")
+        ops.extend(_result_ops(notification, token, error, now))
+    notifications = await get_trip_notifications_collection()
+    await notifications.bulk_write(ops, ordered=True)
+    logger.info(f"TripNotifier: Đã gửi {counts['delivered']}/{counts['claimed']} thông báo thanh toán.")
+    return counts
+
+
+async def run_flusher():
+    logger.info("TripNotifier: Flusher bắt đầu.")
+    wakeup = _get_wakeup()
+    while True:
+        try:
+            wakeup.clear()
+            counts = await flush_once()
+            if counts["claimed"] >= NOTIFY_BATCH_SIZE:
+                continue
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=NOTIFY_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"TripNotifier: Flusher lỗi: {e}", exc_info=True)
+            await asyncio.sleep(NOTIFY_POLL_SECONDS)
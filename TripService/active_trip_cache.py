@@ -0,0 +1,137 @@
+# TripService/active_trip_cache.py
+"""
+Cache write-through trong Redis cho các chuyến đi đang hoạt động (PENDING/ACCEPTED/ON_TRIP).
+
+App hành khách/tài xế poll GET /trips/{trip_id} liên tục trong suốt chuyến đi. Mỗi lần
+chuyến đi đổi trạng thái, TripService ghi sẵn JSON của TripResponse vào Redis, nên lần poll
+tiếp theo trả thẳng chuỗi JSON (không find_one, không validate Pydantic).
+Chuyến đi COMPLETED/CANCELLED bị xóa khỏi cache; TTL chỉ là lưới an toàn.
+
+Mỗi bản cache đi kèm một key version (updated_at của chuyến, mili giây). Ghi và xóa đều chạy qua
+một script Lua so-và-ghi: bản cũ hơn version đã biết bị bỏ qua, còn xóa để lại version làm
+"bia mộ". Nhờ vậy một lần đọc trượt (đọc Mongo trước khi chuyến bị hoàn thành/hủy) không thể
+ghi lại JSON ACCEPTED/ON_TRIP cũ sau khi write-through đã xóa nó.
+"""
+import logging
+import os
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import models
+import schemas
+from database import redis_client
+from fast_response import dumps, trusted_dump
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_TRIP_CACHE_TTL_SECONDS = int(os.getenv("ACTIVE_TRIP_CACHE_TTL_SECONDS", "300"))
+ACTIVE_TRIP_KEY_PREFIX = "trip:active:"
+
+# KEYS[1]: JSON chuyến đi, KEYS[2]: version; ARGV: version, JSON ('' = xóa), TTL (giây)
+_COMPARE_AND_SET = """
+local known = tonumber(redis.call('GET', KEYS[2]) or '-1')
+if tonumber(ARGV[1]) < known then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[3])
+return 1
+"""
+_compare_and_set = None
+
+ACTIVE_STATUSES = {
+    models.TripStatusEnum.PENDING.value,
+    models.TripStatusEnum.ACCEPTED.value,
+    models.TripStatusEnum.ON_TRIP.value,
+}
+
+
+def _keys(trip_id: str) -> List[str]:
+    # Hash tag {trip_id}: hai key cùng slot để script chạy được trên Redis cluster
+    return [f"{ACTIVE_TRIP_KEY_PREFIX}{{{trip_id}}}", f"{ACTIVE_TRIP_KEY_PREFIX}{{{trip_id}}}:version"]
+
+
+def _version(at: Optional[datetime]) -> int:
+    """Version theo mili giây (độ chính xác datetime của MongoDB); Mongo trả datetime không tz = UTC."""
+    if at is None:
+        return 0
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    return int(at.timestamp() * 1000)
+
+
+def trip_version(trip: dict) -> int:
+    return _version(trip.get("updated_at") or trip.get("created_at"))
+
+
+def serialize_trip(trip: dict) -> str:
+    """JSON giống hệt response của GET /trips/{trip_id}."""
+    return dumps(trusted_dump(schemas.TripResponse, trip)).decode("utf-8")
+
+
+async def get_json(trip_id: str) -> Optional[str]:
+    if redis_client is None:
+        return None
+    try:
+        return await redis_client.get(_keys(trip_id)[0])
+    except Exception as e:
+        logger.warning(f"ActiveTripCache: Lỗi đọc Redis cho chuyến {trip_id}: {e}")
+        return None
+
+
+def _script():
+    global _compare_and_set
+    if _compare_and_set is None or _compare_and_set.registered_client is not redis_client:
+        _compare_and_set = redis_client.register_script(_COMPARE_AND_SET)
+    return _compare_and_set
+
+
+async def _write(trip: dict, client=None):
+    payload = serialize_trip(trip) if trip.get("status") in ACTIVE_STATUSES else ""
+    return await _script()(
+        keys=_keys(str(trip["_id"])),
+        args=[trip_version(trip), payload, ACTIVE_TRIP_CACHE_TTL_SECONDS],
+        client=client
+    )
+
+
+async def refresh(trip: Optional[dict]):
+    """Ghi (hoặc xóa) bản cache theo trạng thái hiện tại của chuyến đi, trừ khi cache đã có bản mới hơn."""
+    if redis_client is None or not trip:
+        return
+    try:
+        await _write(trip)
+    except Exception as e:
+        logger.warning(f"ActiveTripCache: Lỗi cập nhật cache cho chuyến {trip['_id']}: {e}")
+
+
+async def populate(trip: Optional[dict]):
+    """Nạp lại cache khi đọc trượt; bị bỏ qua nếu chuyến đã đổi (hoặc bị xóa khỏi cache) sau lần đọc này."""
+    if redis_client is None or not trip or trip.get("status") not in ACTIVE_STATUSES:
+        return
+    try:
+        await _write(trip)
+    except Exception as e:
+        logger.warning(f"ActiveTripCache: Lỗi nạp cache cho chuyến {trip['_id']}: {e}")
+
+
+async def evict(trip_id: str):
+    await evict_many([trip_id])
+
+
+async def evict_many(trip_ids: List[str]):
+    """Xóa cache của nhiều chuyến đi trong một pipeline (job hàng loạt), để lại version = thời điểm xóa."""
+    if redis_client is None or not trip_ids:
+        return
+    tombstone = {"status": None, "updated_at": datetime.now(timezone.utc)}
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for trip_id in trip_ids:
+                await _write({**tombstone, "_id": trip_id}, client=pipe)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"ActiveTripCache: Lỗi xóa cache cho {len(trip_ids)} chuyến: {e}")
@@ -0,0 +1,83 @@
+# TripService/archive_trips.py
+"""
+Chuyển chuyến đi COMPLETED/CANCELLED cũ hơn N ngày từ 'trips' sang 'trips_archive' để collection
+nóng đủ nhỏ nằm trong bộ nhớ. Bản lưu trữ bỏ các field chỉ cần lúc chuyến đang chạy
+(notified_driver_ids, rejected_driver_ids, offer_sent_at) và để trống polyline route_info.geometry.
+Đánh giá / trạng thái thanh toán đến muộn vẫn được ghi vào bản lưu trữ (crud._update_trip_any_tier).
+
+Chạy trong container TripService (cần MONGODB_URL), ví dụ mỗi đêm:
+    python archive_trips.py
+    python archive_trips.py --days 30 --batch-size 500
+
+An toàn khi chạy lại: chép sang archive (upsert) trước, sau đó mới xóa khỏi 'trips', và chỉ xóa
+document chưa bị sửa kể từ lúc chép (so khớp updated_at).
+"""
+import argparse
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, DESCENDING, DeleteOne, ReplaceOne
+
+from database import sync_database
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("TRIP_ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVED_STATUSES = ["COMPLETED", "CANCELLED"]
+DROPPED_FIELDS = ("notified_driver_ids", "rejected_driver_ids", "offer_sent_at")
+
+
+def compact_trip(trip: dict, archived_at: datetime) -> dict:
+    archived = {key: value for key, value in trip.items() if key not in DROPPED_FIELDS}
+    if archived.get("route_info"):
+        # Giữ field (RouteInfo.geometry là bắt buộc) nhưng bỏ polyline dài
+        archived["route_info"] = {**archived["route_info"], "geometry": ""}
+    archived["archived_at"] = archived_at
+    return archived
+
+
+def ensure_archive_indexes(archive):
+    archive.create_index([("passenger_id", ASCENDING), ("created_at", DESCENDING)], background=True)
+    archive.create_index([("driver_id", ASCENDING), ("created_at", DESCENDING)], background=True)
+
+
+def archive_trips(days: int = ARCHIVE_AFTER_DAYS, batch_size: int = 1000) -> int:
+    trips = sync_database.get_collection("trips")
+    archive = sync_database.get_collection("trips_archive")
+    ensure_archive_indexes(archive)
+
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    query = {"status": {"$in": ARCHIVED_STATUSES}, "created_at": {"$lt": cutoff}}
+    moved = 0
+
+    while True:
+        batch = list(trips.find(query).sort("created_at", ASCENDING).limit(batch_size))
+        if not batch:
+            break
+        archived_at = datetime.now(timezone.utc)
+        archive.bulk_write(
+            [ReplaceOne({"_id": trip["_id"]}, compact_trip(trip, archived_at), upsert=True) for trip in batch],
+            ordered=False
+        )
+        result = trips.bulk_write(
+            [DeleteOne({"_id": trip["_id"], "updated_at": trip.get("updated_at")}) for trip in batch],
+            ordered=False
+        )
+        moved += result.deleted_count
+        logger.info(f"Đã lưu trữ {result.deleted_count}/{len(batch)} chuyến đi (tổng {moved}).")
+        if result.deleted_count == 0:
+            # Cả lô vừa bị sửa trong lúc chép: để lần chạy sau xử lý, tránh lặp vô hạn
+            break
+
+    logger.info(f"Lưu trữ xong: chuyển {moved} chuyến đi cũ hơn {days} ngày sang trips_archive.")
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chuyển chuyến đi đã kết thúc sang trips_archive")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    archive_trips(days=args.days, batch_size=args.batch_size)
@@ -1,8 +1,18 @@
 from typing import List, Optional, Any, Dict
 from bson import ObjectId
-from database import trips_collection, ratings_collection
+from pymongo import ReturnDocument
+from database import trips_collection, trips_archive_collection, ratings_collection
 import models
 import schemas
+import trip_stats
+import active_trip_cache
+from driver_cache import driver_cache
+from geocoding import geocode_cache
+import surge
+import pricing
+import pickup_eta
+import route_geometry
+from service_token import ServiceTokenManager
 from datetime import datetime
 import requests
 import httpx
@@ -10,7 +20,8 @@ import logging
 import os
 from dotenv import load_dotenv
 from datetime import datetime, timezone, timedelta
-# import polyline  # Uncomment if you install polyline package
+import asyncio
+import heapq
 
 
 load_dotenv()
@@ -24,13 +35,19 @@ USER_SERVICE_URL = os.getenv("USER_SERVICE_URL")
 DRIVER_SERVICE_URL = os.getenv("DRIVER_SERVICE_URL")
 LOCATION_SERVICE_URL = os.getenv("LOCATION_SERVICE_URL")
 
-_service_token_cache: Optional[str] = None
-_token_expiry_time: Optional[datetime] = None
+service_token_manager = ServiceTokenManager(
+    token_url=f"{USER_SERVICE_URL}/auth/token" if USER_SERVICE_URL else None,
+    client_id=MY_CLIENT_ID,
+    client_secret=MY_CLIENT_SECRET
+)
 
 
 
 # Mapbox API configuration
 MAPBOX_ACCESS_TOKEN = os.getenv("MAPBOX_ACCESS_TOKEN")
+GEOCODE_BATCH_CONCURRENCY = int(os.getenv("GEOCODE_BATCH_CONCURRENCY", "5"))
+# Số tài xế nhận lời mời, chọn theo ETA tới điểm đón
+TRIP_OFFER_MAX_DRIVERS = int(os.getenv("TRIP_OFFER_MAX_DRIVERS", "5"))
 LOCATION_SERVICE_URL = os.getenv("LOCATION_SERVICE_URL", "http://locationservice:8000")
 DRIVER_SERVICE_URL = os.getenv("DRIVER_SERVICE_URL", "http://driverservice:8000")
 def convert_objectid(doc):
@@ -39,46 +56,158 @@ def convert_objectid(doc):
         doc["_id"] = str(doc["_id"])
     return doc
 
-async def get_trip_by_id(trip_id: str) -> Optional[dict]:
-    """Get trip by ObjectId"""
+def _trip_after_set(before: dict, set_data: Dict[str, Any]) -> dict:
+    """Dựng lại document sau một lệnh $set (hỗ trợ key dạng 'fare.actual') để tính chênh lệch thống kê."""
+    after = dict(before)
+    for key, value in set_data.items():
+        parts = key.split(".")
+        target = after
+        for part in parts[:-1]:
+            target[part] = dict(target.get(part) or {})
+            target = target[part]
+        target[parts[-1]] = value
+    return after
+
+async def get_trip_by_id(trip_id: str, projection: Optional[dict] = None) -> Optional[dict]:
+    """Get trip by ObjectId (projection: chỉ đọc các field cần thiết)"""
     if not ObjectId.is_valid(trip_id):
         return None
-    doc = await trips_collection.find_one({"_id": ObjectId(trip_id)})
+    doc = await trips_collection.find_one({"_id": ObjectId(trip_id)}, projection)
+    if doc is None:
+        doc = await trips_archive_collection.find_one({"_id": ObjectId(trip_id)}, projection)
     return convert_objectid(doc)
 
-async def get_trips_by_passenger(passenger_id: str, skip: int = 0, limit: int = 100) -> List[dict]:
-    """Get trips by passenger ID"""
-    cursor = trips_collection.find({"passenger_id": passenger_id}).skip(skip).limit(limit).sort("created_at", -1)
-    return await cursor.to_list(length=limit)
-
-async def get_trips_by_driver(driver_id: str, skip: int = 0, limit: int = 100) -> List[dict]:
-    """Get trips by driver ID"""
-    cursor = trips_collection.find({"driver_id": driver_id}).skip(skip).limit(limit).sort("created_at", -1)
-    return await cursor.to_list(length=limit)
+async def _update_trip_any_tier(trip_id: str, update: dict, extra_filter: Optional[dict] = None) -> Optional[dict]:
+    """
+    find_one_and_update (trả về document TRƯỚC khi sửa) trên 'trips', không thấy thì trên 'trips_archive':
+    chuyến đã lưu trữ vẫn nhận được đánh giá / trạng thái thanh toán đến muộn.
+    """
+    query = {"_id": ObjectId(trip_id), **(extra_filter or {})}
+    for collection in (trips_collection, trips_archive_collection):
+        trip_before = await collection.find_one_and_update(query, update, return_document=ReturnDocument.BEFORE)
+        if trip_before is not None:
+            return trip_before
+    return None
 
-async def get_available_trips(skip: int = 0, limit: int = 100) -> List[dict]:
+async def get_trips_by_ids(trip_ids: List[str], projection: Optional[dict] = None) -> List[dict]:
+    """Đọc nhiều chuyến đi theo id trong một lượt ($in), chuyến không có ở 'trips' thì tìm trong 'trips_archive'."""
+    object_ids = [ObjectId(trip_id) for trip_id in dict.fromkeys(trip_ids) if ObjectId.is_valid(trip_id)]
+    if not object_ids:
+        return []
+    hot = await trips_collection.find({"_id": {"$in": object_ids}}, projection).to_list(length=len(object_ids))
+    found = {doc["_id"] for doc in hot}
+    missing = [object_id for object_id in object_ids if object_id not in found]
+    archived = []
+    if missing:
+        archived = await trips_archive_collection.find({"_id": {"$in": missing}}, projection).to_list(length=len(missing))
+    return [convert_objectid(doc) for doc in hot + archived]
+
+def build_trip_event(trip: dict, status_changed: bool, driver_info: Optional[dict] = None) -> Dict[str, Any]:
+    """
+    Payload sự kiện gửi cho hành khách và tài xế trong phòng của chuyến đi (trip_events và báo trực tiếp).
+    (trip_id, type, updated_at) là khóa khử trùng phía client.
+    """
+    status = trip.get("status")
+    if status_changed and status == models.TripStatusEnum.ACCEPTED.value:
+        event_type = "DRIVER_ASSIGNED"
+    elif status_changed:
+        event_type = "TRIP_STATUS_CHANGED"
+    else:
+        event_type = "TRIP_UPDATED"
+
+    updated_at = trip.get("updated_at")
+    payload = {
+        "type": event_type,
+        "trip_id": str(trip["_id"]),
+        "status": status,
+        "driver_id": trip.get("driver_id") or None,
+        "fare": trip.get("fare"),
+        "payment_status": (trip.get("payment") or {}).get("status"),
+        "updated_at": updated_at.isoformat() if isinstance(updated_at, datetime) else updated_at,
+    }
+    if status == models.TripStatusEnum.CANCELLED.value and trip.get("cancellation"):
+        cancellation = trip["cancellation"]
+        payload["cancellation"] = {"cancelled_by": cancellation.get("cancelled_by"), "reason": cancellation.get("reason")}
+    if event_type == "DRIVER_ASSIGNED":
+        payload["driver_info"] = driver_info or {"name": "Tài xế", "vehicle": {"license_plate": "N/A"}}
+    return payload
+
+async def reload_trip(trip_id: str) -> Optional[dict]:
+    """Đọc lại chuyến đi sau khi thay đổi và ghi vào cache chuyến đi đang hoạt động (write-through)."""
+    trip = await get_trip_by_id(trip_id)
+    await active_trip_cache.refresh(trip)
+    return trip
+
+async def _find_across_tiers(query: dict, skip: int, limit: int, projection: Optional[dict] = None) -> List[dict]:
+    """Đọc lịch sử chuyến đi từ cả 'trips' và 'trips_archive', sắp xếp created_at giảm dần."""
+    window = skip + limit
+    if projection is not None:
+        projection = {**projection, "created_at": 1}  # cần để trộn hai tầng
+    hot, archived = await asyncio.gather(
+        trips_collection.find(query, projection).sort("created_at", -1).limit(window).to_list(length=window),
+        trips_archive_collection.find(query, projection).sort("created_at", -1).limit(window).to_list(length=window)
+    )
+    # archive_trips chép sang 'trips_archive' trước rồi mới xóa khỏi 'trips' (và bỏ qua chuyến vừa bị sửa),
+    # nên một chuyến có thể nằm ở cả hai tầng: giữ bản trong 'trips' (mới nhất)
+    hot_ids = {trip["_id"] for trip in hot}
+    archived = [trip for trip in archived if trip["_id"] not in hot_ids]
+    if not archived:
+        return hot[skip:]
+    merged = heapq.merge(hot, archived, key=lambda trip: trip["created_at"], reverse=True)
+    return list(merged)[skip:window]
+
+async def get_trips_by_passenger(passenger_id: str, skip: int = 0, limit: int = 100, projection: Optional[dict] = None) -> List[dict]:
+    """Get trips by passenger ID (cả chuyến đi đã lưu trữ)"""
+    return await _find_across_tiers({"passenger_id": passenger_id}, skip, limit, projection)
+
+async def get_trips_by_driver(driver_id: str, skip: int = 0, limit: int = 100, projection: Optional[dict] = None) -> List[dict]:
+    """Get trips by driver ID (cả chuyến đi đã lưu trữ)"""
+    return await _find_across_tiers({"driver_id": driver_id}, skip, limit, projection)
+
+async def get_available_trips(skip: int = 0, limit: int = 100, projection: Optional[dict] = None) -> List[dict]:
     """Get available trips (status = PENDING)"""
-    cursor = trips_collection.find({"status": models.TripStatusEnum.PENDING.value}).skip(skip).limit(limit).sort("created_at", -1)
+    cursor = trips_collection.find({"status": models.TripStatusEnum.PENDING.value}, projection).skip(skip).limit(limit).sort("created_at", -1)
     return await cursor.to_list(length=limit)
 
-async def get_trips_near_location(longitude: float, latitude: float, max_distance: int = 5000, limit: int = 50) -> List[dict]:
-    """Get trips near specific location using GeoJSON"""
-    cursor = trips_collection.find({
-        "pickup.location": {
-            "$near": {
-                "$geometry": {
-                    "type": "Point",
-                    "coordinates": [longitude, latitude]
-                },
-                "$maxDistance": max_distance  
+async def ensure_geo_index():
+    """$geoNear cần 2dsphere index trên pickup.location; gọi lúc khởi động."""
+    await trips_collection.create_index([("pickup.location", "2dsphere")], background=True)
+
+async def get_trips_near_location(
+    longitude: float,
+    latitude: float,
+    max_distance: int = 5000,
+    limit: int = 50,
+    vehicle_types: Optional[List[models.VehicleTypeEnum]] = None,
+    projection: Optional[dict] = None
+) -> List[dict]:
+    """Chuyến đi PENDING gần vị trí, gần nhất trước, kèm 'distance_m' (mét) tới điểm đón."""
+    query = {"status": models.TripStatusEnum.PENDING.value}
+    if vehicle_types:
+        query["vehicle_type"] = {"$in": [vehicle_type.value for vehicle_type in vehicle_types]}
+    pipeline = [
+        {
+            "$geoNear": {
+                "near": {"type": "Point", "coordinates": [longitude, latitude]},
+                "key": "pickup.location",
+                "distanceField": "distance_m",
+                "maxDistance": max_distance,
+                "query": query,
+                "spherical": True
             }
         },
-        "status": models.TripStatusEnum.PENDING.value
-    }).limit(limit)
-    return await cursor.to_list(length=limit)
+        {"$limit": limit}
+    ]
+    if projection is not None:
+        pipeline.append({"$project": {**projection, "distance_m": 1}})
+    return await trips_collection.aggregate(pipeline).to_list(length=limit)
 
 async def get_coordinates(location_name: str) -> tuple | None:
-    """Hàm này nhận tên một địa điểm và trả về tọa độ (kinh độ, vĩ độ)."""
+    """Hàm này nhận tên một địa điểm và trả về tọa độ (kinh độ, vĩ độ), ưu tiên cache."""
+    cached_coords = await geocode_cache.get(location_name)
+    if cached_coords is not None:
+        return cached_coords or None  # NOT_FOUND: Mapbox đã không tìm thấy địa chỉ này gần đây
+
     if not MAPBOX_ACCESS_TOKEN:
         logger.error("Mapbox access token not configured")
         return None
@@ -101,15 +230,45 @@ async def get_coordinates(location_name: str) -> tuple | None:
         
         if data.get("features"):
             coords = data["features"][0]["geometry"]["coordinates"]
+            await geocode_cache.set(location_name, (coords[0], coords[1]))
             return (coords[0], coords[1])  
         else:
             logger.warning(f"Mapbox: No features found for location: {location_name}")
+            await geocode_cache.set_not_found(location_name)
             return None
             
-    except httpx.RequestError as e:
+    except httpx.HTTPError as e:
+        # Lỗi kết nối hoặc Mapbox trả lỗi HTTP (vd: 429 hết hạn mức)
         logger.error(f"Mapbox API (Geocoding) error: {e}")
         raise e # Ném lỗi ra để main.py bắt
 
+async def geocode_addresses(addresses: List[str], save_as_places: bool = False) -> List[Dict[str, Any]]:
+    """Geocode nhiều địa chỉ song song (giới hạn số request Mapbox đồng thời)."""
+    semaphore = asyncio.Semaphore(GEOCODE_BATCH_CONCURRENCY)
+
+    async def _geocode_one(address: str):
+        async with semaphore:
+            try:
+                return await get_coordinates(address)
+            except httpx.HTTPError:
+                # Một địa chỉ lỗi (kể cả 429/5xx của Mapbox) chỉ làm địa chỉ đó found=False, không hỏng cả lô
+                return None
+
+    coords_list = await asyncio.gather(*[_geocode_one(address) for address in addresses])
+
+    results = []
+    found_places = []
+    for address, coords in zip(addresses, coords_list):
+        if coords:
+            found_places.append((address, coords))
+            results.append({"address": address, "longitude": coords[0], "latitude": coords[1], "found": True})
+        else:
+            results.append({"address": address, "longitude": None, "latitude": None, "found": False})
+
+    if save_as_places:
+        await geocode_cache.save_places(found_places)
+    return results
+
 
 async def get_route_info(pickup_coords: tuple[float, float], dropoff_coords: tuple[float, float], vehicle_type: models.VehicleTypeEnum) -> dict | None:
     """Get route information from Mapbox Directions API"""
@@ -143,7 +302,7 @@ async def get_route_info(pickup_coords: tuple[float, float], dropoff_coords: tup
             return {
                 "distance": route["distance"],  # meters
                 "duration": route["duration"],  # seconds
-                "geometry": route["geometry"]   # encoded polyline
+                "geometry": route_geometry.simplify_polyline(route["geometry"])  # encoded polyline (đã rút gọn)
             }
         else:
             logger.warning("Mapbox: No routes found")
@@ -152,59 +311,50 @@ async def get_route_info(pickup_coords: tuple[float, float], dropoff_coords: tup
         logger.error(f"Mapbox API (Directions) error: {e}")
         raise e # Ném lỗi ra
 
-def calculate_estimated_fare(distance_meters: float, vehicle_type: models.VehicleTypeEnum) -> float:
-    """Calculate estimated fare based on distance and vehicle type"""
-    # TODO: Implement your fare calculation logic here
-    # Base fare + distance-based pricing + vehicle type multiplier
-    
-    distance_km = distance_meters / 1000
-    
-    # Base fare by vehicle type
-    base_fares = {
-        models.VehicleTypeEnum.TWO_SEATER: 15000,   # 2 chỗ
-        models.VehicleTypeEnum.FOUR_SEATER: 20000,  # 4 chỗ
-        models.VehicleTypeEnum.SEVEN_SEATER: 30000  # 7 chỗ
-    }
-    
-    # Per km rate by vehicle type
-    per_km_rates = {
-        models.VehicleTypeEnum.TWO_SEATER: 8000,    # 2 chỗ
-        models.VehicleTypeEnum.FOUR_SEATER: 10000,  # 4 chỗ
-        models.VehicleTypeEnum.SEVEN_SEATER: 15000  # 7 chỗ
-    }
-    
-    base_fare = base_fares.get(vehicle_type, 20000)
-    per_km_rate = per_km_rates.get(vehicle_type, 10000)
-    
-    estimated_fare = base_fare + (distance_km * per_km_rate)
-    
-    # Round to nearest 1000 VND
-    return round(estimated_fare / 1000) * 1000
+def calculate_estimated_fare(distance_meters: float, vehicle_type: models.VehicleTypeEnum, surge_multiplier: float = 1.0) -> float:
+    """Calculate estimated fare based on distance, vehicle type and surge multiplier (bảng giá dùng chung, xem pricing.py)"""
+    return pricing.quote(distance_meters / 1000, vehicle_type, surge_multiplier=surge_multiplier).total_fare
 
 async def estimate_fare_for_all_vehicles(pickup_coords: tuple[float, float], dropoff_coords: tuple[float, float]) -> List[dict]:
     """Estimate fare for all 3 vehicle types"""
     estimates = []
-    
-    for vehicle_type in [models.VehicleTypeEnum.TWO_SEATER, models.VehicleTypeEnum.FOUR_SEATER, models.VehicleTypeEnum.SEVEN_SEATER]:
-        # Get route info for this vehicle type
-        route_info = await get_route_info(pickup_coords, dropoff_coords, vehicle_type)
-        
+    # get_route_info chỉ khác tham số cho xe 2 chỗ (exclude motorway) -> xe 4 và 7 chỗ dùng chung một lệnh gọi Mapbox
+    # Hệ số surge của ô điểm đón (một HGET), đồng thời ghi nhận nhu cầu cho surge engine
+    surge_multiplier, two_seater_route, car_route = await asyncio.gather(
+        surge.get_multiplier(pickup_coords[0], pickup_coords[1], record_demand=True),
+        get_route_info(pickup_coords, dropoff_coords, models.VehicleTypeEnum.TWO_SEATER),
+        get_route_info(pickup_coords, dropoff_coords, models.VehicleTypeEnum.FOUR_SEATER)
+    )
+    routes = {
+        models.VehicleTypeEnum.TWO_SEATER: two_seater_route,
+        models.VehicleTypeEnum.FOUR_SEATER: car_route,
+        models.VehicleTypeEnum.SEVEN_SEATER: car_route,
+    }
+
+    first_vehicle_by_geometry: Dict[str, models.VehicleTypeEnum] = {}
+    for vehicle_type, route_info in routes.items():
         if route_info:
             # Calculate fare
-            estimated_fare = calculate_estimated_fare(route_info["distance"], vehicle_type)
+            estimated_fare = calculate_estimated_fare(route_info["distance"], vehicle_type, surge_multiplier)
             
-            # Let FE handle polyline decoding
-            route_geometry = {
-                "type": "LineString",
-                "encoded_polyline": route_info["geometry"]  # FE will decode this to coordinates
-            }
+            # Let FE handle polyline decoding; tuyến trùng với loại xe trước chỉ trỏ tới loại xe đó
+            same_as = first_vehicle_by_geometry.get(route_info["geometry"])
+            if same_as is None:
+                first_vehicle_by_geometry[route_info["geometry"]] = vehicle_type
+                route_geometry = {
+                    "type": "LineString",
+                    "encoded_polyline": route_info["geometry"]  # FE will decode this to coordinates
+                }
+            else:
+                route_geometry = {"type": "LineString", "same_as": same_as.value}
             
             estimates.append({
                 "vehicle_type": vehicle_type,
                 "estimated_fare": estimated_fare,
                 "distance_meters": route_info["distance"],
                 "duration_seconds": route_info["duration"],
-                "route_geometry": route_geometry
+                "route_geometry": route_geometry,
+                "surge_multiplier": surge_multiplier
             })
     
     return estimates
@@ -230,7 +380,8 @@ async def create_trip_request_complete(trip_request: schemas.TripRequestComplete
     if not route_info_data:
         raise ValueError("Could not calculate route between coordinates")
     route_info = models.RouteInfo(**route_info_data)
-    estimated_fare = calculate_estimated_fare(route_info_data["distance"], trip_request.vehicle_type)
+    surge_multiplier = await surge.get_multiplier(pickup_coords[0], pickup_coords[1])
+    estimated_fare = calculate_estimated_fare(route_info_data["distance"], trip_request.vehicle_type, surge_multiplier)
     fare_info = models.FareInfo(estimated=estimated_fare)
     payment_info = models.PaymentInfo(
         method=trip_request.payment_method,
@@ -246,6 +397,7 @@ async def create_trip_request_complete(trip_request: schemas.TripRequestComplete
         dropoff=dropoff_location,
         created_at=datetime.now(timezone.utc), 
         fare=fare_info,
+        surge_multiplier=surge_multiplier,
         route_info=route_info,
         payment=payment_info,
         history=initial_history,
@@ -255,12 +407,14 @@ async def create_trip_request_complete(trip_request: schemas.TripRequestComplete
         offer_sent_at=None 
     )
     trip_dict = trip_obj.model_dump(by_alias=True, exclude={"id"})
+    trip_dict["updated_at"] = trip_dict["created_at"]
 
     try:
         result = await trips_collection.insert_one(trip_dict)
         trip_id = str(result.inserted_id)
         trip_dict["_id"] = trip_id
         logger.info(f"Đã tạo chuyến đi mới với ID: {trip_id}")
+        await trip_stats.record_trip_change(None, trip_dict)
     except Exception as e:
          logger.error(f"Lỗi khi insert chuyến đi vào DB: {e}", exc_info=True)
          raise HTTPException(status_code=500, detail="Lỗi server khi tạo chuyến đi.")
@@ -269,8 +423,13 @@ async def create_trip_request_complete(trip_request: schemas.TripRequestComplete
         trip_request.pickup.longitude
     )
     if nearby_drivers_raw:
-        driver_ids = [driver['driver_id'] for driver in nearby_drivers_raw]
-        logger.info(f"Tìm thấy {len(driver_ids)} tài xế gần đó cho chuyến đi {trip_id}. Bắt đầu mời...")
+        ranked_drivers = await pickup_eta.rank_drivers_by_eta(
+            trip_request.pickup.longitude,
+            trip_request.pickup.latitude,
+            nearby_drivers_raw
+        )
+        driver_ids = [driver['driver_id'] for driver in ranked_drivers[:TRIP_OFFER_MAX_DRIVERS]]
+        logger.info(f"Tìm thấy {len(nearby_drivers_raw)} tài xế gần đó cho chuyến đi {trip_id}, mời {len(driver_ids)} tài xế có ETA tốt nhất...")
         await add_notified_drivers_to_trip(trip_id, driver_ids)
         trip_payload = {
             "type": "TRIP_OFFER",
@@ -293,14 +452,16 @@ async def create_trip_request_complete(trip_request: schemas.TripRequestComplete
              logger.error(f"Lỗi khi cập nhật offer_sent_at cho chuyến đi {trip_id}: {e}")
     else:
         logger.warning(f"Không tìm thấy tài xế nào cho chuyến đi {trip_id} khi tạo.")
-    final_trip_data = await get_trip_by_id(trip_id)
+    final_trip_data = await reload_trip(trip_id)
     return final_trip_data if final_trip_data else trip_dict
 
 async def create_trip_request(trip_request: schemas.TripRequest) -> dict:
     """Create new trip request from passenger (using Mapbox APIs)"""
-    # Get coordinates from addresses using Mapbox Geocoding API
-    pickup_coords = await get_coordinates(trip_request.pickup.address)
-    dropoff_coords = await get_coordinates(trip_request.dropoff.address)
+    # Get coordinates from addresses using Mapbox Geocoding API (song song, có cache)
+    pickup_coords, dropoff_coords = await asyncio.gather(
+        get_coordinates(trip_request.pickup.address),
+        get_coordinates(trip_request.dropoff.address)
+    )
     
     if not pickup_coords or not dropoff_coords:
         raise ValueError("Could not geocode one or both addresses")
@@ -318,8 +479,9 @@ async def create_trip_request(trip_request: schemas.TripRequest) -> dict:
         geometry=route_info_data["geometry"]
     )
     
-    # Calculate estimated fare based on distance and vehicle type
-    estimated_fare = calculate_estimated_fare(route_info_data["distance"], trip_request.vehicle_type)
+    # Calculate estimated fare based on distance, vehicle type and surge của ô điểm đón
+    surge_multiplier = await surge.get_multiplier(pickup_coords[0], pickup_coords[1])
+    estimated_fare = calculate_estimated_fare(route_info_data["distance"], trip_request.vehicle_type, surge_multiplier)
     
     # Convert addresses to LocationInfo with Mapbox coordinates
     pickup_location = models.LocationInfo(
@@ -360,6 +522,7 @@ async def create_trip_request(trip_request: schemas.TripRequest) -> dict:
         dropoff=dropoff_location,
         created_at=datetime.now(),  # Explicitly set created_at
         fare=fare_info,
+        surge_multiplier=surge_multiplier,  # PaymentService tính giá khi hoàn thành theo hệ số này
         route_info=route_info,  # Add route information
         payment=payment_info,  # Add payment information
         history=initial_history,
@@ -368,12 +531,14 @@ async def create_trip_request(trip_request: schemas.TripRequest) -> dict:
     
     # Convert to dict for MongoDB - exclude the id field to let MongoDB generate it
     trip_dict = trip_obj.model_dump(by_alias=True, exclude={"id"})
+    trip_dict["updated_at"] = trip_dict["created_at"]
     
     # Insert to database
     result = await trips_collection.insert_one(trip_dict)
     
     # Add the inserted ID to the dict and return it directly
     trip_dict["_id"] = str(result.inserted_id)
+    await trip_stats.record_trip_change(None, trip_dict)
     return trip_dict
 
 async def assign_driver_to_trip(trip_id: str, driver_id: str) -> Optional[dict]:
@@ -419,27 +584,31 @@ async def assign_driver_to_trip(trip_id: str, driver_id: str) -> Optional[dict]:
         "status": models.TripStatusEnum.ACCEPTED.value,
         "timestamp": datetime.now(timezone.utc) 
     }
+    set_data = {
+        "driver_id": driver_id,
+        "status": models.TripStatusEnum.ACCEPTED.value,
+        "updated_at": datetime.now(timezone.utc)
+    }
     try:
-        result = await trips_collection.update_one(
+        trip_before = await trips_collection.find_one_and_update(
             {"_id": ObjectId(trip_id), "status": models.TripStatusEnum.PENDING.value},
             {
-                "$set": {
-                    "driver_id": driver_id,
-                    "status": models.TripStatusEnum.ACCEPTED.value
-                },
+                "$set": set_data,
                 "$push": {"history": new_history_entry}
-            }
+            },
+            return_document=ReturnDocument.BEFORE
         )
     except Exception as e:
-        logger.error(f"Lỗi khi update_one để gán tài xế {driver_id} cho chuyến {trip_id}: {e}")
+        logger.error(f"Lỗi khi update để gán tài xế {driver_id} cho chuyến {trip_id}: {e}")
         return None 
 
-    if result.modified_count == 0:
+    if trip_before is None:
         logger.warning(f"Tài xế {driver_id} THẤT BẠI khi nhận chuyến {trip_id} (Race condition - người khác nhanh hơn).")
         return None
+    await trip_stats.record_trip_change(trip_before, _trip_after_set(trip_before, set_data))
     
     logger.info(f"Tài xế {driver_id} THÀNH CÔNG nhận chuyến {trip_id} (Thắng race condition).")
-    updated_trip = await get_trip_by_id(trip_id) 
+    updated_trip = await reload_trip(trip_id) 
     if not updated_trip: return None 
     notified_ids = updated_trip.get("notified_driver_ids", [])
     winner_id = driver_id
@@ -449,12 +618,13 @@ async def assign_driver_to_trip(trip_id: str, driver_id: str) -> Optional[dict]:
         cancel_payload = {"type": "TRIP_CANCELLED", "trip_id": trip_id, "reason": "Đã được tài xế khác nhận"}
         await notify_drivers_via_location_service(loser_ids, cancel_payload)
 
+    # Báo trực tiếp cho hành khách. trip_events cũng phát DRIVER_ASSIGNED với cùng payload (updated_at đọc
+    # lại từ MongoDB như change stream), client bỏ bản trùng theo (trip_id, type, updated_at)
     logger.info(f"Lấy thông tin tài xế {winner_id} để báo cho hành khách.")
     driver_details = await get_driver_details_from_driver_service(winner_id)
-    if driver_details is None: driver_details = {"name": "Tài xế", "vehicle": {"license_plate": "N/A"}}
 
     logger.info(f"Thông báo 'DRIVER_ASSIGNED' cho hành khách chuyến {trip_id}.")
-    passenger_payload = {"type": "DRIVER_ASSIGNED", "trip_id": trip_id, "driver_info": driver_details}
+    passenger_payload = build_trip_event(updated_trip, status_changed=True, driver_info=driver_details)
     await notify_passenger_via_location_service(trip_id, passenger_payload)
 
     return updated_trip
@@ -470,36 +640,35 @@ async def deny_trip(trip_id: str, driver_id: str) -> Optional[dict]:
         "timestamp": datetime.now()
     }
     
-    result = await trips_collection.update_one(
+    set_data = {
+        "driver_id": "",  # Remove driver
+        "status": models.TripStatusEnum.PENDING.value,
+        "updated_at": datetime.now(timezone.utc)
+    }
+    trip_before = await trips_collection.find_one_and_update(
         {
             "_id": ObjectId(trip_id), 
             "status": models.TripStatusEnum.ACCEPTED.value,
             "driver_id": driver_id
         },
         {
-            "$set": {
-                "driver_id": "",  # Remove driver
-                "status": models.TripStatusEnum.PENDING.value
-            },
+            "$set": set_data,
             "$push": {"history": new_history_entry}
-        }
+        },
+        return_document=ReturnDocument.BEFORE
     )
     
-    if result.modified_count == 0:
+    if trip_before is None:
         return None
+    await trip_stats.record_trip_change(trip_before, _trip_after_set(trip_before, set_data))
         
-    return await get_trip_by_id(trip_id)
+    return await reload_trip(trip_id)
 
 async def update_trip_status(trip_id: str, new_status: models.TripStatusEnum) -> Optional[dict]:
     """Update trip status and add to history"""
     if not ObjectId.is_valid(trip_id):
         return None
     
-    # Get current trip
-    current_trip = await get_trip_by_id(trip_id)
-    if not current_trip:
-        return None
-    
     # Create new status history entry
     new_history_entry = {
         "status": new_status.value,
@@ -508,7 +677,8 @@ async def update_trip_status(trip_id: str, new_status: models.TripStatusEnum) ->
     
     # Prepare update data
     set_data = {
-        "status": new_status.value
+        "status": new_status.value,
+        "updated_at": datetime.now(timezone.utc)
     }
     
     # Add specific timestamp fields based on status
@@ -517,18 +687,20 @@ async def update_trip_status(trip_id: str, new_status: models.TripStatusEnum) ->
     elif new_status == models.TripStatusEnum.COMPLETED:
         set_data["endTime"] = datetime.now()
     
-    # Update with both $set and $push operations
-    result = await trips_collection.update_one(
+    # Update with both $set and $push operations (lấy document trước khi update để cập nhật thống kê)
+    trip_before = await trips_collection.find_one_and_update(
         {"_id": ObjectId(trip_id)},
         {
             "$set": set_data,
             "$push": {"history": new_history_entry}
-        }
+        },
+        return_document=ReturnDocument.BEFORE
     )
     
-    if result.modified_count:
-        return await get_trip_by_id(trip_id)
-    return None
+    if trip_before is None:
+        return None
+    await trip_stats.record_trip_change(trip_before, _trip_after_set(trip_before, set_data))
+    return await reload_trip(trip_id)
 
 async def update_trip_fare(trip_id: str, actual_fare: float, discount: float = 0, tax: float = 0) -> Optional[dict]:
     """Update trip fare information"""
@@ -538,17 +710,20 @@ async def update_trip_fare(trip_id: str, actual_fare: float, discount: float = 0
     update_data = {
         "fare.actual": actual_fare,
         "fare.discount": discount,
-        "fare.tax": tax
+        "fare.tax": tax,
+        "updated_at": datetime.now(timezone.utc)
     }
     
-    result = await trips_collection.update_one(
+    trip_before = await trips_collection.find_one_and_update(
         {"_id": ObjectId(trip_id)},
-        {"$set": update_data}
+        {"$set": update_data},
+        return_document=ReturnDocument.BEFORE
     )
     
-    if result.modified_count:
-        return await get_trip_by_id(trip_id)
-    return None
+    if trip_before is None:
+        return None
+    await trip_stats.record_trip_change(trip_before, _trip_after_set(trip_before, update_data))
+    return await reload_trip(trip_id)
 
 async def add_payment_info(trip_id: str, payment: schemas.PaymentCreate) -> Optional[dict]:
     """Add payment information to trip"""
@@ -561,14 +736,12 @@ async def add_payment_info(trip_id: str, payment: schemas.PaymentCreate) -> Opti
         status=models.PaymentStatusEnum.PENDING
     )
     
-    result = await trips_collection.update_one(
-        {"_id": ObjectId(trip_id)},
-        {"$set": {"payment": payment_data.dict()}}
+    trip_before = await _update_trip_any_tier(
+        trip_id, {"$set": {"payment": payment_data.dict(), "updated_at": datetime.now(timezone.utc)}}
     )
-    
-    if result.modified_count:
-        return await get_trip_by_id(trip_id)
-    return None
+    if trip_before is None:
+        return None
+    return await reload_trip(trip_id)
 
 async def update_payment_status(trip_id: str, payment_update: schemas.PaymentUpdate) -> Optional[dict]:
     """Update payment status"""
@@ -576,7 +749,8 @@ async def update_payment_status(trip_id: str, payment_update: schemas.PaymentUpd
         return None
     
     update_data = {
-        "payment.status": payment_update.status.value
+        "payment.status": payment_update.status.value,
+        "updated_at": datetime.now(timezone.utc)
     }
     
     if payment_update.transaction_id:
@@ -587,14 +761,10 @@ async def update_payment_status(trip_id: str, payment_update: schemas.PaymentUpd
     elif payment_update.status == models.PaymentStatusEnum.SUCCESS:
         update_data["payment.paid_at"] = datetime.now()
     
-    result = await trips_collection.update_one(
-        {"_id": ObjectId(trip_id)},
-        {"$set": update_data}
-    )
-    
-    if result.modified_count:
-        return await get_trip_by_id(trip_id)
-    return None
+    trip_before = await _update_trip_any_tier(trip_id, {"$set": update_data})
+    if trip_before is None:
+        return None
+    return await reload_trip(trip_id)
 
 async def add_trip_rating(trip_id: str, rating: schemas.RatingCreate) -> Optional[dict]:
     """Add rating to trip (embedded)"""
@@ -607,14 +777,14 @@ async def add_trip_rating(trip_id: str, rating: schemas.RatingCreate) -> Optiona
         rated_at=datetime.now()
     )
     
-    result = await trips_collection.update_one(
-        {"_id": ObjectId(trip_id)},
-        {"$set": {"rating": rating_data.dict()}}
-    )
+    set_data = {"rating": rating_data.dict(), "updated_at": datetime.now(timezone.utc)}
+    # Chỉ ghi khi chưa có đánh giá: hai request đánh giá đồng thời không ghi đè nhau
+    trip_before = await _update_trip_any_tier(trip_id, {"$set": set_data}, {"rating": None})
     
-    if result.modified_count:
-        return await get_trip_by_id(trip_id)
-    return None
+    if trip_before is None:
+        return None
+    await trip_stats.record_trip_change(trip_before, _trip_after_set(trip_before, set_data))
+    return await reload_trip(trip_id)
 
 async def cancel_trip(trip_id: str, cancellation: schemas.CancellationCreate) -> Optional[dict]:
     """Cancel trip with reason"""
@@ -627,81 +797,47 @@ async def cancel_trip(trip_id: str, cancellation: schemas.CancellationCreate) ->
         cancelled_at=datetime.now()
     )
     
-    result = await trips_collection.update_one(
+    set_data = {
+        "status": models.TripStatusEnum.CANCELLED.value,
+        "cancellation": cancellation_data.dict(),
+        "updated_at": datetime.now(timezone.utc),
+    }
+    trip_before = await trips_collection.find_one_and_update(
         {"_id": ObjectId(trip_id)},
         {
-            "$set": {
-                "status": models.TripStatusEnum.CANCELLED.value,
-                "cancellation": cancellation_data.dict(),
-            },
+            "$set": set_data,
             "$push": {
                 "history": {
                     "status": models.TripStatusEnum.CANCELLED.value,
                     "timestamp": datetime.now()
                 }
             }
-        }
+        },
+        return_document=ReturnDocument.BEFORE
     )
     
-    if result.modified_count:
-        return await get_trip_by_id(trip_id)
-    return None
+    if trip_before is None:
+        return None
+    await trip_stats.record_trip_change(trip_before, _trip_after_set(trip_before, set_data))
+    return await reload_trip(trip_id)
 
 async def delete_trip(trip_id: str) -> bool:
     """Delete trip"""
     if not ObjectId.is_valid(trip_id):
         return False
     
-    result = await trips_collection.delete_one({"_id": ObjectId(trip_id)})
-    return result.deleted_count > 0
+    deleted_trip = await trips_collection.find_one_and_delete({"_id": ObjectId(trip_id)})
+    if deleted_trip is None:
+        return False
+    await trip_stats.record_trip_change(deleted_trip, None)
+    await active_trip_cache.evict(trip_id)
+    return True
 
 async def get_trip_statistics(driver_id: Optional[str] = None, passenger_id: Optional[str] = None) -> dict:
-    """Get trip statistics"""
-    match_condition = {}
-    
+    """Get trip statistics (đọc bộ đếm trong trip_stats, O(1))"""
     if driver_id:
-        match_condition["driver_id"] = driver_id
-    if passenger_id:
-        match_condition["passenger_id"] = passenger_id
-    
-    pipeline = [
-        {"$match": match_condition},
-        {
-            "$group": {
-                "_id": None,
-                "total_trips": {"$sum": 1},
-                "completed_trips": {
-                    "$sum": {
-                        "$cond": [{"$eq": ["$status", "COMPLETED"]}, 1, 0]
-                    }
-                },
-                "cancelled_trips": {
-                    "$sum": {
-                        "$cond": [{"$eq": ["$status", "CANCELLED"]}, 1, 0]
-                    }
-                },
-                "total_revenue": {
-                    "$sum": {
-                        "$cond": [
-                            {"$eq": ["$status", "COMPLETED"]},
-                            "$fare.actual",
-                            0
-                        ]
-                    }
-                },
-                "average_rating": {"$avg": "$rating.stars"}
-            }
-        }
-    ]
-    
-    result = await trips_collection.aggregate(pipeline).to_list(length=1)
-    return result[0] if result else {
-        "total_trips": 0,
-        "completed_trips": 0, 
-        "cancelled_trips": 0,
-        "total_revenue": 0,
-        "average_rating": None
-    }
+        return await trip_stats.get_stats("driver", driver_id)
+    return await trip_stats.get_stats("passenger", passenger_id)
     
 async def find_nearby_drivers_from_location_service(latitude: float, longitude: float) -> List[Dict[str, Any]]:
     search_radii = [3, 7, 15] 
@@ -776,9 +912,14 @@ async def notify_passenger_via_location_service(trip_id: str, payload: Dict[str,
 
 
 async def get_driver_details_from_driver_service(driver_id: str) -> Optional[Dict[str, Any]]:
-    """Lấy thông tin tài xế từ DriverService (dùng OAuth2 Service Token)."""
+    """Lấy thông tin tài xế từ DriverService (dùng OAuth2 Service Token), có cache read-through."""
 
-    service_token = await _get_service_token()
+    cached_details = await driver_cache.get(driver_id)
+    if cached_details is not None:
+        logger.info(f"Lấy thông tin tài xế {driver_id} từ cache.")
+        return cached_details
+
+    service_token = await service_token_manager.get_token()
     if not service_token:
         logger.error("Không thể lấy Service Token để gọi DriverService.")
         return None 
@@ -795,12 +936,12 @@ async def get_driver_details_from_driver_service(driver_id: str) -> Optional[Dic
             response = await client.get(url, headers=headers, timeout=5.0)
 
             if response.status_code == 200:
-                return response.json()
+                driver_details = response.json()
+                await driver_cache.set(driver_id, driver_details)
+                return driver_details
             elif response.status_code == 401 or response.status_code == 403:
                  logger.error(f"Lỗi gọi DriverService: Service Token không hợp lệ hoặc bị từ chối.")
-                 global _service_token_cache, _token_expiry_time
-                 _service_token_cache = None
-                 _token_expiry_time = None
+                 service_token_manager.invalidate(service_token)
                  return None
             else:
                 logger.warning(f"DriverService trả lỗi {response.status_code} khi lấy thông tin {driver_id}")
@@ -814,66 +955,25 @@ async def add_notified_drivers_to_trip(trip_id: str, driver_ids: List[str]):
     if not ObjectId.is_valid(trip_id) or not driver_ids:
         return
     
-    await trips_collection.update_one(
+    trip = await trips_collection.find_one_and_update(
         {"_id": ObjectId(trip_id)},
-        {"$set": {"notified_driver_ids": driver_ids}}
+        {"$set": {"notified_driver_ids": driver_ids}},
+        return_document=ReturnDocument.AFTER
     )
+    await active_trip_cache.refresh(convert_objectid(trip))
 
 async def reject_trip_by_driver(trip_id: str, driver_id: str) -> bool:
     if not ObjectId.is_valid(trip_id):
         return False
         
-    result = await trips_collection.update_one(
-        {"_id": ObjectId(trip_id)},
-        {"$addToSet": {"rejected_driver_ids": driver_id}} 
+    # Lọc rejected_driver_ids != driver_id: từ chối lặp lại không đổi gì (như $addToSet không sửa).
+    # Không set updated_at (cập nhật nội bộ, trip_events bỏ qua); cache ghi lại với version hiện tại
+    trip = await trips_collection.find_one_and_update(
+        {"_id": ObjectId(trip_id), "rejected_driver_ids": {"$ne": driver_id}},
+        {"$addToSet": {"rejected_driver_ids": driver_id}},
+        return_document=ReturnDocument.AFTER
     )
-    
-    return result.modified_count > 0
-
-async def _get_service_token() -> Optional[str]:
-    global _service_token_cache, _token_expiry_time
-
-    if _service_token_cache and _token_expiry_time and \
-       _token_expiry_time > (datetime.now(timezone.utc) + timedelta(minutes=1)):
-        logger.info("Sử dụng Service Token từ cache.")
-        return _service_token_cache
-
-    if not USER_SERVICE_URL or not MY_CLIENT_ID or not MY_CLIENT_SECRET:
-        logger.error("Client ID/Secret hoặc UserService URL chưa được cấu hình!")
-        return None
-
-    token_url = f"{USER_SERVICE_URL}/auth/token"
-    data = {
-        "username": MY_CLIENT_ID, 
-        "password": MY_CLIENT_SECRET 
-    }
-
-    logger.info(f"Đang xin Service Token từ {token_url} cho client {MY_CLIENT_ID}...")
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(token_url, data=data, timeout=10.0)
-            response.raise_for_status() 
-
-            token_data = response.json()
-            new_token = token_data.get("access_token")
-
-            if new_token:
-                logger.info("Lấy Service Token mới thành công.")
-                _service_token_cache = new_token
-                _token_expiry_time = datetime.now(timezone.utc) + timedelta(minutes=14)
-                return new_token
-            else:
-                logger.error("Phản hồi từ UserService không chứa access_token.")
-                return None
-
-    except httpx.RequestError as e:
-        logger.error(f"Lỗi kết nối đến UserService để lấy token: {e}")
-        return None
-    except httpx.HTTPStatusError as e:
-        logger.error(f"UserService trả lỗi khi cấp token: {e.response.status_code} - {e.response.text}")
-        return None
-    except Exception as e:
-        logger.error(f"Lỗi không xác định khi lấy Service Token: {e}")
-        return None
-
-    
+    if trip is None:
+        return False
+    await active_trip_cache.refresh(convert_objectid(trip))
+    return True
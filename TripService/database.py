@@ -1,5 +1,6 @@
 import os
 import motor.motor_asyncio
+import redis.asyncio as redis
 from pymongo import MongoClient
 
 MONGODB_URL = os.getenv("MONGODB_URL")
@@ -11,10 +12,35 @@ client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URL)
 database = client[DATABASE_NAME]
 
 trips_collection = database.get_collection("trips")
+# Chuyến đi đã kết thúc lâu ngày (archive_trips.py chuyển sang), bản rút gọn
+trips_archive_collection = database.get_collection("trips_archive")
 ratings_collection = database.get_collection("ratings")
+trip_stats_collection = database.get_collection("trip_stats")
+geocode_places_collection = database.get_collection("geocode_places")
+idempotency_keys_collection = database.get_collection("idempotency_keys")
+leases_collection = database.get_collection("leases")
+trip_event_checkpoints_collection = database.get_collection("trip_event_checkpoints")
+job_metrics_collection = database.get_collection("job_metrics")
 
 sync_client = MongoClient(MONGODB_URL)
 sync_database = sync_client[DATABASE_NAME]
 
+# Redis là tùy chọn: chỉ bật khi có REDIS_HOST (dùng chung cache giữa các replica)
+REDIS_HOST = os.getenv("REDIS_HOST")
+REDIS_KEY = os.getenv("REDIS_KEY", None)
+REDIS_PORT = os.getenv("REDIS_PORT", "6380")
+
+redis_client = None
+if REDIS_HOST:
+    try:
+        if REDIS_KEY:
+            redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_KEY, ssl=True, decode_responses=True)
+        else:
+            redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+        print(f"TripService: Đã khởi tạo Redis client tại {REDIS_HOST}:{REDIS_PORT}")
+    except Exception as e:
+        print(f"TripService: Lỗi khi khởi tạo Redis: {e}")
+        redis_client = None
+
 def get_database():
-    return database
\ No newline at end of file
+    return database
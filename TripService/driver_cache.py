@@ -0,0 +1,125 @@
+# TripService/driver_cache.py
+"""
+Read-through cache cho thông tin hiển thị của tài xế (tên, SĐT, xe...).
+
+Tầng 1: LRU + TTL trong bộ nhớ của từng replica.
+Tầng 2 (tùy chọn): Redis dùng chung giữa các replica, khi có REDIS_HOST.
+DriverService gọi /internal/drivers/{driver_id}/invalidate khi tài xế cập nhật hồ sơ;
+replica nhận được sẽ xóa key Redis và publish lên kênh để các replica khác xóa bản local.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from database import redis_client
+
+logger = logging.getLogger(__name__)
+
+DRIVER_CACHE_TTL_SECONDS = int(os.getenv("DRIVER_CACHE_TTL_SECONDS", "60"))
+DRIVER_CACHE_REDIS_TTL_SECONDS = int(os.getenv("DRIVER_CACHE_REDIS_TTL_SECONDS", "600"))
+DRIVER_CACHE_MAX_ENTRIES = int(os.getenv("DRIVER_CACHE_MAX_ENTRIES", "5000"))
+
+DRIVER_CACHE_KEY_PREFIX = "driver:details:"
+DRIVER_INVALIDATION_CHANNEL = "driver:details:invalidate"
+
+
+class DriverDetailsCache:
+    """LRU + TTL cache trong bộ nhớ, có thể kèm Redis làm tầng dùng chung."""
+
+    def __init__(self, ttl_seconds: int, max_entries: int, redis=None, redis_ttl_seconds: int = 600):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.redis = redis
+        self.redis_ttl_seconds = redis_ttl_seconds
+        self._entries: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    def _get_local(self, driver_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(driver_id)
+        if entry is None:
+            return None
+        expires_at, details = entry
+        if expires_at < time.monotonic():
+            del self._entries[driver_id]
+            return None
+        self._entries.move_to_end(driver_id)
+        return details
+
+    def _set_local(self, driver_id: str, details: Dict[str, Any]):
+        self._entries[driver_id] = (time.monotonic() + self.ttl_seconds, details)
+        self._entries.move_to_end(driver_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def evict_local(self, driver_id: str):
+        self._entries.pop(driver_id, None)
+
+    async def get(self, driver_id: str) -> Optional[Dict[str, Any]]:
+        details = self._get_local(driver_id)
+        if details is not None:
+            return details
+        if self.redis is None:
+            return None
+        try:
+            raw = await self.redis.get(f"{DRIVER_CACHE_KEY_PREFIX}{driver_id}")
+        except Exception as e:
+            logger.warning(f"DriverCache: Lỗi đọc Redis cho tài xế {driver_id}: {e}")
+            return None
+        if raw is None:
+            return None
+        details = json.loads(raw)
+        self._set_local(driver_id, details)
+        return details
+
+    async def set(self, driver_id: str, details: Dict[str, Any]):
+        self._set_local(driver_id, details)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(
+                f"{DRIVER_CACHE_KEY_PREFIX}{driver_id}",
+                json.dumps(details, default=str),
+                ex=self.redis_ttl_seconds
+            )
+        except Exception as e:
+            logger.warning(f"DriverCache: Lỗi ghi Redis cho tài xế {driver_id}: {e}")
+
+    async def invalidate(self, driver_id: str):
+        """Xóa bản cache ở mọi tầng và báo cho các replica khác."""
+        self.evict_local(driver_id)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.delete(f"{DRIVER_CACHE_KEY_PREFIX}{driver_id}")
+            await self.redis.publish(DRIVER_INVALIDATION_CHANNEL, driver_id)
+        except Exception as e:
+            logger.warning(f"DriverCache: Lỗi khi invalidate tài xế {driver_id} trên Redis: {e}")
+
+    async def listen_for_invalidations(self):
+        """Chạy nền: nhận sự kiện invalidate từ các replica khác qua Redis pub/sub."""
+        if self.redis is None:
+            return
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                await pubsub.subscribe(DRIVER_INVALIDATION_CHANNEL)
+                logger.info("DriverCache: Đã subscribe kênh invalidate thông tin tài xế.")
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self.evict_local(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"DriverCache: Mất kết nối pub/sub, thử lại sau 5s: {e}")
+                await asyncio.sleep(5)
+
+
+driver_cache = DriverDetailsCache(
+    ttl_seconds=DRIVER_CACHE_TTL_SECONDS,
+    max_entries=DRIVER_CACHE_MAX_ENTRIES,
+    redis=redis_client,
+    redis_ttl_seconds=DRIVER_CACHE_REDIS_TTL_SECONDS
+)
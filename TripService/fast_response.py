@@ -0,0 +1,69 @@
+# TripService/fast_response.py
+"""
+Đường tắt serialize response cho document đọc từ MongoDB.
+
+Document trong 'trips' do chính TripService ghi (model_dump của models.Trip), nên không cần
+Pydantic validate lại mỗi lần đọc. trusted_dump() chỉ lọc các field của schema response
+(theo alias) và điền giá trị mặc định; trusted_response() trả thẳng ORJSONResponse để FastAPI
+bỏ qua bước validate + jsonable_encoder của response_model.
+
+Khác với đường validate: model con (pickup, fare, history...) được trả nguyên như trong document
+(không lọc theo field của model con), và giá trị không được ép kiểu (vd. fare lưu int vẫn ra int,
+không thành float). Document TripService ghi qua models.Trip thường cho cùng JSON, nhưng document
+sửa tay hoặc ghi từ schema cũ có thể khác.
+"""
+from typing import Any, Collection, Dict, Iterable, List, Optional, Type, Union
+
+import orjson
+from bson import ObjectId
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def trusted_dump(
+    model_cls: Type[BaseModel],
+    doc: Dict[str, Any],
+    fields: Optional[Collection[str]] = None
+) -> Dict[str, Any]:
+    """Dict response (key theo alias) dựng từ document tin cậy, không validate.
+    fields: chỉ giữ các key này (sparse fieldset), field thiếu trong document trả về default/None."""
+    data = {}
+    for name, field in model_cls.model_fields.items():
+        key = field.alias or name
+        if fields is not None and key not in fields:
+            continue
+        if key in doc:
+            value = doc[key]
+        elif name in doc:
+            value = doc[name]
+        elif fields is not None:
+            value = None if field.is_required() else field.get_default(call_default_factory=True)
+        elif field.is_required():
+            # Document thiếu field bắt buộc: để Pydantic báo lỗi như đường chậm
+            return model_cls.model_validate(doc).model_dump(by_alias=True)
+        else:
+            value = field.get_default(call_default_factory=True)
+        data[key] = str(value) if isinstance(value, ObjectId) else value
+    return data
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=_default)
+
+
+def trusted_response(
+    model_cls: Type[BaseModel],
+    docs: Union[Dict[str, Any], Iterable[Dict[str, Any]]],
+    fields: Optional[Collection[str]] = None
+) -> ORJSONResponse:
+    if isinstance(docs, dict):
+        content: Union[Dict[str, Any], List[Dict[str, Any]]] = trusted_dump(model_cls, docs, fields)
+    else:
+        content = [trusted_dump(model_cls, doc, fields) for doc in docs]
+    return ORJSONResponse(content=content)
@@ -0,0 +1,172 @@
+# TripService/geocoding.py
+"""
+Cache kết quả geocoding (địa chỉ -> tọa độ) để không gọi Mapbox cho các địa điểm quen thuộc
+(trường học, trung tâm thương mại, sân bay...).
+
+Thứ tự tra cứu: bộ nhớ (LRU + TTL) -> Redis (TTL, dùng chung) -> warm set trong MongoDB
+('geocode_places', không hết hạn). Tối đa GEOCODE_WARM_SET_LIMIT địa điểm được ghim trong bộ nhớ
+(nạp khi khởi động); địa điểm đọc từ MongoDB sau đó đi vào LRU như các kết quả khác.
+Địa chỉ Mapbox không tìm thấy được nhớ là NOT_FOUND trong GEOCODE_NEGATIVE_TTL_SECONDS, để địa chỉ
+sai lặp lại không tốn thêm một lần đọc MongoDB và một lệnh gọi Mapbox.
+"""
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from database import redis_client, geocode_places_collection
+
+logger = logging.getLogger(__name__)
+
+GEOCODE_CACHE_TTL_SECONDS = int(os.getenv("GEOCODE_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+GEOCODE_CACHE_MAX_ENTRIES = int(os.getenv("GEOCODE_CACHE_MAX_ENTRIES", "10000"))
+GEOCODE_WARM_SET_LIMIT = int(os.getenv("GEOCODE_WARM_SET_LIMIT", "5000"))
+GEOCODE_NEGATIVE_TTL_SECONDS = int(os.getenv("GEOCODE_NEGATIVE_TTL_SECONDS", "3600"))
+
+GEOCODE_KEY_PREFIX = "geocode:"
+NOT_FOUND_MARKER = "-"  # Giá trị trong Redis cho địa chỉ không tìm thấy
+
+Coordinates = Tuple[float, float]
+# get() trả NOT_FOUND (tuple rỗng, falsy) khi địa chỉ đã biết là không tìm thấy, None khi chưa có trong cache
+NOT_FOUND: Tuple = ()
+
+
+def normalize_address(address: str) -> str:
+    """Chuẩn hóa địa chỉ làm key cache: NFC, chữ thường, gộp khoảng trắng, bỏ dấu câu thừa ở cuối."""
+    normalized = unicodedata.normalize("NFC", address).lower().strip()
+    normalized = re.sub(r"\s+", " ", normalized)
+    normalized = re.sub(r"\s*,\s*", ", ", normalized)
+    return normalized.strip(" ,.;")
+
+
+class GeocodeCache:
+    def __init__(self, ttl_seconds: int, max_entries: int, redis=None, places_collection=None,
+                 warm_limit: int = GEOCODE_WARM_SET_LIMIT, negative_ttl_seconds: int = GEOCODE_NEGATIVE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.redis = redis
+        self.places_collection = places_collection
+        self.warm_limit = warm_limit
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, Coordinates]]" = OrderedDict()
+        # Warm set: địa điểm phổ biến, không hết hạn và không bị LRU đẩy ra (tối đa warm_limit)
+        self._warm: Dict[str, Coordinates] = {}
+
+    def _get_local(self, key: str) -> Optional[Coordinates]:
+        if key in self._warm:
+            return self._warm[key]
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, coords = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return coords
+
+    def _set_local(self, key: str, coords: Coordinates, ttl_seconds: Optional[int] = None):
+        self._entries[key] = (time.monotonic() + (ttl_seconds or self.ttl_seconds), coords)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _pin(self, key: str, coords: Coordinates):
+        """Ghim vào warm set nếu còn chỗ, không thì để LRU quản lý."""
+        if key in self._warm or len(self._warm) < self.warm_limit:
+            self._warm[key] = coords
+        else:
+            self._set_local(key, coords)
+
+    async def get(self, address: str) -> Optional[Coordinates]:
+        key = normalize_address(address)
+        coords = self._get_local(key)
+        if coords is not None:
+            return coords
+
+        if self.redis is not None:
+            try:
+                raw = await self.redis.get(f"{GEOCODE_KEY_PREFIX}{key}")
+                if raw == NOT_FOUND_MARKER:
+                    self._set_local(key, NOT_FOUND, self.negative_ttl_seconds)
+                    return NOT_FOUND
+                if raw:
+                    lon, lat = raw.split(",")
+                    coords = (float(lon), float(lat))
+                    self._set_local(key, coords)
+                    return coords
+            except Exception as e:
+                logger.warning(f"GeocodeCache: Lỗi đọc Redis cho '{key}': {e}")
+
+        if self.places_collection is not None:
+            try:
+                place = await self.places_collection.find_one({"_id": key}, {"coordinates": 1})
+                if place:
+                    coords = (place["coordinates"][0], place["coordinates"][1])
+                    self._set_local(key, coords)
+                    return coords
+            except Exception as e:
+                logger.warning(f"GeocodeCache: Lỗi đọc warm set cho '{key}': {e}")
+        return None
+
+    async def set(self, address: str, coords: Coordinates):
+        key = normalize_address(address)
+        self._set_local(key, coords)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(f"{GEOCODE_KEY_PREFIX}{key}", f"{coords[0]},{coords[1]}", ex=self.ttl_seconds)
+        except Exception as e:
+            logger.warning(f"GeocodeCache: Lỗi ghi Redis cho '{key}': {e}")
+
+    async def set_not_found(self, address: str):
+        """Nhớ địa chỉ không tìm thấy trong negative_ttl_seconds (ngắn hơn TTL của kết quả tìm thấy)."""
+        key = normalize_address(address)
+        self._set_local(key, NOT_FOUND, self.negative_ttl_seconds)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(f"{GEOCODE_KEY_PREFIX}{key}", NOT_FOUND_MARKER, ex=self.negative_ttl_seconds)
+        except Exception as e:
+            logger.warning(f"GeocodeCache: Lỗi ghi Redis cho '{key}': {e}")
+
+    async def save_places(self, places: List[Tuple[str, Coordinates]]):
+        """Lưu địa điểm vào warm set (persistent) bằng một lệnh bulk_write."""
+        if not places:
+            return
+        now = datetime.now(timezone.utc)
+        operations = []
+        for address, coords in places:
+            key = normalize_address(address)
+            self._pin(key, coords)
+            operations.append(UpdateOne(
+                {"_id": key},
+                {"$set": {"address": address, "coordinates": [coords[0], coords[1]], "updated_at": now}},
+                upsert=True
+            ))
+        if self.places_collection is not None:
+            await self.places_collection.bulk_write(operations, ordered=False)
+
+    async def load_warm_set(self, limit: int = GEOCODE_WARM_SET_LIMIT) -> int:
+        """Nạp warm set từ MongoDB vào bộ nhớ (gọi khi khởi động)."""
+        if self.places_collection is None:
+            return 0
+        cursor = self.places_collection.find({}, {"coordinates": 1}).sort("updated_at", -1).limit(limit)
+        async for place in cursor:
+            self._pin(place["_id"], (place["coordinates"][0], place["coordinates"][1]))
+        logger.info(f"GeocodeCache: Đã nạp {len(self._warm)} địa điểm vào warm set.")
+        return len(self._warm)
+
+
+geocode_cache = GeocodeCache(
+    ttl_seconds=GEOCODE_CACHE_TTL_SECONDS,
+    max_entries=GEOCODE_CACHE_MAX_ENTRIES,
+    redis=redis_client,
+    places_collection=geocode_places_collection
+)
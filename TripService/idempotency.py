@@ -0,0 +1,186 @@
+# TripService/idempotency.py
+"""
+Hỗ trợ header Idempotency-Key cho các endpoint tốn kém (tạo chuyến đi, hoàn thành chuyến đi).
+
+- Lần đầu: giữ chỗ key (IN_PROGRESS) với lease ngắn IDEMPOTENCY_LEASE_SECONDS, chạy handler,
+  lưu response (DONE) kèm TTL IDEMPOTENCY_TTL_SECONDS.
+- Client gửi lại cùng key: trả response đã lưu, không chạy lại handler.
+- Các request trùng đang chạy song song trên CÙNG replica chờ chung một Future;
+  trên replica khác thì poll store tới khi request đầu xong.
+- Handler lỗi: xóa key để client có thể thử lại. Replica chết giữa chừng thì key IN_PROGRESS
+  hết lease và request sau được giữ chỗ lại (không bị 409 suốt TTL).
+
+Store dùng Redis nếu có REDIS_HOST, ngược lại dùng collection 'idempotency_keys' (TTL index).
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+
+from database import redis_client, idempotency_keys_collection
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+IDEMPOTENCY_LEASE_SECONDS = int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "60"))  # > IDEMPOTENCY_WAIT_SECONDS
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "30"))
+IDEMPOTENCY_POLL_INTERVAL_SECONDS = 0.2
+
+IN_PROGRESS = "IN_PROGRESS"
+DONE = "DONE"
+
+
+def request_fingerprint(payload: Any) -> str:
+    """Hash nội dung request để phát hiện một key bị dùng lại cho request khác."""
+    raw = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class RedisIdempotencyStore:
+    def __init__(self, redis, ttl_seconds: int, lease_seconds: int = IDEMPOTENCY_LEASE_SECONDS):
+        self.redis = redis
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+
+    async def claim(self, key: str, fingerprint: str) -> bool:
+        record = json.dumps({"state": IN_PROGRESS, "fingerprint": fingerprint})
+        return bool(await self.redis.set(f"idem:{key}", record, nx=True, ex=self.lease_seconds))
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raw = await self.redis.get(f"idem:{key}")
+        return json.loads(raw) if raw else None
+
+    async def complete(self, key: str, fingerprint: str, response: Any):
+        record = json.dumps({"state": DONE, "fingerprint": fingerprint, "response": response}, default=str)
+        await self.redis.set(f"idem:{key}", record, ex=self.ttl_seconds)
+
+    async def release(self, key: str):
+        await self.redis.delete(f"idem:{key}")
+
+
+class MongoIdempotencyStore:
+    def __init__(self, collection, ttl_seconds: int, lease_seconds: int = IDEMPOTENCY_LEASE_SECONDS):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0, background=True)
+
+    def _expires_at(self, seconds: int) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+    async def claim(self, key: str, fingerprint: str) -> bool:
+        try:
+            await self.collection.insert_one({
+                "_id": key,
+                "state": IN_PROGRESS,
+                "fingerprint": fingerprint,
+                "expires_at": self._expires_at(self.lease_seconds)
+            })
+            return True
+        except DuplicateKeyError:
+            pass
+        # TTL monitor của MongoDB xóa document chậm (~60s): tự giữ chỗ lại key IN_PROGRESS đã hết lease
+        taken_over = await self.collection.find_one_and_update(
+            {"_id": key, "state": IN_PROGRESS, "expires_at": {"$lte": datetime.now(timezone.utc)}},
+            {"$set": {"fingerprint": fingerprint, "expires_at": self._expires_at(self.lease_seconds)}}
+        )
+        return taken_over is not None
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        record = await self.collection.find_one({"_id": key})
+        if record and record.get("state") == IN_PROGRESS:
+            expires_at = record["expires_at"].replace(tzinfo=timezone.utc)  # Motor trả datetime naive (UTC)
+            if expires_at <= datetime.now(timezone.utc):
+                return None  # Hết lease (replica giữ chỗ đã chết): coi như chưa có, client thử lại
+        return record
+
+    async def complete(self, key: str, fingerprint: str, response: Any):
+        await self.collection.update_one(
+            {"_id": key},
+            {"$set": {"state": DONE, "response": response, "expires_at": self._expires_at(self.ttl_seconds)}}
+        )
+
+    async def release(self, key: str):
+        await self.collection.delete_one({"_id": key, "state": IN_PROGRESS})
+
+
+class IdempotencyManager:
+    def __init__(self, store, wait_seconds: float = IDEMPOTENCY_WAIT_SECONDS):
+        self.store = store
+        self.wait_seconds = wait_seconds
+        self._inflight: Dict[str, Tuple[str, asyncio.Future]] = {}
+
+    async def run(
+        self,
+        scope: str,
+        idempotency_key: Optional[str],
+        payload: Any,
+        handler: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """Chạy handler một lần cho mỗi (scope, key). Trả về (response, replayed)."""
+        if not idempotency_key:
+            return await handler(), False
+
+        key = f"{scope}:{idempotency_key}"
+        fingerprint = request_fingerprint(payload)
+
+        local = self._inflight.get(key)
+        if local is not None:
+            local_fingerprint, local_future = local
+            if local_fingerprint != fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key đã được dùng cho một yêu cầu khác.")
+            return await asyncio.shield(local_future), True
+
+        if not await self.store.claim(key, fingerprint):
+            return await self._wait_for_stored(key, fingerprint), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = (fingerprint, future)
+        try:
+            response = await handler()
+        except asyncio.CancelledError:
+            future.cancel()
+            await asyncio.shield(self.store.release(key))
+            raise
+        except Exception as e:
+            await self.store.release(key)
+            future.set_exception(e)
+            future.exception()  # đánh dấu đã lấy exception (tránh warning khi không ai chờ)
+            raise
+        else:
+            await self.store.complete(key, fingerprint, response)
+            future.set_result(response)
+            return response, False
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _wait_for_stored(self, key: str, fingerprint: str) -> Any:
+        deadline = asyncio.get_running_loop().time() + self.wait_seconds
+        while True:
+            record = await self.store.get(key)
+            if record is None:
+                raise HTTPException(status_code=409, detail="Yêu cầu trước với Idempotency-Key này đã thất bại, hãy thử lại.")
+            if record.get("fingerprint") != fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key đã được dùng cho một yêu cầu khác.")
+            if record.get("state") == DONE:
+                logger.info(f"Idempotency: Trả lại response đã lưu cho key {key}.")
+                return record.get("response")
+            if asyncio.get_running_loop().time() >= deadline:
+                raise HTTPException(status_code=409, detail="Yêu cầu với Idempotency-Key này vẫn đang được xử lý.")
+            await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL_SECONDS)
+
+
+if redis_client is not None:
+    idempotency_store = RedisIdempotencyStore(redis_client, IDEMPOTENCY_TTL_SECONDS)
+else:
+    idempotency_store = MongoIdempotencyStore(idempotency_keys_collection, IDEMPOTENCY_TTL_SECONDS)
+
+idempotency = IdempotencyManager(idempotency_store)
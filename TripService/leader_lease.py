@@ -0,0 +1,86 @@
+# TripService/leader_lease.py
+"""
+Lease đơn giản trên MongoDB để chỉ MỘT replica TripService chạy một job nền
+(consumer change stream, job định kỳ...). Replica giữ lease phải gia hạn trước khi hết hạn;
+nếu replica chết, replica khác sẽ nhận lease sau tối đa ttl_seconds.
+"""
+import asyncio
+import logging
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database import leases_collection
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLease:
+    def __init__(self, name: str, ttl_seconds: int = 30, collection=None):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.collection = collection if collection is not None else leases_collection
+        self.holder = f"{socket.gethostname()}:{uuid.uuid4().hex[:8]}"
+
+    @property
+    def renew_interval(self) -> float:
+        return self.ttl_seconds / 3
+
+    async def acquire_or_renew(self) -> bool:
+        now = datetime.now(timezone.utc)
+        try:
+            lease = await self.collection.find_one_and_update(
+                {"_id": self.name, "$or": [{"holder": self.holder}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"holder": self.holder, "expires_at": now + timedelta(seconds=self.ttl_seconds)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Replica khác đang giữ lease (upsert đụng _id đã tồn tại)
+            return False
+        return lease is not None and lease.get("holder") == self.holder
+
+    async def release(self):
+        await self.collection.delete_one({"_id": self.name, "holder": self.holder})
+
+    async def run_while_leader(self, job: Callable[[], Awaitable[None]], retry_delay_seconds: float = 5.0):
+        """Chạy job khi đang giữ lease; mất lease thì hủy job và chờ giành lại."""
+        while True:
+            try:
+                if not await self.acquire_or_renew():
+                    await asyncio.sleep(self.renew_interval)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Lease {self.name}: Lỗi khi giành lease: {e}")
+                await asyncio.sleep(retry_delay_seconds)
+                continue
+
+            logger.info(f"Lease {self.name}: {self.holder} bắt đầu chạy job.")
+            task = asyncio.create_task(job())
+            try:
+                while True:
+                    done, _ = await asyncio.wait({task}, timeout=self.renew_interval)
+                    if done:
+                        if task.exception():
+                            logger.error(f"Lease {self.name}: Job dừng vì lỗi: {task.exception()}")
+                        break
+                    if not await self.acquire_or_renew():
+                        logger.warning(f"Lease {self.name}: Mất lease, dừng job.")
+                        break
+            except asyncio.CancelledError:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await asyncio.shield(self.release())
+                raise
+            except Exception as e:
+                logger.warning(f"Lease {self.name}: Lỗi khi gia hạn lease: {e}")
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            await asyncio.sleep(retry_delay_seconds)
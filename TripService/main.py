@@ -1,11 +1,25 @@
-from fastapi import FastAPI, HTTPException, status, Query
-from typing import List, Optional, Dict, Any
+from fastapi import FastAPI, HTTPException, status, Query, Header, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+from brotli_asgi import BrotliMiddleware
+from typing import List, Optional, Dict, Any, AsyncGenerator
 from datetime import datetime
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
+import asyncio
+import orjson
 
 import crud
 import models
 import schemas
+from driver_cache import driver_cache
+from geocoding import geocode_cache
+from idempotency import idempotency, idempotency_store
+import active_trip_cache
+from fast_response import trusted_response
+from trip_events import run_trip_event_consumer
+from surge import run_surge_engine
+from trip_reaper import run_trip_reaper, get_reaper_metrics
 
 import os
 import httpx
@@ -18,8 +32,67 @@ load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+
+# Thời gian chờ PaymentService xếp hàng job thanh toán khi hoàn thành chuyến
+PAYMENT_ENQUEUE_TIMEOUT_SECONDS = float(os.getenv("PAYMENT_ENQUEUE_TIMEOUT_SECONDS", "5"))
                            
-app = FastAPI(title="UIT-Go Trip Service (MongoDB)", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
+    logger.info("TripService: Đang khởi động...")
+    try:
+        await geocode_cache.load_warm_set()
+    except Exception as e:
+        logger.error(f"TripService: Không nạp được warm set geocoding: {e}")
+    if hasattr(idempotency_store, "ensure_indexes"):
+        try:
+            await idempotency_store.ensure_indexes()
+        except Exception as e:
+            logger.error(f"TripService: Không tạo được TTL index cho idempotency_keys: {e}")
+    try:
+        await crud.ensure_geo_index()
+    except Exception as e:
+        logger.error(f"TripService: Không tạo được 2dsphere index cho pickup.location: {e}")
+    background_tasks = [
+        asyncio.create_task(driver_cache.listen_for_invalidations()),
+        asyncio.create_task(crud.service_token_manager.run_background_renewal()),
+        asyncio.create_task(run_trip_event_consumer()),
+        asyncio.create_task(run_surge_engine()),
+        asyncio.create_task(run_trip_reaper()),
+    ]
+    logger.info("TripService: Khởi động hoàn tất.")
+    yield
+    logger.info("TripService: Đang tắt...")
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    logger.info("TripService: Tắt hoàn tất.")
+
+app = FastAPI(
+    title="UIT-Go Trip Service (MongoDB)",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
+# Nén response (brotli, tự fallback gzip theo Accept-Encoding): polyline và danh sách chuyến đi nén rất tốt
+app.add_middleware(BrotliMiddleware, minimum_size=1000)
+
+# Sparse fieldsets: ?fields=status,driver_id -> projection MongoDB + response chỉ gồm các field đó
+FIELDS_DESCRIPTION = "Danh sách field cần trả, cách nhau bằng dấu phẩy (vd: status,driver_id). Bỏ trống = toàn bộ."
+TRIP_FIELDS = {field.alias or name for name, field in schemas.TripResponse.model_fields.items()}
+SUMMARY_FIELD_PATHS = {
+    "_id": "_id",
+    "passenger_id": "passenger_id",
+    "driver_id": "driver_id",
+    "status": "status",
+    "pickup_address": "pickup.address",
+    "dropoff_address": "dropoff.address",
+    "estimated_fare": "fare.estimated",
+    "actual_fare": "fare.actual",
+    "created_at": "created_at",
+    "startTime": "startTime",
+    "endTime": "endTime",
+}
+NEARBY_FIELD_PATHS = {**SUMMARY_FIELD_PATHS, "vehicle_type": "vehicle_type", "distance_m": "distance_m"}
 
 @app.get("/")
 async def get_service_info():
@@ -42,6 +115,27 @@ async def health_check():
         logger.error(f"Health check failed: {e}")
         raise HTTPException(status_code=503, detail="Service unhealthy")
 
+@app.post("/internal/drivers/{driver_id}/invalidate", tags=["Internal"])
+async def invalidate_driver_details(driver_id: str):
+    """[API NỘI BỘ] DriverService gọi khi tài xế cập nhật hồ sơ để xóa cache thông tin tài xế."""
+    await driver_cache.invalidate(driver_id)
+    logger.info(f"Đã xóa cache thông tin tài xế {driver_id}.")
+    return {"message": "Driver cache invalidated", "driver_id": driver_id}
+
+@app.get("/internal/metrics/reaper", tags=["Internal"])
+async def reaper_metrics():
+    """[API NỘI BỘ] Số chuyến PENDING đã bị reaper hủy vì không có tài xế nhận."""
+    return await get_reaper_metrics()
+
+# Các field PaymentService cần để đối soát giao dịch với chuyến đi
+RECONCILE_PROJECTION = {"status": 1, "driver_id": 1, "passenger_id": 1, "fare": 1, "payment": 1, "updated_at": 1}
+
+@app.post("/internal/trips/batch", tags=["Internal"])
+async def get_trips_batch(request: schemas.TripBatchRequest):
+    """[API NỘI BỘ] Đọc tối đa 500 chuyến đi trong một lượt (PaymentService dùng khi đối soát thanh toán)."""
+    trips = await crud.get_trips_by_ids(request.trip_ids, RECONCILE_PROJECTION)
+    return {"trips": trips}
+
 # Trip CRUD routes
 # New flow: FE sends coordinates -> BE returns fare estimates for all vehicle types
 @app.post("/fare-estimate/", response_model=schemas.FareEstimateResponse)
@@ -58,17 +152,38 @@ async def estimate_fare(fare_request: schemas.FareEstimateRequest):
     return schemas.FareEstimateResponse(estimates=estimates)
 
 
+@app.post("/geocode/batch", response_model=schemas.GeocodeBatchResponse)
+async def geocode_batch(batch_request: schemas.GeocodeBatchRequest):
+    """Geocode nhiều địa chỉ một lúc (import địa điểm đã lưu), dùng chung cache geocoding"""
+    results = await crud.geocode_addresses(batch_request.addresses, save_as_places=batch_request.save_as_places)
+    return schemas.GeocodeBatchResponse(results=results)
+
 @app.post(
     "/trip-requests/complete/",
     response_model=schemas.TripCreationResponse, 
 )
-async def create_complete_trip_request(trip_request: schemas.TripRequestComplete):
+async def create_complete_trip_request(
+    trip_request: schemas.TripRequestComplete,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Tạo chuyến đi. Client gửi kèm Idempotency-Key để retry không tạo chuyến trùng."""
+    result, replayed = await idempotency.run(
+        f"trip-create:{trip_request.passenger_id}",
+        idempotency_key,
+        trip_request.model_dump(mode="json"),
+        lambda: _create_complete_trip_request(trip_request)
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
 
+async def _create_complete_trip_request(trip_request: schemas.TripRequestComplete) -> dict:
     try:
         trip_data = await crud.create_trip_request_complete(trip_request)
         if not trip_data: 
              raise HTTPException(status_code=500, detail="Lỗi không xác định khi tạo chuyến đi.")
-        return {"trip": trip_data}
+        return jsonable_encoder(schemas.TripCreationResponse(trip=trip_data), by_alias=True)
 
     except ValueError as e: 
         logger.error(f"Lỗi khi tạo chuyến đi: {e}")
@@ -88,17 +203,28 @@ async def assign_driver(trip_id: str, assign_data: schemas.AssignDriver):
     trip_data = await crud.assign_driver_to_trip(trip_id, assign_data.driver_id)
     if trip_data is None:
         raise HTTPException(status_code=409, detail="Chuyến đi không hợp lệ, đã được nhận, bị hủy hoặc đã quá hạn chấp nhận.")
-    return schemas.TripResponse(**trip_data)
+    return trusted_response(schemas.TripResponse, trip_data)
 
 
 
 @app.get("/trips/{trip_id}", response_model=schemas.TripResponse)
-async def get_trip(trip_id: str):
-    """Get trip by ID with all nested information"""
-    trip_data = await crud.get_trip_by_id(trip_id)
+async def get_trip(trip_id: str, fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)):
+    """Get trip by ID with all nested information (hoặc chỉ các field trong `fields`)"""
+    selected = _parse_fields(fields, TRIP_FIELDS)
+    # Chuyến đi đang hoạt động: trả thẳng JSON đã serialize sẵn trong Redis
+    cached_json = await active_trip_cache.get_json(trip_id)
+    if cached_json is not None:
+        if selected is None:
+            return Response(content=cached_json, media_type="application/json")
+        cached_trip = orjson.loads(cached_json)
+        return ORJSONResponse({field: cached_trip.get(field) for field in selected})
+    projection = dict.fromkeys(selected, 1) if selected else None
+    trip_data = await crud.get_trip_by_id(trip_id, projection=projection)
     if trip_data is None:
         raise HTTPException(status_code=404, detail="Trip not found")
-    return schemas.TripResponse(**trip_data)
+    if selected is None:
+        await active_trip_cache.populate(trip_data)
+    return trusted_response(schemas.TripResponse, trip_data, fields=selected)
 
 @app.delete("/trips/{trip_id}")
 async def delete_trip(trip_id: str):
@@ -112,41 +238,53 @@ async def delete_trip(trip_id: str):
 async def get_passenger_trips(
     passenger_id: str, 
     skip: int = Query(0, ge=0), 
-    limit: int = Query(100, ge=1, le=100)
+    limit: int = Query(100, ge=1, le=100),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """Get trips for a specific passenger"""
-    trips = await crud.get_trips_by_passenger(passenger_id, skip=skip, limit=limit)
-    return [_convert_to_summary(trip) for trip in trips]
+    selected = _parse_fields(fields, SUMMARY_FIELD_PATHS)
+    trips = await crud.get_trips_by_passenger(passenger_id, skip=skip, limit=limit, projection=_summary_projection(selected))
+    return trusted_response(schemas.TripSummaryResponse, [_convert_to_summary(trip) for trip in trips], fields=selected)
 
 @app.get("/trips/driver/{driver_id}", response_model=List[schemas.TripSummaryResponse])
 async def get_driver_trips(
     driver_id: str,
     skip: int = Query(0, ge=0),
-    limit: int = Query(100, ge=1, le=100)
+    limit: int = Query(100, ge=1, le=100),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """Get trips for a specific driver"""
-    trips = await crud.get_trips_by_driver(driver_id, skip=skip, limit=limit)
-    return [_convert_to_summary(trip) for trip in trips]
+    selected = _parse_fields(fields, SUMMARY_FIELD_PATHS)
+    trips = await crud.get_trips_by_driver(driver_id, skip=skip, limit=limit, projection=_summary_projection(selected))
+    return trusted_response(schemas.TripSummaryResponse, [_convert_to_summary(trip) for trip in trips], fields=selected)
 
 @app.get("/trips/available/", response_model=List[schemas.TripSummaryResponse])
 async def get_available_trips(
     skip: int = Query(0, ge=0),
-    limit: int = Query(100, ge=1, le=100)
+    limit: int = Query(100, ge=1, le=100),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """Get available trips (PENDING status)"""
-    trips = await crud.get_available_trips(skip=skip, limit=limit)
-    return [_convert_to_summary(trip) for trip in trips]
+    selected = _parse_fields(fields, SUMMARY_FIELD_PATHS)
+    trips = await crud.get_available_trips(skip=skip, limit=limit, projection=_summary_projection(selected))
+    return trusted_response(schemas.TripSummaryResponse, [_convert_to_summary(trip) for trip in trips], fields=selected)
 
-@app.get("/trips/near/", response_model=List[schemas.TripSummaryResponse])
+@app.get("/trips/near/", response_model=List[schemas.NearbyTripResponse])
 async def get_trips_near_location(
     longitude: float = Query(..., ge=-180, le=180),
     latitude: float = Query(..., ge=-90, le=90),
     max_distance: int = Query(5000, ge=100, le=50000),  # meters
-    limit: int = Query(50, ge=1, le=100)
+    limit: int = Query(50, ge=1, le=100),
+    vehicle_type: Optional[List[models.VehicleTypeEnum]] = Query(None, description="Loại xe tài xế phục vụ được (lặp lại tham số nếu nhiều loại)"),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
-    """Get trips near a specific location using GeoJSON"""
-    trips = await crud.get_trips_near_location(longitude, latitude, max_distance, limit)
-    return [_convert_to_summary(trip) for trip in trips]
+    """Chuyến đi PENDING gần tài xế, sắp xếp theo khoảng cách tới điểm đón"""
+    selected = _parse_fields(fields, NEARBY_FIELD_PATHS)
+    projection = {NEARBY_FIELD_PATHS[field]: 1 for field in (selected or NEARBY_FIELD_PATHS)}
+    trips = await crud.get_trips_near_location(
+        longitude, latitude, max_distance, limit, vehicle_types=vehicle_type, projection=projection
+    )
+    return trusted_response(schemas.NearbyTripResponse, [_convert_to_nearby(trip) for trip in trips], fields=selected)
 
 # Trip status management
 @app.post("/trips/{trip_id}/accept")
@@ -174,11 +312,28 @@ async def deny_trip(trip_id: str, deny_data: schemas.AssignDriver):
     return {"message": "Trip denied successfully - returned to pending", "trip_id": trip_id, "status": "PENDING"}
 
 @app.post("/trips/{trip_id}/complete")
-async def complete_trip(trip_id: str, data: dict = Body(...)):
+async def complete_trip(
+    trip_id: str,
+    response: Response,
+    data: dict = Body(...),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """
     Hoàn thành chuyến đi và xử lý thanh toán với hệ thống mới.
     Tự động tính cước phí dựa trên khoảng cách và hỗ trợ thanh toán ngân hàng giả lập.
+    Retry với cùng Idempotency-Key sẽ nhận lại kết quả cũ thay vì gọi PaymentService lần nữa.
     """
+    result, replayed = await idempotency.run(
+        f"trip-complete:{trip_id}",
+        idempotency_key,
+        data,
+        lambda: _complete_trip(trip_id, data)
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+async def _complete_trip(trip_id: str, data: dict) -> dict:
     distance_km = data.get("distance_km")
     user_bank_info = data.get("user_bank_info")  # Optional, cho chuyển khoản
 
@@ -205,19 +360,25 @@ async def complete_trip(trip_id: str, data: dict = Body(...)):
         "driver_id": trip.get("driver_id"),
         "user_id": trip.get("passenger_id"),
         "distance_km": distance_km,
+        # Cùng loại xe / surge / giờ đặt chuyến như lúc ước tính để PaymentService tính ra cùng một giá (pricing.py)
+        "vehicle_type": trip.get("vehicle_type"),
+        "surge_multiplier": trip.get("surge_multiplier", 1.0),
+        "requested_at": trip["created_at"].isoformat() if isinstance(trip.get("created_at"), datetime) else None,
         "payment_method": payment_method,
         "user_bank_info": user_bank_info if payment_method == "BANK_TRANSFER" else None
     }
 
+    # PaymentService chỉ xếp hàng job (trả 202 + job_id), kết quả thanh toán về sau qua
+    # PUT /trips/{trip_id}/payment nên không phải chờ ngân hàng xử lý
     try:
         async with httpx.AsyncClient() as client:
             response = await client.post(
                 f"{PAYMENT_SERVICE_URL}/v1/trip-completion/complete",
                 json=payment_completion_request,
-                timeout=30.0
+                timeout=PAYMENT_ENQUEUE_TIMEOUT_SECONDS
             )
             response.raise_for_status()
-            payment_result = response.json()
+            payment_job = response.json()
     except (httpx.RequestError, httpx.TimeoutException) as e:
         logger.error(f"Payment service connection error: {e}")
         raise HTTPException(status_code=503, detail="Could not connect to Payment Service")
@@ -228,14 +389,14 @@ async def complete_trip(trip_id: str, data: dict = Body(...)):
     # Cập nhật trạng thái trip
     await crud.update_trip_status(trip_id, models.TripStatusEnum.COMPLETED)
 
-    # Cập nhật fare nếu payment thành công
-    if payment_result.get("success") and payment_result.get("fare_details"):
-        fare_details = payment_result["fare_details"]
+    # Cước tính theo quãng đường, có ngay trong phản hồi xếp hàng
+    fare_details = payment_job.get("fare_details")
+    if fare_details:
         await crud.update_trip_fare(trip_id, fare_details["total_fare"])
 
     return {
-        "message": "Trip completed and payment processed successfully",
-        "payment_result": payment_result
+        "message": "Trip completed, payment is being processed",
+        "payment_job": payment_job
     }
 
 @app.post("/trips/{trip_id}/cancel")
@@ -283,6 +444,9 @@ async def add_trip_rating(trip_id: str, rating: schemas.RatingCreate):
         raise HTTPException(status_code=400, detail="Trip already rated")
     
     updated_trip = await crud.add_trip_rating(trip_id, rating)
+    if updated_trip is None:
+        # Chuyến vừa được đánh giá bởi request khác (hoặc vừa bị xóa) giữa lúc đọc và ghi
+        raise HTTPException(status_code=409, detail="Trip already rated or no longer available")
     return {"message": "Rating added successfully", "trip_id": trip_id, "rating": rating.stars}
 
 @app.get("/trips/{trip_id}/rating")
@@ -312,21 +476,43 @@ async def get_passenger_statistics(passenger_id: str):
     return schemas.TripStatistics(**stats)
 
 # Helper function
-def _convert_to_summary(trip: dict) -> schemas.TripSummaryResponse:
-    """Convert full trip to summary response"""
-    return schemas.TripSummaryResponse(
+def _convert_to_summary(trip: dict) -> dict:
+    """Convert full trip to summary response (dict, không validate lại document từ DB)"""
+    fare = trip.get("fare") or {}
+    return dict(
         _id=str(trip["_id"]),
-        passenger_id=trip["passenger_id"],
-        driver_id=trip["driver_id"],
-        status=trip["status"],
-        pickup_address=trip["pickup"]["address"],
-        dropoff_address=trip["dropoff"]["address"],
-        estimated_fare=trip.get("fare", {}).get("estimated"),
-        actual_fare=trip.get("fare", {}).get("actual"),
-        created_at=trip["created_at"],
+        passenger_id=trip.get("passenger_id"),
+        driver_id=trip.get("driver_id"),
+        status=trip.get("status"),
+        pickup_address=(trip.get("pickup") or {}).get("address"),
+        dropoff_address=(trip.get("dropoff") or {}).get("address"),
+        estimated_fare=fare.get("estimated"),
+        actual_fare=fare.get("actual"),
+        created_at=trip.get("created_at"),
         startTime=trip.get("startTime"),
         endTime=trip.get("endTime")
     )
+
+def _convert_to_nearby(trip: dict) -> dict:
+    return dict(
+        _convert_to_summary(trip),
+        vehicle_type=trip.get("vehicle_type"),
+        distance_m=round(trip.get("distance_m", 0.0), 1)
+    )
+
+def _parse_fields(fields: Optional[str], allowed) -> Optional[List[str]]:
+    """Tách tham số fields=a,b,c; luôn kèm _id. None = trả toàn bộ."""
+    if not fields:
+        return None
+    requested = ["_id" if f.strip() == "id" else f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Field không hợp lệ: {', '.join(unknown)}")
+    return list(dict.fromkeys(["_id", *requested]))
+
+def _summary_projection(selected: Optional[List[str]]) -> dict:
+    """Projection MongoDB cho danh sách chuyến đi: chỉ đọc các path cần cho summary."""
+    return {SUMMARY_FIELD_PATHS[field]: 1 for field in (selected or SUMMARY_FIELD_PATHS)}
     
 @app.post("/trips/{trip_id}/reject")
 async def reject_trip(trip_id: str, reject_data: schemas.AssignDriver):
@@ -88,9 +88,12 @@ class Trip(BaseModel):
     startTime: Optional[datetime] = None
     endTime: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.now)
+    # Lần cuối chuyến đi thay đổi mà client cần biết (dùng cho trip_events)
+    updated_at: Optional[datetime] = None
     
     # Fare information
     fare: FareInfo = Field(default_factory=FareInfo)
+    surge_multiplier: float = 1.0  # Hệ số surge tại thời điểm đặt chuyến (đã nhân vào fare.estimated)
     
     # Route information from Mapbox
     route_info: Optional[RouteInfo] = None
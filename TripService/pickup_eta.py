@@ -0,0 +1,110 @@
+# TripService/pickup_eta.py
+"""
+Xếp hạng tài xế ứng viên theo thời gian tới điểm đón (ETA) thay vì khoảng cách đường chim bay.
+
+- Một lệnh Mapbox Matrix cho mỗi chuyến: các tài xế là sources, điểm đón là destination (vector 1xN).
+- Cache trong Redis theo ô điểm đón: hash 'eta:<ô đón>' với field là ô của tài xế (ô nhỏ ~300m),
+  nên các chuyến gần nhau trong vài phút dùng lại kết quả, chỉ gọi Mapbox cho tài xế chưa có trong cache.
+- Không có token Mapbox hoặc Mapbox lỗi: ước lượng cục bộ (haversine x hệ số đường vòng / tốc độ trung bình).
+"""
+import logging
+import math
+import os
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from database import redis_client
+from surge import cell_of
+
+logger = logging.getLogger(__name__)
+
+MAPBOX_ACCESS_TOKEN = os.getenv("MAPBOX_ACCESS_TOKEN")
+MAPBOX_MATRIX_URL = "https://api.mapbox.com/directions-matrix/v1/mapbox/driving"
+MAPBOX_MATRIX_MAX_COORDINATES = 25  # Giới hạn của profile driving
+
+ETA_CACHE_TTL_SECONDS = int(os.getenv("ETA_CACHE_TTL_SECONDS", "300"))
+ETA_ORIGIN_CELL_BITS = int(os.getenv("ETA_ORIGIN_CELL_BITS", "32"))  # ~600m x 300m
+ETA_DRIVER_CELL_BITS = int(os.getenv("ETA_DRIVER_CELL_BITS", "34"))  # ~300m x 150m
+ETA_KEY_PREFIX = "eta:"
+
+# Mô hình cục bộ: đường thực tế dài hơn đường chim bay, tốc độ trung bình trong thành phố
+LOCAL_DETOUR_FACTOR = float(os.getenv("ETA_LOCAL_DETOUR_FACTOR", "1.4"))
+LOCAL_AVERAGE_SPEED_KMH = float(os.getenv("ETA_LOCAL_AVERAGE_SPEED_KMH", "20"))
+
+
+def haversine_meters(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+def local_eta_seconds(driver_lon: float, driver_lat: float, pickup_lon: float, pickup_lat: float) -> float:
+    meters = haversine_meters(driver_lon, driver_lat, pickup_lon, pickup_lat) * LOCAL_DETOUR_FACTOR
+    return meters / (LOCAL_AVERAGE_SPEED_KMH / 3.6)
+
+
+async def _matrix_durations(pickup: tuple, drivers: List[Dict[str, Any]]) -> List[Optional[float]]:
+    """ETA (giây) từ mỗi tài xế tới điểm đón bằng một lệnh Mapbox Matrix; None nếu không có kết quả."""
+    if not MAPBOX_ACCESS_TOKEN or not drivers:
+        return [None] * len(drivers)
+    coordinates = ";".join(
+        [f"{pickup[0]},{pickup[1]}"] + [f"{d['longitude']},{d['latitude']}" for d in drivers]
+    )
+    params = {
+        "access_token": MAPBOX_ACCESS_TOKEN,
+        "sources": ";".join(str(i) for i in range(1, len(drivers) + 1)),
+        "destinations": "0",
+        "annotations": "duration",
+    }
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(f"{MAPBOX_MATRIX_URL}/{coordinates}", params=params, timeout=5.0)
+            response.raise_for_status()
+            data = response.json()
+        return [row[0] if row else None for row in data.get("durations", [])] or [None] * len(drivers)
+    except Exception as e:
+        logger.warning(f"Mapbox Matrix lỗi, dùng ước lượng cục bộ: {e}")
+        return [None] * len(drivers)
+
+
+async def rank_drivers_by_eta(pickup_lon: float, pickup_lat: float, drivers: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Gắn 'eta_seconds' cho từng tài xế và sắp xếp tăng dần theo ETA."""
+    if not drivers:
+        return drivers
+    origin_key = f"{ETA_KEY_PREFIX}{cell_of(pickup_lon, pickup_lat, ETA_ORIGIN_CELL_BITS)}"
+    driver_cells = [cell_of(d["longitude"], d["latitude"], ETA_DRIVER_CELL_BITS) for d in drivers]
+
+    cached: List[Optional[str]] = [None] * len(drivers)
+    if redis_client is not None:
+        try:
+            cached = await redis_client.hmget(origin_key, driver_cells)
+        except Exception as e:
+            logger.warning(f"PickupETA: Lỗi đọc cache ETA: {e}")
+
+    misses = [i for i, value in enumerate(cached) if value is None][:MAPBOX_MATRIX_MAX_COORDINATES - 1]
+    durations = await _matrix_durations((pickup_lon, pickup_lat), [drivers[i] for i in misses])
+
+    fresh: Dict[str, float] = {}
+    for i, duration in zip(misses, durations):
+        if duration is not None:
+            fresh[driver_cells[i]] = duration
+            cached[i] = duration
+    if fresh and redis_client is not None:
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.hset(origin_key, mapping=fresh)
+                pipe.expire(origin_key, ETA_CACHE_TTL_SECONDS)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"PickupETA: Lỗi ghi cache ETA: {e}")
+
+    ranked = []
+    for driver, value in zip(drivers, cached):
+        eta = float(value) if value is not None else local_eta_seconds(
+            driver["longitude"], driver["latitude"], pickup_lon, pickup_lat
+        )
+        ranked.append({**driver, "eta_seconds": round(eta)})
+    ranked.sort(key=lambda d: d["eta_seconds"])
+    logger.info(f"PickupETA: Xếp hạng {len(ranked)} tài xế ({len(fresh)} ETA mới từ Mapbox).")
+    return ranked
@@ -0,0 +1,85 @@
+# TripService/rebuild_trip_stats.py
+"""
+Tính lại toàn bộ collection 'trip_stats' từ 'trips' và 'trips_archive' (backfill / sửa lệch).
+
+Chạy trong container TripService (cần MONGODB_URL):
+    python rebuild_trip_stats.py
+    python rebuild_trip_stats.py --batch-size 500
+
+Nên chạy lúc ít traffic: các thay đổi chuyến đi xảy ra trong lúc rebuild có thể bị ghi đè.
+"""
+import argparse
+import logging
+from datetime import datetime, timezone
+
+from pymongo import ReplaceOne
+
+from database import sync_database
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _group_pipeline(owner_field: str) -> list:
+    """Pipeline nhóm chuyến đi theo owner_field, khớp với trip_stats.trip_contribution."""
+    completed = {"$eq": ["$status", "COMPLETED"]}
+    return [
+        {"$match": {owner_field: {"$nin": ["", None]}}},
+        {
+            "$group": {
+                "_id": f"${owner_field}",
+                "total_trips": {"$sum": 1},
+                "completed_trips": {"$sum": {"$cond": [completed, 1, 0]}},
+                "cancelled_trips": {"$sum": {"$cond": [{"$eq": ["$status", "CANCELLED"]}, 1, 0]}},
+                "total_revenue": {"$sum": {"$cond": [completed, {"$ifNull": ["$fare.actual", 0]}, 0]}},
+                "rating_sum": {"$sum": {"$ifNull": ["$rating.stars", 0]}},
+                "rating_count": {"$sum": {"$cond": [{"$gt": [{"$ifNull": ["$rating.stars", 0]}, 0]}, 1, 0]}},
+            }
+        },
+    ]
+
+
+def _merged_groups(collections: list, owner_field: str):
+    """Gộp kết quả nhóm của 'trips' và 'trips_archive' (cộng dồn các bộ đếm theo owner)."""
+    merged = {}
+    for collection in collections:
+        for group in collection.aggregate(_group_pipeline(owner_field), allowDiskUse=True):
+            owner_id = group.pop("_id")
+            totals = merged.setdefault(owner_id, dict.fromkeys(group, 0))
+            for field, value in group.items():
+                totals[field] += value
+    return merged.items()
+
+
+def rebuild_trip_stats(batch_size: int = 1000) -> int:
+    trips = sync_database.get_collection("trips")
+    trips_archive = sync_database.get_collection("trips_archive")
+    stats = sync_database.get_collection("trip_stats")
+    started_at = datetime.now(timezone.utc)
+    written = 0
+
+    for role, owner_field in (("driver", "driver_id"), ("passenger", "passenger_id")):
+        batch = []
+        for owner_id, group in _merged_groups([trips, trips_archive], owner_field):
+            doc = {"_id": f"{role}:{owner_id}", "role": role, "owner_id": owner_id, "updated_at": started_at, **group}
+            batch.append(ReplaceOne({"_id": doc["_id"]}, doc, upsert=True))
+            if len(batch) >= batch_size:
+                stats.bulk_write(batch, ordered=False)
+                written += len(batch)
+                batch = []
+        if batch:
+            stats.bulk_write(batch, ordered=False)
+            written += len(batch)
+        logger.info(f"Đã rebuild thống kê cho nhóm {role}.")
+
+    # Xóa thống kê của những người không còn chuyến đi nào
+    removed = stats.delete_many({"updated_at": {"$lt": started_at}}).deleted_count
+    logger.info(f"Rebuild trip_stats xong: ghi {written} document, xóa {removed} document cũ.")
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild collection trip_stats từ trips")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    rebuild_trip_stats(batch_size=args.batch_size)
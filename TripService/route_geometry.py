@@ -0,0 +1,108 @@
+# TripService/route_geometry.py
+"""
+Rút gọn polyline của Mapbox (overview=full) trước khi trả cho client / lưu vào Trip:
+decode -> Douglas–Peucker với sai số bằng ~1 pixel ở mức zoom hiển thị -> encode lại.
+Định dạng Google Encoded Polyline, độ chính xác 5 chữ số (mặc định của Mapbox 'polyline').
+"""
+import math
+import os
+from typing import List, Tuple
+
+ROUTE_SIMPLIFY_ZOOM = int(os.getenv("ROUTE_SIMPLIFY_ZOOM", "15"))
+POLYLINE_PRECISION = 5
+
+Point = Tuple[float, float]  # (lat, lon)
+
+
+def decode_polyline(encoded: str, precision: int = POLYLINE_PRECISION) -> List[Point]:
+    factor = 10 ** precision
+    points: List[Point] = []
+    index = lat = lon = 0
+    length = len(encoded)
+    while index < length:
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1F) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        points.append((lat / factor, lon / factor))
+    return points
+
+
+def _encode_value(value: int) -> str:
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+
+def encode_polyline(points: List[Point], precision: int = POLYLINE_PRECISION) -> str:
+    factor = 10 ** precision
+    encoded = []
+    prev_lat = prev_lon = 0
+    for lat, lon in points:
+        lat_i, lon_i = round(lat * factor), round(lon * factor)
+        encoded.append(_encode_value(lat_i - prev_lat))
+        encoded.append(_encode_value(lon_i - prev_lon))
+        prev_lat, prev_lon = lat_i, lon_i
+    return "".join(encoded)
+
+
+def tolerance_for_zoom(latitude: float, zoom: int = ROUTE_SIMPLIFY_ZOOM) -> float:
+    """Số mét ứng với 1 pixel (tile 256px) ở mức zoom và vĩ độ cho trước."""
+    return 156543.03392 * math.cos(math.radians(latitude)) / (2 ** zoom)
+
+
+def simplify_points(points: List[Point], tolerance_m: float) -> List[Point]:
+    """Douglas–Peucker (không đệ quy) trên tọa độ chiếu phẳng cục bộ (mét)."""
+    if len(points) < 3:
+        return list(points)
+    lat0 = math.radians(points[0][0])
+    meters_per_deg = 111320.0
+    xy = [(lon * meters_per_deg * math.cos(lat0), lat * meters_per_deg) for lat, lon in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    tolerance_sq = tolerance_m * tolerance_m
+    while stack:
+        start, end = stack.pop()
+        (x1, y1), (x2, y2) = xy[start], xy[end]
+        dx, dy = x2 - x1, y2 - y1
+        segment_sq = dx * dx + dy * dy
+        max_dist_sq, max_index = -1.0, -1
+        for i in range(start + 1, end):
+            px, py = xy[i]
+            if segment_sq == 0:
+                dist_sq = (px - x1) ** 2 + (py - y1) ** 2
+            else:
+                t = max(0.0, min(1.0, ((px - x1) * dx + (py - y1) * dy) / segment_sq))
+                dist_sq = (px - x1 - t * dx) ** 2 + (py - y1 - t * dy) ** 2
+            if dist_sq > max_dist_sq:
+                max_dist_sq, max_index = dist_sq, i
+        if max_dist_sq > tolerance_sq:
+            keep[max_index] = True
+            stack.append((start, max_index))
+            stack.append((max_index, end))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def simplify_polyline(encoded: str, zoom: int = ROUTE_SIMPLIFY_ZOOM) -> str:
+    if not encoded:
+        return encoded
+    points = decode_polyline(encoded)
+    if len(points) < 3:
+        return encoded
+    simplified = simplify_points(points, tolerance_for_zoom(points[0][0], zoom))
+    return encode_polyline(simplified)
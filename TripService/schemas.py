@@ -26,11 +26,26 @@ class VehicleFareEstimate(BaseModel):
     distance_meters: float
     duration_seconds: float
     route_geometry: dict  # Contains encoded_polyline for FE to decode
+    surge_multiplier: float = 1.0
 
 # Schema for fare estimation response (all 3 vehicle types)
 class FareEstimateResponse(BaseModel):
     estimates: List[VehicleFareEstimate]
 
+# Schema for bulk geocoding (import địa điểm đã lưu)
+class GeocodeBatchRequest(BaseModel):
+    addresses: List[str] = Field(..., min_length=1, max_length=100)
+    save_as_places: bool = False  # Lưu vào warm set (không hết hạn)
+
+class GeocodeResult(BaseModel):
+    address: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    found: bool
+
+class GeocodeBatchResponse(BaseModel):
+    results: List[GeocodeResult]
+
 # Enhanced location with both address and coordinates
 class LocationComplete(BaseModel):
     address: str = Field(..., max_length=100)
@@ -83,6 +98,9 @@ class PaymentUpdate(BaseModel):
     transaction_id: Optional[str] = None
     paid_at: Optional[datetime] = None
 
+class TripBatchRequest(BaseModel):
+    trip_ids: List[str] = Field(..., min_length=1, max_length=500)
+
 class RatingCreate(BaseModel):
     stars: int = Field(..., ge=1, le=5)
     comment: Optional[str] = None
@@ -104,6 +122,7 @@ class TripResponse(BaseModel):
     endTime: Optional[datetime] = None
     created_at: datetime
     fare: FareInfo
+    surge_multiplier: float = 1.0
     route_info: Optional[RouteInfo] = None
     payment: Optional[PaymentInfo] = None
     rating: Optional[RatingInfo] = None
@@ -129,6 +148,11 @@ class TripSummaryResponse(BaseModel):
 
     model_config = ConfigDict(populate_by_name=True)
 
+class NearbyTripResponse(TripSummaryResponse):
+    """Chuyến đi PENDING gần tài xế, kèm khoảng cách (mét) tới điểm đón"""
+    vehicle_type: VehicleTypeEnum
+    distance_m: float
+
 class StandaloneRatingResponse(BaseModel):
     id: str = Field(alias="_id")
     trip_id: str
@@ -0,0 +1,148 @@
+# TripService/service_token.py
+"""
+Quản lý Service Token (OAuth2 client credentials) khi gọi service khác.
+
+- Single-flight: nhiều request cùng lúc cần token mới chỉ tạo MỘT request tới UserService.
+- Gia hạn chủ động: task nền lấy token mới trước khi hết hạn (có jitter để các replica
+  không cùng gia hạn một lúc).
+- 401/403 chỉ xóa đúng token bị từ chối, không xóa token mới đã được lấy bởi request khác.
+
+Module không phụ thuộc vào phần còn lại của TripService, service nào cần gọi API nội bộ
+có token đều có thể copy sang và tạo một ServiceTokenManager riêng.
+"""
+import asyncio
+import base64
+import json
+import logging
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def _read_jwt_expiry(token: str) -> Optional[datetime]:
+    """Đọc claim 'exp' của JWT (không verify chữ ký, chỉ để biết lúc nào cần gia hạn)."""
+    try:
+        payload_segment = token.split(".")[1]
+        payload_segment += "=" * (-len(payload_segment) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(payload_segment))
+        return datetime.fromtimestamp(int(payload["exp"]), tz=timezone.utc)
+    except Exception:
+        return None
+
+
+class ServiceTokenManager:
+    def __init__(
+        self,
+        token_url: Optional[str],
+        client_id: Optional[str],
+        client_secret: Optional[str],
+        default_lifetime: timedelta = timedelta(minutes=14),
+        refresh_margin: timedelta = timedelta(minutes=1),
+        renewal_jitter_seconds: float = 30.0,
+        request_timeout: float = 10.0,
+    ):
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.default_lifetime = default_lifetime
+        self.refresh_margin = refresh_margin
+        self.renewal_jitter_seconds = renewal_jitter_seconds
+        self.request_timeout = request_timeout
+
+        self._token: Optional[str] = None
+        self._expires_at: Optional[datetime] = None
+        self._inflight: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_configured(self) -> bool:
+        return bool(self.token_url and self.client_id and self.client_secret)
+
+    def _is_fresh(self) -> bool:
+        return bool(
+            self._token and self._expires_at and
+            self._expires_at > datetime.now(timezone.utc) + self.refresh_margin
+        )
+
+    async def get_token(self) -> Optional[str]:
+        """Trả token còn hạn, hoặc chờ (chung) lượt lấy token mới đang chạy."""
+        if self._is_fresh():
+            return self._token
+        return await self._refresh()
+
+    async def _refresh(self) -> Optional[str]:
+        async with self._lock:
+            if self._inflight is None or self._inflight.done():
+                self._inflight = asyncio.create_task(self._fetch_token())
+            inflight = self._inflight
+        # shield: một caller bị hủy không làm hủy lượt lấy token của các caller khác
+        return await asyncio.shield(inflight)
+
+    async def _fetch_token(self) -> Optional[str]:
+        if not self.is_configured:
+            logger.error("Client ID/Secret hoặc UserService URL chưa được cấu hình!")
+            return None
+
+        data = {
+            "username": self.client_id,
+            "password": self.client_secret
+        }
+
+        logger.info(f"Đang xin Service Token từ {self.token_url} cho client {self.client_id}...")
+        try:
+            async with httpx.AsyncClient() as client:
+                response = await client.post(self.token_url, data=data, timeout=self.request_timeout)
+                response.raise_for_status()
+                new_token = response.json().get("access_token")
+        except httpx.RequestError as e:
+            logger.error(f"Lỗi kết nối đến UserService để lấy token: {e}")
+            return None
+        except httpx.HTTPStatusError as e:
+            logger.error(f"UserService trả lỗi khi cấp token: {e.response.status_code} - {e.response.text}")
+            return None
+        except Exception as e:
+            logger.error(f"Lỗi không xác định khi lấy Service Token: {e}")
+            return None
+
+        if not new_token:
+            logger.error("Phản hồi từ UserService không chứa access_token.")
+            return None
+
+        self._token = new_token
+        self._expires_at = _read_jwt_expiry(new_token) or (datetime.now(timezone.utc) + self.default_lifetime)
+        logger.info(f"Lấy Service Token mới thành công (hết hạn lúc {self._expires_at.isoformat()}).")
+        return new_token
+
+    def invalidate(self, rejected_token: Optional[str] = None):
+        """Bỏ token hiện tại. Nếu truyền rejected_token, chỉ bỏ khi nó vẫn là token đang dùng."""
+        if rejected_token is not None and rejected_token != self._token:
+            return
+        self._token = None
+        self._expires_at = None
+
+    def _seconds_until_renewal(self) -> float:
+        if not self._token or not self._expires_at:
+            return 0.0
+        renew_at = self._expires_at - self.refresh_margin
+        jitter = random.uniform(0, self.renewal_jitter_seconds)
+        return max((renew_at - datetime.now(timezone.utc)).total_seconds() - jitter, 0.0)
+
+    async def run_background_renewal(self, retry_delay_seconds: float = 10.0):
+        """Chạy nền: gia hạn token trước khi hết hạn để request không phải chờ UserService."""
+        if not self.is_configured:
+            return
+        while True:
+            try:
+                await asyncio.sleep(self._seconds_until_renewal())
+                token = await self._refresh()
+                if token is None:
+                    await asyncio.sleep(retry_delay_seconds)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Lỗi khi gia hạn Service Token nền: {e}")
+                await asyncio.sleep(retry_delay_seconds)
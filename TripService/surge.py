@@ -0,0 +1,187 @@
+# TripService/surge.py
+"""
+Surge pricing theo cung/cầu từng ô (cell) trên bản đồ.
+
+- Ô = tiền tố geohash của score trong geo index 'drivers:online' (LocationService dùng GEOADD,
+  score là geohash 52 bit), nên đếm cung chỉ cần đọc score, không decode tọa độ.
+  SURGE_CELL_BITS=25 tương đương geohash 5 ký tự (~4.9km x 4.9km).
+- Cung: số tài xế online mỗi ô, lấy trung bình trên các lần đo gần nhất (sliding window).
+- Cầu: chuyến PENDING mới tạo trong cửa sổ + số lần ước tính giá (đếm theo phút trong Redis hash).
+- Engine chạy định kỳ trên MỘT replica (LeaderLease "surge-engine"), ghi hệ số vào hash
+  'surge:multipliers'; request ước tính giá chỉ cần một HGET (O(1)).
+  Engine dừng thì hash hết hạn và giá tự về hệ số 1.0.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Deque, Dict, Optional
+
+from database import redis_client, trips_collection
+from leader_lease import LeaderLease
+import models
+
+logger = logging.getLogger(__name__)
+
+DRIVER_GEO_KEY = "drivers:online"  # Cùng key với LocationService
+SURGE_MULTIPLIERS_KEY = "surge:multipliers"
+SURGE_ESTIMATES_KEY_PREFIX = "surge:estimates:"
+
+SURGE_CELL_BITS = int(os.getenv("SURGE_CELL_BITS", "25"))
+SURGE_INTERVAL_SECONDS = int(os.getenv("SURGE_INTERVAL_SECONDS", "30"))
+SURGE_WINDOW_MINUTES = int(os.getenv("SURGE_WINDOW_MINUTES", "5"))
+SURGE_ESTIMATE_WEIGHT = float(os.getenv("SURGE_ESTIMATE_WEIGHT", "0.3"))  # Ước tính giá chưa chắc thành chuyến
+SURGE_MIN_DEMAND = float(os.getenv("SURGE_MIN_DEMAND", "3"))
+SURGE_RATIO_THRESHOLD = float(os.getenv("SURGE_RATIO_THRESHOLD", "1.0"))
+SURGE_SENSITIVITY = float(os.getenv("SURGE_SENSITIVITY", "0.5"))
+SURGE_MAX_MULTIPLIER = float(os.getenv("SURGE_MAX_MULTIPLIER", "2.5"))
+
+# Giống hằng số GEO của Redis (geohash.h)
+GEO_LAT_MIN, GEO_LAT_MAX = -85.05112878, 85.05112878
+GEO_LONG_MIN, GEO_LONG_MAX = -180.0, 180.0
+GEO_STEP = 26  # Mỗi trục 26 bit -> score 52 bit
+
+
+def _spread_bits(value: int) -> int:
+    """Chèn một bit 0 giữa các bit của value (value < 2^26)."""
+    result = 0
+    for i in range(GEO_STEP):
+        result |= ((value >> i) & 1) << (2 * i)
+    return result
+
+
+def geo_score(longitude: float, latitude: float) -> int:
+    """Score 52 bit giống hệt Redis GEOADD cho (longitude, latitude)."""
+    lat_offset = int((latitude - GEO_LAT_MIN) / (GEO_LAT_MAX - GEO_LAT_MIN) * (1 << GEO_STEP))
+    long_offset = int((longitude - GEO_LONG_MIN) / (GEO_LONG_MAX - GEO_LONG_MIN) * (1 << GEO_STEP))
+    lat_offset = min(max(lat_offset, 0), (1 << GEO_STEP) - 1)
+    long_offset = min(max(long_offset, 0), (1 << GEO_STEP) - 1)
+    return _spread_bits(lat_offset) | (_spread_bits(long_offset) << 1)
+
+
+def cell_from_score(score: float, cell_bits: int = SURGE_CELL_BITS) -> str:
+    return str(int(score) >> (2 * GEO_STEP - cell_bits))
+
+
+def cell_of(longitude: float, latitude: float, cell_bits: int = SURGE_CELL_BITS) -> str:
+    return cell_from_score(geo_score(longitude, latitude), cell_bits)
+
+
+def compute_multipliers(supply: Dict[str, float], demand: Dict[str, float]) -> Dict[str, float]:
+    """Hệ số surge cho các ô có cầu vượt cung; ô không có trong kết quả = 1.0."""
+    multipliers = {}
+    for cell, cell_demand in demand.items():
+        if cell_demand < SURGE_MIN_DEMAND:
+            continue
+        ratio = cell_demand / max(supply.get(cell, 0.0), 1.0)
+        if ratio <= SURGE_RATIO_THRESHOLD:
+            continue
+        multiplier = min(1.0 + SURGE_SENSITIVITY * (ratio - SURGE_RATIO_THRESHOLD), SURGE_MAX_MULTIPLIER)
+        multiplier = round(multiplier, 1)
+        if multiplier > 1.0:
+            multipliers[cell] = multiplier
+    return multipliers
+
+
+def _minute_bucket(now: Optional[float] = None) -> int:
+    return int((now if now is not None else time.time()) // 60)
+
+
+async def get_multiplier(longitude: float, latitude: float, record_demand: bool = False) -> float:
+    """Hệ số surge tại điểm đón (một round-trip Redis); record_demand=True đếm thêm một lần ước tính giá."""
+    if redis_client is None:
+        return 1.0
+    cell = cell_of(longitude, latitude)
+    try:
+        if record_demand:
+            estimates_key = f"{SURGE_ESTIMATES_KEY_PREFIX}{_minute_bucket()}"
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.hget(SURGE_MULTIPLIERS_KEY, cell)
+                pipe.hincrby(estimates_key, cell, 1)
+                pipe.expire(estimates_key, (SURGE_WINDOW_MINUTES + 1) * 60)
+                raw, _, _ = await pipe.execute()
+        else:
+            raw = await redis_client.hget(SURGE_MULTIPLIERS_KEY, cell)
+        return float(raw) if raw else 1.0
+    except Exception as e:
+        logger.warning(f"Surge: Lỗi đọc hệ số surge cho ô {cell}: {e}")
+        return 1.0
+
+
+class SurgeEngine:
+    def __init__(self, redis=None, interval_seconds: int = SURGE_INTERVAL_SECONDS, window_minutes: int = SURGE_WINDOW_MINUTES):
+        self.redis = redis if redis is not None else redis_client
+        self.interval_seconds = interval_seconds
+        self.window_minutes = window_minutes
+        window_ticks = max(1, (window_minutes * 60) // interval_seconds)
+        self._supply_history: Deque[Dict[str, int]] = deque(maxlen=window_ticks)
+
+    async def _count_supply(self) -> Dict[str, float]:
+        snapshot: Dict[str, int] = {}
+        for _, score in await self.redis.zrange(DRIVER_GEO_KEY, 0, -1, withscores=True):
+            cell = cell_from_score(score)
+            snapshot[cell] = snapshot.get(cell, 0) + 1
+        self._supply_history.append(snapshot)
+        totals: Dict[str, float] = {}
+        for past in self._supply_history:
+            for cell, count in past.items():
+                totals[cell] = totals.get(cell, 0) + count
+        return {cell: total / len(self._supply_history) for cell, total in totals.items()}
+
+    async def _count_demand(self) -> Dict[str, float]:
+        demand: Dict[str, float] = {}
+        since = datetime.now(timezone.utc) - timedelta(minutes=self.window_minutes)
+        cursor = trips_collection.find(
+            {"status": models.TripStatusEnum.PENDING.value, "created_at": {"$gte": since}},
+            {"pickup.location.coordinates": 1}
+        )
+        async for trip in cursor:
+            longitude, latitude = trip["pickup"]["location"]["coordinates"][:2]
+            cell = cell_of(longitude, latitude)
+            demand[cell] = demand.get(cell, 0.0) + 1.0
+
+        current = _minute_bucket()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for bucket in range(current - self.window_minutes + 1, current + 1):
+                pipe.hgetall(f"{SURGE_ESTIMATES_KEY_PREFIX}{bucket}")
+            buckets = await pipe.execute()
+        for counts in buckets:
+            for cell, count in counts.items():
+                demand[cell] = demand.get(cell, 0.0) + int(count) * SURGE_ESTIMATE_WEIGHT
+        return demand
+
+    async def tick(self) -> Dict[str, float]:
+        supply = await self._count_supply()
+        demand = await self._count_demand()
+        multipliers = compute_multipliers(supply, demand)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(SURGE_MULTIPLIERS_KEY)
+            if multipliers:
+                pipe.hset(SURGE_MULTIPLIERS_KEY, mapping=multipliers)
+                pipe.expire(SURGE_MULTIPLIERS_KEY, self.interval_seconds * 3)
+            await pipe.execute()
+        logger.info(f"Surge: {len(supply)} ô có tài xế, {len(demand)} ô có nhu cầu, {len(multipliers)} ô đang surge.")
+        return multipliers
+
+    async def run(self):
+        while True:
+            try:
+                await self.tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Surge: Lỗi khi tính hệ số surge: {e}")
+            await asyncio.sleep(self.interval_seconds)
+
+
+surge_lease = LeaderLease("surge-engine")
+
+
+async def run_surge_engine():
+    """Task nền cho lifespan; không có Redis thì không surge (hệ số luôn 1.0)."""
+    if redis_client is None:
+        logger.info("Surge: Không có Redis, tắt surge pricing.")
+        return
+    await surge_lease.run_while_leader(SurgeEngine().run)
@@ -0,0 +1,234 @@
+# TripService/trip_events.py
+"""
+Đẩy thay đổi của chuyến đi tới phòng WebSocket của chuyến (LocationService) thay cho việc client poll.
+
+Nguồn sự kiện:
+- MongoDB change stream trên 'trips' (replica set / CosmosDB), resume token lưu trong
+  'trip_event_checkpoints' để khởi động lại không mất sự kiện.
+- Fallback poll theo (updated_at, _id) khi MongoDB không hỗ trợ change stream (standalone).
+
+Chỉ các cập nhật có set 'updated_at' (thay đổi client cần biết) mới sinh sự kiện; các cập nhật
+nội bộ như notified_driver_ids / rejected_driver_ids bị bỏ qua. Change stream của CosmosDB không
+có updateDescription, nên khi thiếu nó consumer so updated_at với lần cuối đã thấy của chuyến đi.
+Sự kiện được gom theo lô và gửi bằng MỘT request tới LocationService (/notify/trips/batch);
+mọi sự kiện đổi trạng thái đều được gửi, chỉ TRIP_UPDATED bị gộp khi chuyến có sự kiện mới hơn trong lô.
+Chỉ một replica chạy consumer (LeaderLease "trip-events"). assign_driver_to_trip vẫn báo
+DRIVER_ASSIGNED trực tiếp cho hành khách (nhanh hơn một vòng change stream) bằng cùng payload
+crud.build_trip_event, nên client khử trùng theo (trip_id, type, updated_at).
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import httpx
+from pymongo.errors import OperationFailure
+
+import crud
+import models
+from database import trips_collection, trip_event_checkpoints_collection
+from leader_lease import LeaderLease
+
+logger = logging.getLogger(__name__)
+
+LOCATION_SERVICE_URL = os.getenv("LOCATION_SERVICE_URL")
+MONGODB_URL = os.getenv("MONGODB_URL", "")
+TRIP_EVENTS_BATCH_SIZE = int(os.getenv("TRIP_EVENTS_BATCH_SIZE", "100"))
+TRIP_EVENTS_FLUSH_INTERVAL_MS = int(os.getenv("TRIP_EVENTS_FLUSH_INTERVAL_MS", "200"))
+TRIP_EVENTS_POLL_INTERVAL_SECONDS = float(os.getenv("TRIP_EVENTS_POLL_INTERVAL_SECONDS", "2"))
+TRIP_EVENTS_RETRY_DELAY_SECONDS = 5
+
+CHECKPOINT_ID = "trips"
+# Lỗi "change stream history lost": resume token quá cũ so với oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+CHANGE_STREAM_PIPELINE = [
+    {
+        "$match": {
+            "$or": [
+                {"operationType": "replace"},
+                {"operationType": "update", "updateDescription.updatedFields.updated_at": {"$exists": True}},
+            ]
+        }
+    }
+]
+# CosmosDB chỉ nhận pipeline dạng này (không lọc được theo updateDescription): lọc phía consumer
+COSMOS_CHANGE_STREAM_PIPELINE = [
+    {"$match": {"operationType": {"$in": ["update", "replace"]}}},
+    {"$project": {"_id": 1, "fullDocument": 1, "ns": 1, "documentKey": 1}},
+]
+
+
+def change_stream_pipeline(mongodb_url: str) -> List[Dict[str, Any]]:
+    return COSMOS_CHANGE_STREAM_PIPELINE if ".cosmos.azure.com" in mongodb_url else CHANGE_STREAM_PIPELINE
+
+
+def coalesce_events(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Bỏ TRIP_UPDATED nếu cùng chuyến còn sự kiện sau nó trong lô (payload nào cũng là ảnh chụp đầy đủ).
+    Sự kiện đổi trạng thái luôn được giữ, thứ tự giữ nguyên.
+    """
+    seen = set()
+    kept = []
+    for event in reversed(events):
+        if event["type"] == "TRIP_UPDATED" and event["trip_id"] in seen:
+            continue
+        seen.add(event["trip_id"])
+        kept.append(event)
+    return kept[::-1]
+
+
+async def publish_events(events: List[Dict[str, Any]]):
+    """Gửi cả lô sự kiện tới LocationService bằng một request."""
+    if not events or not LOCATION_SERVICE_URL:
+        return
+    events = coalesce_events(events)
+    url = f"{LOCATION_SERVICE_URL}/notify/trips/batch"
+    request_data = {
+        "events": [
+            {"trip_id": event["trip_id"], "user_types": ["passenger", "driver"], "payload": event}
+            for event in events
+        ]
+    }
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.post(url, json=request_data, timeout=10.0)
+            response.raise_for_status()
+            logger.info(f"TripEvents: Đã gửi {len(events)} sự kiện chuyến đi tới LocationService.")
+    except httpx.RequestError as e:
+        logger.error(f"TripEvents: Không thể kết nối LocationService: {e}")
+    except httpx.HTTPStatusError as e:
+        logger.error(f"TripEvents: LocationService trả lỗi: {e.response.status_code} - {e.response.text}")
+    except Exception as e:
+        logger.error(f"TripEvents: Lỗi không xác định khi gửi sự kiện: {e}")
+
+
+class TripEventConsumer:
+    def __init__(self, batch_size: int = TRIP_EVENTS_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.use_polling = False
+        # (status, updated_at) gần nhất đã thấy của mỗi chuyến (poll / CosmosDB không có updateDescription)
+        self._last_seen: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _remember(self, trip: dict) -> Optional[tuple]:
+        trip_id = str(trip["_id"])
+        previous = self._last_seen.pop(trip_id, None)
+        self._last_seen[trip_id] = (trip.get("status"), trip.get("updated_at"))
+        while len(self._last_seen) > 10000:
+            self._last_seen.popitem(last=False)
+        return previous
+
+    async def _to_event(self, trip: dict, updated_fields: Optional[dict] = None) -> Optional[Dict[str, Any]]:
+        """Sự kiện cho một thay đổi, None nếu đó là cập nhật nội bộ (không đổi updated_at)."""
+        previous = self._remember(trip)
+        if updated_fields is not None:
+            if "updated_at" not in updated_fields:
+                return None
+            status_changed = "status" in updated_fields
+        else:
+            if previous is not None and previous[1] == trip.get("updated_at"):
+                return None
+            status_changed = previous is None or previous[0] != trip.get("status")
+        driver_info = None
+        if status_changed and trip.get("status") == models.TripStatusEnum.ACCEPTED.value and trip.get("driver_id"):
+            driver_info = await crud.get_driver_details_from_driver_service(trip["driver_id"])
+        return crud.build_trip_event(trip, status_changed, driver_info)
+
+    async def _load_checkpoint(self) -> dict:
+        return await trip_event_checkpoints_collection.find_one({"_id": CHECKPOINT_ID}) or {}
+
+    async def _save_checkpoint(self, **fields):
+        await trip_event_checkpoints_collection.update_one(
+            {"_id": CHECKPOINT_ID},
+            {"$set": {**fields, "saved_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    async def run(self):
+        while True:
+            try:
+                if self.use_polling:
+                    await self._poll()
+                else:
+                    await self._watch()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    logger.warning("TripEvents: Resume token đã hết hạn, bắt đầu lại từ thời điểm hiện tại.")
+                    await self._save_checkpoint(resume_token=None)
+                elif not self.use_polling:
+                    logger.warning(f"TripEvents: MongoDB không hỗ trợ change stream ({e}), chuyển sang chế độ poll.")
+                    self.use_polling = True
+                else:
+                    logger.error(f"TripEvents: Lỗi khi poll chuyến đi: {e}")
+                    await asyncio.sleep(TRIP_EVENTS_RETRY_DELAY_SECONDS)
+            except Exception as e:
+                logger.error(f"TripEvents: Consumer lỗi, thử lại sau {TRIP_EVENTS_RETRY_DELAY_SECONDS}s: {e}")
+                await asyncio.sleep(TRIP_EVENTS_RETRY_DELAY_SECONDS)
+
+    async def _watch(self):
+        checkpoint = await self._load_checkpoint()
+        async with trips_collection.watch(
+            change_stream_pipeline(MONGODB_URL),
+            full_document="updateLookup",
+            resume_after=checkpoint.get("resume_token"),
+            max_await_time_ms=TRIP_EVENTS_FLUSH_INTERVAL_MS
+        ) as stream:
+            logger.info("TripEvents: Đang theo dõi change stream của 'trips'.")
+            pending: List[Dict[str, Any]] = []
+            while stream.alive:
+                change = await stream.try_next()
+                if change is not None:
+                    trip = change.get("fullDocument")
+                    if trip is not None:
+                        updated_fields = (change.get("updateDescription") or {}).get("updatedFields")
+                        event = await self._to_event(trip, updated_fields)
+                        if event is not None:
+                            pending.append(event)
+                    if len(pending) < self.batch_size:
+                        continue
+                if pending:
+                    await publish_events(pending)
+                    pending = []
+                    await self._save_checkpoint(resume_token=stream.resume_token)
+
+    async def poll_once(self, since: datetime, since_id: Optional[Any] = None) -> tuple:
+        """
+        Đọc một trang chuyến đi đổi sau (since, since_id) theo thứ tự (updated_at, _id) và phát sự kiện.
+        Nhiều chuyến cùng updated_at ở ranh giới trang không bị bỏ sót. Trả về (since, since_id, số chuyến).
+        """
+        page_filter = {"updated_at": {"$gt": since}}
+        if since_id is not None:
+            page_filter = {"$or": [page_filter, {"updated_at": since, "_id": {"$gt": since_id}}]}
+        trips = await trips_collection.find(page_filter).sort(
+            [("updated_at", 1), ("_id", 1)]
+        ).limit(self.batch_size).to_list(length=self.batch_size)
+        if trips:
+            events = [await self._to_event(trip) for trip in trips]
+            await publish_events([event for event in events if event is not None])
+            since, since_id = trips[-1]["updated_at"], trips[-1]["_id"]
+            await self._save_checkpoint(polled_until=since, polled_until_id=since_id)
+        return since, since_id, len(trips)
+
+    async def _poll(self):
+        await trips_collection.create_index([("updated_at", 1), ("_id", 1)], background=True)
+        checkpoint = await self._load_checkpoint()
+        since = checkpoint.get("polled_until") or datetime.now(timezone.utc)
+        since_id = checkpoint.get("polled_until_id")
+        logger.info(f"TripEvents: Poll 'trips' theo (updated_at, _id) từ {since}.")
+        while True:
+            since, since_id, count = await self.poll_once(since, since_id)
+            if count < self.batch_size:
+                await asyncio.sleep(TRIP_EVENTS_POLL_INTERVAL_SECONDS)
+
+
+trip_event_consumer = TripEventConsumer()
+trip_events_lease = LeaderLease("trip-events")
+
+
+async def run_trip_event_consumer():
+    """Task nền cho lifespan: chỉ replica giữ lease mới chạy consumer."""
+    await trip_events_lease.run_while_leader(trip_event_consumer.run)
@@ -0,0 +1,130 @@
+# TripService/trip_reaper.py
+"""
+Job nền hủy các chuyến đi PENDING quá lâu không có tài xế nhận (CANCELLED bởi SYSTEM),
+để chúng không làm chậm get_available_trips / get_trips_near_location.
+
+- Mỗi lô: một find (chỉ lấy field cần cho thống kê) + một update_many + một find xác nhận.
+  Chuyến đi được nhận trong lúc đó không bị hủy nhầm vì update_many lọc lại status PENDING.
+- Hành khách được báo qua trip_events: các cập nhật có 'updated_at' được gom thành
+  một request /notify/trips/batch tới LocationService cho cả lô.
+- Bộ đếm (tổng số đã hủy, lần chạy gần nhất) lưu trong collection 'job_metrics',
+  xem qua GET /internal/metrics/reaper.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict
+
+import active_trip_cache
+import models
+import trip_stats
+from database import trips_collection, job_metrics_collection
+from leader_lease import LeaderLease
+
+logger = logging.getLogger(__name__)
+
+PENDING_TRIP_MAX_AGE_SECONDS = int(os.getenv("PENDING_TRIP_MAX_AGE_SECONDS", "600"))
+REAPER_INTERVAL_SECONDS = int(os.getenv("REAPER_INTERVAL_SECONDS", "60"))
+REAPER_BATCH_SIZE = int(os.getenv("REAPER_BATCH_SIZE", "500"))
+REAPER_METRICS_ID = "pending_trip_reaper"
+REAPER_REASON = "Không tìm được tài xế"
+
+
+async def reap_batch(cutoff: datetime, batch_size: int = REAPER_BATCH_SIZE) -> int:
+    """Hủy tối đa batch_size chuyến PENDING tạo trước cutoff. Trả về số chuyến đã hủy."""
+    candidates = await trips_collection.find(
+        {"status": models.TripStatusEnum.PENDING.value, "created_at": {"$lt": cutoff}},
+        {"passenger_id": 1, "driver_id": 1, "status": 1, "fare": 1, "rating": 1}
+    ).sort("created_at", 1).limit(batch_size).to_list(length=batch_size)
+    if not candidates:
+        return 0
+
+    now = datetime.now(timezone.utc)
+    candidate_ids = [trip["_id"] for trip in candidates]
+    await trips_collection.update_many(
+        {"_id": {"$in": candidate_ids}, "status": models.TripStatusEnum.PENDING.value},
+        {
+            "$set": {
+                "status": models.TripStatusEnum.CANCELLED.value,
+                "cancellation": {
+                    "cancelled_by": models.CancelledByEnum.SYSTEM.value,
+                    "reason": REAPER_REASON,
+                    "cancelled_at": now
+                },
+                "updated_at": now
+            },
+            "$push": {"history": {"status": models.TripStatusEnum.CANCELLED.value, "timestamp": now}}
+        }
+    )
+    # updated_at = now đánh dấu đúng các chuyến do lô này hủy (bỏ qua chuyến vừa được tài xế nhận)
+    reaped_ids = {
+        doc["_id"] for doc in await trips_collection.find(
+            {"_id": {"$in": candidate_ids}, "updated_at": now, "status": models.TripStatusEnum.CANCELLED.value},
+            {"_id": 1}
+        ).to_list(length=len(candidate_ids))
+    }
+    reaped = [trip for trip in candidates if trip["_id"] in reaped_ids]
+
+    await trip_stats.record_trip_changes(
+        (trip, {**trip, "status": models.TripStatusEnum.CANCELLED.value}) for trip in reaped
+    )
+    await active_trip_cache.evict_many([str(trip["_id"]) for trip in reaped])
+    return len(reaped)
+
+
+async def _record_run(reaped: int, started_at: datetime):
+    await job_metrics_collection.update_one(
+        {"_id": REAPER_METRICS_ID},
+        {
+            "$inc": {"total_reaped": reaped, "runs": 1},
+            "$set": {"last_run_at": started_at, "last_reaped": reaped}
+        },
+        upsert=True
+    )
+
+
+async def reap_abandoned_trips(max_age_seconds: int = PENDING_TRIP_MAX_AGE_SECONDS) -> int:
+    started_at = datetime.now(timezone.utc)
+    cutoff = started_at - timedelta(seconds=max_age_seconds)
+    total = 0
+    while True:
+        reaped = await reap_batch(cutoff)
+        total += reaped
+        if reaped < REAPER_BATCH_SIZE:
+            break
+    await _record_run(total, started_at)
+    if total:
+        logger.info(f"Reaper: Đã hủy {total} chuyến PENDING quá {max_age_seconds}s không có tài xế.")
+    return total
+
+
+async def get_reaper_metrics() -> Dict:
+    doc = await job_metrics_collection.find_one({"_id": REAPER_METRICS_ID}) or {}
+    return {
+        "total_reaped": doc.get("total_reaped", 0),
+        "runs": doc.get("runs", 0),
+        "last_reaped": doc.get("last_reaped", 0),
+        "last_run_at": doc.get("last_run_at"),
+        "max_age_seconds": PENDING_TRIP_MAX_AGE_SECONDS,
+    }
+
+
+async def _run_loop():
+    await trips_collection.create_index([("status", 1), ("created_at", 1)], background=True)
+    while True:
+        try:
+            await reap_abandoned_trips()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Reaper: Lỗi khi hủy chuyến PENDING quá hạn: {e}")
+        await asyncio.sleep(REAPER_INTERVAL_SECONDS)
+
+
+reaper_lease = LeaderLease("pending-trip-reaper")
+
+
+async def run_trip_reaper():
+    """Task nền cho lifespan: chỉ replica giữ lease mới chạy reaper."""
+    await reaper_lease.run_while_leader(_run_loop)
@@ -0,0 +1,120 @@
+# TripService/trip_stats.py
+"""
+Thống kê chuyến đi được cập nhật dần (incremental) trong collection 'trip_stats'.
+
+Mỗi tài xế/hành khách có một document với _id "driver:<id>" hoặc "passenger:<id>".
+Mỗi khi một chuyến đi thay đổi, ta tính phần đóng góp của chuyến đi TRƯỚC và SAU khi
+thay đổi rồi $inc phần chênh lệch, nên đọc thống kê chỉ cần một find_one.
+Dữ liệu cũ được backfill bằng rebuild_trip_stats.py.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional, Tuple
+
+from pymongo import UpdateOne
+
+import models
+from database import trip_stats_collection
+
+logger = logging.getLogger(__name__)
+
+STAT_FIELDS = ("total_trips", "completed_trips", "cancelled_trips", "total_revenue", "rating_sum", "rating_count")
+
+
+def stats_key(role: str, owner_id: str) -> str:
+    return f"{role}:{owner_id}"
+
+
+def trip_contribution(trip: Optional[dict]) -> Dict[str, Dict[str, float]]:
+    """Phần đóng góp của một chuyến đi vào thống kê của tài xế và hành khách."""
+    if not trip:
+        return {}
+
+    status = trip.get("status")
+    completed = status == models.TripStatusEnum.COMPLETED.value
+    rating = trip.get("rating") or {}
+    counters = {
+        "total_trips": 1,
+        "completed_trips": 1 if completed else 0,
+        "cancelled_trips": 1 if status == models.TripStatusEnum.CANCELLED.value else 0,
+        "total_revenue": ((trip.get("fare") or {}).get("actual") or 0) if completed else 0,
+        "rating_sum": rating.get("stars") or 0,
+        "rating_count": 1 if rating.get("stars") else 0,
+    }
+
+    contribution = {}
+    if trip.get("passenger_id"):
+        contribution[stats_key("passenger", trip["passenger_id"])] = counters
+    if trip.get("driver_id"):
+        contribution[stats_key("driver", trip["driver_id"])] = counters
+    return contribution
+
+
+def compute_stats_delta(before: Optional[dict], after: Optional[dict]) -> Dict[str, Dict[str, float]]:
+    """Chênh lệch (after - before) theo từng key, bỏ các giá trị bằng 0."""
+    delta: Dict[str, Dict[str, float]] = defaultdict(dict)
+    for sign, trip in ((-1, before), (1, after)):
+        for key, counters in trip_contribution(trip).items():
+            for field, value in counters.items():
+                delta[key][field] = delta[key].get(field, 0) + sign * value
+
+    return {
+        key: {field: value for field, value in counters.items() if value}
+        for key, counters in delta.items()
+        if any(counters.values())
+    }
+
+
+async def record_trip_change(before: Optional[dict], after: Optional[dict]):
+    """Áp phần chênh lệch thống kê của một thay đổi chuyến đi (một round trip bulk_write)."""
+    await record_trip_changes([(before, after)])
+
+
+async def record_trip_changes(changes: Iterable[Tuple[Optional[dict], Optional[dict]]]):
+    """Như record_trip_change nhưng gộp nhiều thay đổi (job hàng loạt) vào một bulk_write."""
+    delta: Dict[str, Dict[str, float]] = defaultdict(dict)
+    for before, after in changes:
+        for key, increments in compute_stats_delta(before, after).items():
+            for field, value in increments.items():
+                delta[key][field] = delta[key].get(field, 0) + value
+    delta = {key: {f: v for f, v in inc.items() if v} for key, inc in delta.items()}
+    delta = {key: inc for key, inc in delta.items() if inc}
+    if not delta:
+        return
+
+    now = datetime.now(timezone.utc)
+    operations = []
+    for key, increments in delta.items():
+        role, owner_id = key.split(":", 1)
+        operations.append(UpdateOne(
+            {"_id": key},
+            {
+                "$inc": increments,
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"role": role, "owner_id": owner_id}
+            },
+            upsert=True
+        ))
+    try:
+        await trip_stats_collection.bulk_write(operations, ordered=False)
+    except Exception as e:
+        # Thống kê không được làm hỏng luồng chính; rebuild_trip_stats.py sẽ sửa lệch
+        logger.error(f"Lỗi khi cập nhật trip_stats ({list(delta)}): {e}")
+
+
+def stats_document_to_response(doc: Optional[dict]) -> dict:
+    doc = doc or {}
+    rating_count = doc.get("rating_count") or 0
+    return {
+        "total_trips": doc.get("total_trips", 0),
+        "completed_trips": doc.get("completed_trips", 0),
+        "cancelled_trips": doc.get("cancelled_trips", 0),
+        "total_revenue": doc.get("total_revenue", 0),
+        "average_rating": (doc.get("rating_sum", 0) / rating_count) if rating_count else None
+    }
+
+
+async def get_stats(role: str, owner_id: str) -> dict:
+    doc = await trip_stats_collection.find_one({"_id": stats_key(role, owner_id)})
+    return stats_document_to_response(doc)
@@ -2,6 +2,7 @@
 import os
 from fastapi import FastAPI, Depends, HTTPException, status, APIRouter 
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
+from fastapi.responses import ORJSONResponse
 from datetime import timedelta
 from typing import List, AsyncGenerator
 from contextlib import asynccontextmanager
@@ -34,7 +35,8 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
 app = FastAPI(
     title="UIT-Go User Service (PostgreSQL)", # <-- Đổi tên
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
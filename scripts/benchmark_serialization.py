@@ -0,0 +1,114 @@
+# scripts/benchmark_serialization.py
+"""
+Đo CPU cho mỗi response danh sách chuyến đi: đường cũ (Pydantic validate + jsonable_encoder
++ json chuẩn, như FastAPI làm với response_model) so với đường mới (trusted_dump + orjson).
+
+Không cần MongoDB, chạy từ thư mục gốc repo (cần requirements của TripService):
+    python scripts/benchmark_serialization.py
+    python scripts/benchmark_serialization.py --trips 100 --rounds 200
+
+Script nằm ngoài TripService để không bị COPY vào image của service.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")  # database.py yêu cầu biến này khi import
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TripService"))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+import schemas  # noqa: E402
+from fast_response import dumps, trusted_dump  # noqa: E402
+
+
+def make_trip(i: int) -> dict:
+    created_at = datetime(2024, 1, 1, 8, 0, 0, 123000) + timedelta(minutes=i)
+    return {
+        "_id": ObjectId(),
+        "passenger_id": f"passenger-{i % 50}",
+        "driver_id": f"driver-{i % 20}",
+        "vehicle_type": "4_SEATER",
+        "status": "COMPLETED",
+        "pickup": {"address": f"Điểm đón {i}", "location": {"type": "Point", "coordinates": [106.70 + i * 1e-4, 10.77]}},
+        "dropoff": {"address": f"Điểm đến {i}", "location": {"type": "Point", "coordinates": [106.66, 10.87 - i * 1e-4]}},
+        "startTime": created_at + timedelta(minutes=3),
+        "endTime": created_at + timedelta(minutes=25),
+        "created_at": created_at,
+        "updated_at": created_at + timedelta(minutes=25),
+        "fare": {"estimated": 52000.0, "actual": 55000.0, "discount": 0.0, "tax": 0.0},
+        "route_info": {"distance": 10400.0, "duration": 1320.0, "geometry": "_p~iF~ps|U_ulLnnqC_mqNvxq`@" * 20},
+        "payment": {"method": "Cash", "status": "SUCCESS", "transaction_id": None, "paid_at": created_at + timedelta(minutes=26)},
+        "rating": {"stars": 5, "comment": "Tốt", "rated_at": created_at + timedelta(minutes=30)},
+        "cancellation": None,
+        "history": [
+            {"status": status, "timestamp": created_at + timedelta(minutes=k)}
+            for k, status in enumerate(["PENDING", "ACCEPTED", "ON_TRIP", "COMPLETED"])
+        ],
+        "notes": None,
+        "notified_driver_ids": [f"driver-{k}" for k in range(5)],
+        "rejected_driver_ids": [],
+        "offer_sent_at": created_at,
+    }
+
+
+def summary(trip: dict) -> dict:
+    return dict(
+        _id=str(trip["_id"]),
+        passenger_id=trip["passenger_id"],
+        driver_id=trip["driver_id"],
+        status=trip["status"],
+        pickup_address=trip["pickup"]["address"],
+        dropoff_address=trip["dropoff"]["address"],
+        estimated_fare=trip["fare"].get("estimated"),
+        actual_fare=trip["fare"].get("actual"),
+        created_at=trip["created_at"],
+        startTime=trip.get("startTime"),
+        endTime=trip.get("endTime"),
+    )
+
+
+def old_path(model_cls, docs) -> bytes:
+    validated = [model_cls(**doc) for doc in docs]
+    content = jsonable_encoder(validated, by_alias=True)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def new_path(model_cls, docs) -> bytes:
+    return dumps([trusted_dump(model_cls, doc) for doc in docs])
+
+
+def bench(fn, model_cls, docs, rounds: int) -> float:
+    fn(model_cls, docs)  # warm-up
+    start = time.process_time()
+    for _ in range(rounds):
+        fn(model_cls, docs)
+    return (time.process_time() - start) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark serialize danh sách chuyến đi")
+    parser.add_argument("--trips", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    trips = [make_trip(i) for i in range(args.trips)]
+    full_docs = [{**trip, "_id": str(trip["_id"])} for trip in trips]
+    cases = [
+        ("TripSummaryResponse", schemas.TripSummaryResponse, [summary(trip) for trip in trips]),
+        ("TripResponse", schemas.TripResponse, full_docs),
+    ]
+    print(f"{args.trips} chuyến đi / response, {args.rounds} vòng (CPU ms / response)")
+    for name, model_cls, docs in cases:
+        before = bench(old_path, model_cls, docs, args.rounds)
+        after = bench(new_path, model_cls, docs, args.rounds)
+        print(f"  {name:<22} trước: {before:7.2f} ms   sau: {after:7.2f} ms   nhanh hơn {before / after:4.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""
+Fixture dùng chung cho các test.
+
+Các module của TripService import thẳng 'from database import ...' (kết nối MongoDB/Redis lúc import),
+nên test thay 'database' trong sys.modules bằng trip_database_stub() TRƯỚC khi nạp module.
+Việc nạp diễn ra lúc import file test, trước khi fixture của pytest chạy, nên stub là một hàm thường
+được import từ conftest.
+"""
+import types
+from unittest.mock import MagicMock
+
+# Khớp với các collection trong TripService/database.py
+TRIP_COLLECTIONS = (
+    "trips_collection",
+    "trips_archive_collection",
+    "ratings_collection",
+    "trip_stats_collection",
+    "idempotency_keys_collection",
+    "leases_collection",
+    "trip_event_checkpoints_collection",
+    "job_metrics_collection",
+)
+
+
+def trip_database_stub(**overrides) -> types.ModuleType:
+    """Module 'database' giả cho TripService: collection là MagicMock, không có Redis, không có tầng geocode Mongo."""
+    stub = types.ModuleType("database")
+    for name in TRIP_COLLECTIONS:
+        setattr(stub, name, MagicMock())
+    stub.geocode_places_collection = None
+    stub.sync_database = MagicMock()
+    stub.redis_client = None
+    for name, value in overrides.items():
+        setattr(stub, name, value)
+    return stub
+
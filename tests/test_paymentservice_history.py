@@ -0,0 +1,65 @@
+"""
+Unit tests cho phân trang lịch sử giao dịch ví (crud.get_wallet_transactions) của PaymentService.
+Chạy với: pytest tests/test_paymentservice_history.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock, patch
+from bson import ObjectId
+
+os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")
+payment_service_path = os.path.join(os.path.dirname(__file__), "..", "PaymentService")
+
+
+def _load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(payment_service_path, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+payment_models = _load("payment_models", "models.py")
+payment_schemas = _load("payment_schemas", "schemas.py")
+with patch.dict(sys.modules, {"models": payment_models, "schemas": payment_schemas, "database": MagicMock(), "ledger": MagicMock(),
+                              "trip_cache": MagicMock(), "trip_notifier": MagicMock(), "pricing": MagicMock()}):
+    crud = _load("payment_crud", "crud.py")
+
+
+def _transactions(count):
+    start = datetime(2026, 10, 18, 12, 0, 0)
+    return [{"_id": ObjectId(), "transaction_id": f"TXN_{i}", "created_at": start - timedelta(minutes=i)} for i in range(count)]
+
+
+def test_cursor_round_trip():
+    transaction = _transactions(1)[0]
+    created_at, last_id = crud.decode_history_cursor(crud.encode_history_cursor(transaction))
+    assert created_at == transaction["created_at"] and last_id == transaction["_id"]
+
+
+def test_invalid_cursor_is_rejected():
+    with pytest.raises(ValueError):
+        crud.decode_history_cursor("not-a-cursor")
+
+
+@pytest.mark.asyncio
+async def test_page_fetches_one_extra_row_to_build_next_cursor(monkeypatch):
+    rows = _transactions(4)
+    find_cursor = MagicMock()
+    find_cursor.sort.return_value = find_cursor
+    find_cursor.limit.return_value = find_cursor
+    find_cursor.to_list = AsyncMock(return_value=rows)
+    collection = MagicMock()
+    collection.find.return_value = find_cursor
+    monkeypatch.setattr(crud, "get_transactions_collection", AsyncMock(return_value=collection))
+
+    page = await crud.get_wallet_transactions("d1", limit=3, cursor=crud.encode_history_cursor(rows[0]))
+
+    query, projection = collection.find.call_args.args
+    assert query["user_id"] == "d1" and "$or" in query
+    assert "vnpay_response_code" not in projection
+    find_cursor.limit.assert_called_once_with(4)
+    assert [t["transaction_id"] for t in page["items"]] == ["TXN_0", "TXN_1", "TXN_2"]
+    assert crud.decode_history_cursor(page["next_cursor"])[1] == rows[2]["_id"]
@@ -0,0 +1,83 @@
+"""
+Unit tests cho chống xử lý trùng IPN VNPay (ipn_dedup.py) của PaymentService.
+Chạy với: pytest tests/test_paymentservice_ipn_dedup.py
+"""
+import asyncio
+import pytest
+import sys
+import os
+import importlib.util
+from unittest.mock import MagicMock, patch
+
+payment_service_path = os.path.join(os.path.dirname(__file__), "..", "PaymentService")
+spec = importlib.util.spec_from_file_location("payment_ipn_dedup", os.path.join(payment_service_path, "ipn_dedup.py"))
+ipn_dedup = importlib.util.module_from_spec(spec)
+with patch.dict(sys.modules, {"database": MagicMock(redis_client=None)}):
+    spec.loader.exec_module(ipn_dedup)
+
+
+class FakeStore:
+    def __init__(self):
+        self.locks = set()
+        self.processed = {}
+
+    async def get_processed(self, txn_ref):
+        return self.processed.get(txn_ref)
+
+    async def lock(self, txn_ref):
+        if txn_ref in self.locks or txn_ref in self.processed:
+            return False
+        self.locks.add(txn_ref)
+        return True
+
+    async def mark_processed(self, txn_ref, response):
+        self.processed[txn_ref] = response
+        self.locks.discard(txn_ref)
+
+    async def unlock(self, txn_ref):
+        self.locks.discard(txn_ref)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_and_repeated_ipns_run_handler_once():
+    store = FakeStore()
+    dedup = ipn_dedup.IpnDeduplicator(store)
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"RspCode": "00", "Message": "Confirm Success"}
+
+    responses = await asyncio.gather(*(dedup.run("ORDER1", handler) for _ in range(5)))
+    replay = await dedup.run("ORDER1", handler)
+
+    assert len(calls) == 1
+    assert all(r["RspCode"] == "00" for r in responses) and replay["RspCode"] == "00"
+
+
+@pytest.mark.asyncio
+async def test_failed_processing_is_not_cached():
+    store = FakeStore()
+    dedup = ipn_dedup.IpnDeduplicator(store)
+    results = iter([{"RspCode": "99", "Message": "Unknown error"}, {"RspCode": "00", "Message": "Confirm Success"}])
+
+    async def handler():
+        return next(results)
+
+    assert (await dedup.run("ORDER2", handler))["RspCode"] == "99"
+    assert "ORDER2" not in store.locks
+    assert (await dedup.run("ORDER2", handler))["RspCode"] == "00"
+
+
+@pytest.mark.asyncio
+async def test_locked_elsewhere_asks_vnpay_to_retry(monkeypatch):
+    store = FakeStore()
+    store.locks.add("ORDER3")  # replica khác đang giữ khóa
+    monkeypatch.setattr(ipn_dedup, "IPN_WAIT_SECONDS", 0.05)
+    dedup = ipn_dedup.IpnDeduplicator(store)
+
+    async def handler():
+        raise AssertionError("không được chạy khi replica khác giữ khóa")
+
+    assert await dedup.run("ORDER3", handler) == ipn_dedup.RETRY_LATER_RESPONSE
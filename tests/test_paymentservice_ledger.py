@@ -0,0 +1,75 @@
+"""
+Unit tests cho sổ cái kép (ledger.py) của PaymentService.
+Chạy với: pytest tests/test_paymentservice_ledger.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+from unittest.mock import AsyncMock, MagicMock, patch
+
+payment_service_path = os.path.join(os.path.dirname(__file__), "..", "PaymentService")
+
+
+def _load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(payment_service_path, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# PaymentService dùng chung tên module (models, database) với các service khác: chỉ thay tạm khi nạp
+payment_models = _load("payment_models", "models.py")
+mock_database = MagicMock()
+with patch.dict(sys.modules, {"models": payment_models, "database": mock_database}):
+    ledger = _load("payment_ledger", "ledger.py")
+
+
+def test_posting_is_balanced_and_sequenced():
+    posting = ledger.build_posting(
+        posting_id="TXN_1", driver_id="d1", amount=40000.0,
+        transaction_type=payment_models.TransactionType.EARNING, seq=7, balance_after=90000.0, trip_id="t1"
+    )
+
+    assert sum(entry["amount"] for entry in posting) == 0
+    wallet_entry, counter_entry = posting
+    assert wallet_entry["account"] == "wallet:d1" and wallet_entry["seq"] == 7
+    assert counter_entry["account"] == "platform:trip_earnings" and "seq" not in counter_entry
+    assert {entry["posting_id"] for entry in posting} == {"TXN_1"}
+
+
+@pytest.mark.asyncio
+async def test_append_postings_batches_entries_and_snapshots_on_interval(monkeypatch):
+    entries_coll, snapshots_coll = MagicMock(), MagicMock()
+    entries_coll.insert_many = AsyncMock()
+    snapshots_coll.insert_many = AsyncMock()
+    monkeypatch.setattr(ledger, "get_ledger_entries_collection", AsyncMock(return_value=entries_coll))
+    monkeypatch.setattr(ledger, "get_ledger_snapshots_collection", AsyncMock(return_value=snapshots_coll))
+    monkeypatch.setattr(ledger, "LEDGER_SNAPSHOT_INTERVAL", 100)
+    earning = payment_models.TransactionType.EARNING
+    postings = [
+        ledger.build_posting("TXN_1", "d1", 10.0, earning, seq=99, balance_after=990.0),
+        ledger.build_posting("TXN_2", "d1", 10.0, earning, seq=100, balance_after=1000.0),
+    ]
+
+    written = await ledger.append_postings(postings)
+
+    assert written == 4
+    entries_coll.insert_many.assert_awaited_once()
+    snapshots = snapshots_coll.insert_many.call_args.args[0]
+    assert [(s["account"], s["seq"], s["balance"]) for s in snapshots] == [("wallet:d1", 100, 1000.0)]
+
+
+@pytest.mark.asyncio
+async def test_first_entry_of_legacy_wallet_records_opening_snapshot(monkeypatch):
+    entries_coll, snapshots_coll = MagicMock(), MagicMock()
+    entries_coll.insert_many = AsyncMock()
+    snapshots_coll.insert_many = AsyncMock()
+    monkeypatch.setattr(ledger, "get_ledger_entries_collection", AsyncMock(return_value=entries_coll))
+    monkeypatch.setattr(ledger, "get_ledger_snapshots_collection", AsyncMock(return_value=snapshots_coll))
+    posting = ledger.build_posting("TXN_1", "d1", 50.0, payment_models.TransactionType.TOPUP, seq=1, balance_after=550.0)
+
+    await ledger.append_postings([posting])
+
+    snapshots = snapshots_coll.insert_many.call_args.args[0]
+    assert [(s["seq"], s["balance"]) for s in snapshots] == [(0, 500.0)]
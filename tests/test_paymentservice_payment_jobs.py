@@ -0,0 +1,201 @@
+"""
+Unit tests cho hàng đợi thanh toán hoàn thành chuyến (payment_jobs) và xử lý idempotent của PaymentService.
+Chạy với: pytest tests/test_paymentservice_payment_jobs.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+from pymongo.errors import DuplicateKeyError
+
+os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")
+payment_service_path = os.path.join(os.path.dirname(__file__), "..", "PaymentService")
+
+
+def _load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(payment_service_path, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+payment_models = _load("payment_models", "models.py")
+payment_schemas = _load("payment_schemas", "schemas.py")
+payment_pricing = _load("payment_pricing", "pricing.py")
+with patch.dict(sys.modules, {"models": payment_models, "schemas": payment_schemas, "database": MagicMock(),
+                              "ledger": MagicMock(), "trip_cache": MagicMock(), "trip_notifier": MagicMock(), "pricing": payment_pricing}):
+    crud = _load("payment_crud_jobs", "crud.py")
+    with patch.dict(sys.modules, {"crud": crud}):
+        payment_jobs = _load("payment_payment_jobs", "payment_jobs.py")
+
+PAYLOAD = {"trip_id": "trip-1", "driver_id": "drv-1", "user_id": "usr-1", "distance_km": 5.0, "payment_method": "CASH"}
+QUEUED = payment_models.PaymentJobStatus.QUEUED.value
+PROCESSING = payment_models.PaymentJobStatus.PROCESSING.value
+
+
+def _job(status=PROCESSING, attempts=1):
+    return {"_id": "job-1", "trip_id": "trip-1", "payload": dict(PAYLOAD), "status": status, "attempts": attempts}
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    coll = MagicMock()
+    coll.find_one_and_update = AsyncMock()
+    coll.find_one = AsyncMock()
+    coll.update_one = AsyncMock()
+    monkeypatch.setattr(payment_jobs, "get_payment_jobs_collection", AsyncMock(return_value=coll))
+    return coll
+
+
+@pytest.mark.asyncio
+async def test_enqueue_returns_existing_job_for_trip(jobs):
+    jobs.find_one_and_update.return_value = _job(status=QUEUED)
+
+    job = await payment_jobs.enqueue_trip_completion(payment_schemas.TripCompletionRequest(**PAYLOAD))
+
+    assert job["_id"] == "job-1"
+    filter_, update = jobs.find_one_and_update.await_args.args
+    assert filter_ == {"trip_id": "trip-1"} and "$setOnInsert" in update
+    assert jobs.find_one_and_update.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_enqueue_requeues_failed_job_and_reads_back_on_duplicate(jobs):
+    failed = _job(status=payment_models.PaymentJobStatus.FAILED.value, attempts=5)
+    jobs.find_one_and_update.side_effect = [DuplicateKeyError("dup"), {**failed, "status": QUEUED, "attempts": 0}]
+    jobs.find_one.return_value = failed
+
+    job = await payment_jobs.enqueue_trip_completion(payment_schemas.TripCompletionRequest(**PAYLOAD))
+
+    assert job["status"] == QUEUED
+    filter_, update = jobs.find_one_and_update.await_args.args
+    assert filter_ == {"_id": "job-1", "status": payment_models.PaymentJobStatus.FAILED.value}
+    assert update["$set"]["status"] == QUEUED and update["$set"]["attempts"] == 0
+    assert update["$set"]["fare_details"]["pricing_version"] == payment_pricing.get_plan().version
+
+
+@pytest.mark.asyncio
+async def test_fare_quote_is_locked_at_enqueue_and_used_by_worker(monkeypatch, jobs):
+    jobs.find_one_and_update.side_effect = lambda filter_, update, **kwargs: {**update["$setOnInsert"], "attempts": 1}
+
+    job = await payment_jobs.enqueue_trip_completion(payment_schemas.TripCompletionRequest(**PAYLOAD))
+
+    quote = job["fare_details"]
+    assert quote["pricing_version"] == payment_pricing.get_plan().version and quote["total_fare"] > 0
+    # Bảng giá đổi sau khi xếp hàng: GET và worker vẫn dùng báo giá đã chốt
+    monkeypatch.setattr(crud, "calculate_request_fare", MagicMock(side_effect=AssertionError("re-quoted")))
+    assert payment_jobs.to_response(job).fare_details.total_fare == quote["total_fare"]
+
+    process = AsyncMock(return_value=MagicMock(success=True, model_dump=MagicMock(return_value={})))
+    monkeypatch.setattr(crud, "process_trip_completion_payment", process)
+    await payment_jobs.process_job(job, "w-1")
+    assert process.await_args.args[1].model_dump(mode="json") == quote
+
+
+@pytest.mark.asyncio
+async def test_claim_takes_due_or_expired_jobs_and_counts_attempt(jobs):
+    await payment_jobs.claim_next_job("w-1")
+
+    filter_, update = jobs.find_one_and_update.await_args.args
+    assert [clause["status"] for clause in filter_["$or"]] == [QUEUED, PROCESSING]
+    assert "$lt" in filter_["$or"][1]["locked_until"]  # job PROCESSING chỉ nhận lại khi hết hạn khóa
+    assert update["$set"]["status"] == PROCESSING and update["$set"]["worker_id"] == "w-1"
+    assert update["$inc"] == {"attempts": 1}
+
+
+@pytest.mark.asyncio
+async def test_failed_attempt_is_retried_with_backoff_by_owning_worker(monkeypatch, jobs):
+    monkeypatch.setattr(crud, "process_trip_completion_payment", AsyncMock(side_effect=RuntimeError("wallet down")))
+
+    await payment_jobs.process_job(_job(attempts=2), "w-1")
+
+    filter_, update = jobs.update_one.await_args.args
+    assert filter_ == {"_id": "job-1", "worker_id": "w-1", "status": PROCESSING}
+    assert update["$set"]["status"] == QUEUED and update["$set"]["error"] == "wallet down"
+    assert update["$set"]["available_at"] > datetime.now(timezone.utc)
+
+
+@pytest.mark.asyncio
+async def test_last_attempt_fails_job_and_notifies_trip_service(monkeypatch, jobs):
+    monkeypatch.setattr(crud, "process_trip_completion_payment", AsyncMock(side_effect=RuntimeError("wallet down")))
+    monkeypatch.setattr(crud, "find_trip_completion_payment", AsyncMock(return_value={"transaction_id": "CASH_1"}))
+    notify = AsyncMock()
+    monkeypatch.setattr(crud, "notify_trip_service_payment_status", notify)
+
+    await payment_jobs.process_job(_job(attempts=payment_jobs.PAYMENT_JOB_MAX_ATTEMPTS), "w-1")
+
+    assert jobs.update_one.await_args.args[1]["$set"]["status"] == payment_models.PaymentJobStatus.FAILED.value
+    assert notify.await_args.kwargs["transaction_id"] == "CASH_1"
+    assert notify.await_args.kwargs["status"] == payment_models.TransactionStatus.SUCCESS
+
+
+@pytest.mark.asyncio
+async def test_reclaimed_job_reuses_payment_and_does_not_credit_twice(monkeypatch):
+    monkeypatch.setattr(crud, "find_trip_completion_payment", AsyncMock(return_value={"transaction_id": "CASH_1"}))
+    monkeypatch.setattr(crud, "get_or_create_wallet", AsyncMock(return_value={"driver_id": "drv-1", "balance": 50000.0}))
+    apply_change = AsyncMock(side_effect=DuplicateKeyError("EARNING_trip-1"))
+    save = AsyncMock()
+    monkeypatch.setattr(crud, "_apply_wallet_change", apply_change)
+    monkeypatch.setattr(crud, "save_trip_completion_transaction", save)
+    monkeypatch.setattr(crud, "notify_trip_service_payment_status", AsyncMock())
+
+    result = await crud.process_trip_completion_payment(payment_schemas.TripCompletionRequest(**PAYLOAD))
+
+    assert result.success and result.transaction_id == "CASH_1" and result.new_driver_balance == 50000.0
+    save.assert_not_awaited()
+    assert apply_change.await_args.args[2].transaction_id == "EARNING_trip-1"
+
+
+@pytest.mark.asyncio
+async def test_credit_failure_raises_so_job_is_retried(monkeypatch):
+    monkeypatch.setattr(crud, "find_trip_completion_payment", AsyncMock(return_value=None))
+    monkeypatch.setattr(crud, "save_trip_completion_transaction", AsyncMock())
+    monkeypatch.setattr(crud, "credit_driver_wallet", AsyncMock(return_value=None))
+    notify = AsyncMock()
+    monkeypatch.setattr(crud, "notify_trip_service_payment_status", notify)
+
+    with pytest.raises(RuntimeError):
+        await crud.process_trip_completion_payment(payment_schemas.TripCompletionRequest(**PAYLOAD))
+    crud.save_trip_completion_transaction.assert_awaited_once()  # đã lưu PAYMENT, lần thử lại sẽ dùng lại
+    notify.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_credit_duplicate_is_not_applied_twice(monkeypatch):
+    apply_change = AsyncMock(side_effect=DuplicateKeyError("EARNING_trip-1"))
+    monkeypatch.setattr(crud, "_apply_wallet_change", apply_change)
+    monkeypatch.setattr(crud, "get_or_create_wallet", AsyncMock(return_value={"driver_id": "drv-1", "balance": 1.0}))
+
+    wallet = await crud.credit_driver_wallet("drv-1", 1.0, "trip-1")
+
+    assert wallet == {"driver_id": "drv-1", "balance": 1.0}
+    assert apply_change.await_args.args[2].transaction_id == "EARNING_trip-1"
+
+
+@pytest.mark.asyncio
+async def test_job_run_twice_credits_balance_exactly_once(monkeypatch):
+    # Hai worker cùng chạy một job (khóa hết hạn) trên MongoDB không có transaction
+    inserted = set()
+
+    async def insert_one(document, session=None):
+        if document["transaction_id"] in inserted:
+            raise DuplicateKeyError("E11000", details={"keyPattern": {"transaction_id": 1}})
+        inserted.add(document["transaction_id"])
+
+    transactions = MagicMock(insert_one=AsyncMock(side_effect=insert_one), update_one=AsyncMock())
+    wallets = MagicMock()
+    wallets.find_one_and_update = AsyncMock(return_value={"_id": "w1", "driver_id": "drv-1", "balance": 1.0, "ledger_seq": 1})
+    monkeypatch.setattr(crud, "get_transactions_collection", AsyncMock(return_value=transactions))
+    monkeypatch.setattr(crud, "get_wallets_collection", AsyncMock(return_value=wallets))
+    monkeypatch.setattr(crud, "run_in_transaction", lambda callback: callback(None))
+    monkeypatch.setattr(crud.ledger, "append_postings", AsyncMock())
+    monkeypatch.setattr(crud, "get_or_create_wallet", AsyncMock(return_value={"driver_id": "drv-1", "balance": 1.0}))
+
+    assert await crud.credit_driver_wallet("drv-1", 1.0, "trip-1")
+    assert await crud.credit_driver_wallet("drv-1", 1.0, "trip-1") == {"driver_id": "drv-1", "balance": 1.0}
+
+    wallets.find_one_and_update.assert_awaited_once()
+    assert wallets.find_one_and_update.await_args.args[1]["$inc"]["balance"] == 1.0
+    crud.ledger.append_postings.assert_awaited_once()
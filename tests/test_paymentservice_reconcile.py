@@ -0,0 +1,142 @@
+"""
+Unit tests cho đối soát giao dịch thanh toán với TripService (reconcile_payments) của PaymentService.
+Chạy với: pytest tests/test_paymentservice_reconcile.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+from unittest.mock import AsyncMock, MagicMock, patch
+
+os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")
+payment_service_path = os.path.join(os.path.dirname(__file__), "..", "PaymentService")
+
+
+def _load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(payment_service_path, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+payment_models = _load("payment_models", "models.py")
+with patch.dict(sys.modules, {"models": payment_models, "database": MagicMock(), "trip_notifier": MagicMock()}):
+    reconcile_payments = _load("payment_reconcile_payments", "reconcile_payments.py")
+
+IssueKind = reconcile_payments.IssueKind
+
+
+def _transaction(status="PENDING", amount=70000, transaction_id="TXN_1", trip_id="trip-1"):
+    return {"_id": f"oid-{transaction_id}", "transaction_id": transaction_id, "trip_id": trip_id, "amount": amount, "status": status}
+
+
+def _trip(payment_status="PENDING", payment_transaction_id=None, actual=70000):
+    return {"_id": "trip-1", "fare": {"actual": actual},
+            "payment": {"method": "E-WALLET", "status": payment_status, "transaction_id": payment_transaction_id}}
+
+
+def test_stale_pending_payment_expires_and_trip_is_told():
+    issues, notify = reconcile_payments.reconcile_transaction(_transaction(), _trip())
+    assert issues == [IssueKind.EXPIRED]
+    assert notify == "FAILED"
+
+
+def test_trip_paid_with_this_transaction_is_flagged_not_expired():
+    issues, notify = reconcile_payments.reconcile_transaction(_transaction(), _trip("SUCCESS", "TXN_1"))
+    assert issues == [IssueKind.STATUS_MISMATCH]
+    assert notify is None
+
+
+def test_failed_transaction_does_not_override_a_later_payment():
+    issues, notify = reconcile_payments.reconcile_transaction(_transaction("FAILED"), _trip("PENDING", "TXN_2"))
+    assert issues == [] and notify is None
+
+
+def test_amount_mismatch_and_missing_trip():
+    issues, _ = reconcile_payments.reconcile_transaction(_transaction("FAILED", amount=50000), _trip("FAILED", "TXN_1"))
+    assert issues == [IssueKind.AMOUNT_MISMATCH]
+    assert reconcile_payments.reconcile_transaction(_transaction(), None) == ([IssueKind.TRIP_NOT_FOUND], None)
+
+
+class _AsyncCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def __aiter__(self):
+        self._it = iter(self.docs)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._it)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def _patch_batch(monkeypatch, trips, failed_ids):
+    """Giả lập các collection; failed_ids là các _id đang FAILED khi đọc lại sau bước chuyển trạng thái."""
+    transactions_coll, issues_coll = MagicMock(), MagicMock()
+    transactions_coll.bulk_write = AsyncMock()
+    transactions_coll.find = MagicMock(return_value=_AsyncCursor([{"_id": _id} for _id in failed_ids]))
+    issues_coll.bulk_write = AsyncMock()
+    notifier = MagicMock(enqueue_payment_statuses=AsyncMock())
+    fetch_trips = AsyncMock(return_value=trips)
+    monkeypatch.setattr(reconcile_payments, "fetch_trips", fetch_trips)
+    monkeypatch.setattr(reconcile_payments, "get_transactions_collection", AsyncMock(return_value=transactions_coll))
+    monkeypatch.setattr(reconcile_payments, "get_reconciliation_issues_collection", AsyncMock(return_value=issues_coll))
+    monkeypatch.setattr(reconcile_payments, "trip_notifier", notifier)
+    return fetch_trips, transactions_coll, issues_coll, notifier
+
+
+@pytest.mark.asyncio
+async def test_batch_fetches_trips_once_and_writes_corrections_in_bulk(monkeypatch):
+    transactions = [_transaction(), _transaction("FAILED", transaction_id="TXN_2", trip_id="trip-2")]
+    fetch_trips, transactions_coll, issues_coll, notifier = _patch_batch(monkeypatch, {"trip-1": _trip()}, ["oid-TXN_1"])
+    calls = MagicMock()
+    calls.attach_mock(transactions_coll.bulk_write, "transactions_bulk_write")
+    calls.attach_mock(notifier.enqueue_payment_statuses, "enqueue")
+
+    counts = await reconcile_payments.reconcile_batch(transactions, "run-1")
+
+    fetch_trips.assert_awaited_once_with(["trip-1", "trip-2"])
+    assert counts == {"scanned": 2, "notified": 1, IssueKind.EXPIRED: 1, IssueKind.TRIP_NOT_FOUND: 1}
+    (expire_ops,), (stamp_ops,) = [c.args for c in transactions_coll.bulk_write.await_args_list]
+    [expire] = expire_ops
+    assert expire._filter == {"_id": "oid-TXN_1", "status": "PENDING"}
+    assert expire._doc["$set"]["status"] == "FAILED"
+    # Giao dịch không cần sửa vẫn được đóng dấu để lượt sau không quét lại
+    assert [op._filter for op in stamp_ops] == [{"_id": "oid-TXN_1"}, {"_id": "oid-TXN_2"}]
+    assert all(list(op._doc["$set"]) == ["reconciled_at"] for op in stamp_ops)
+    assert [op._filter["_id"] for op in issues_coll.bulk_write.await_args.args[0]] == [
+        "oid-TXN_1:EXPIRED", "oid-TXN_2:TRIP_NOT_FOUND"
+    ]
+    notifier.enqueue_payment_statuses.assert_awaited_once_with([("trip-1", "TXN_1", "FAILED")])
+    # Chuyển FAILED trước, báo TripService sau, đóng dấu sau cùng
+    assert [name for name, _, _ in calls.mock_calls] == ["transactions_bulk_write", "enqueue", "transactions_bulk_write"]
+
+
+@pytest.mark.asyncio
+async def test_expired_payment_paid_meanwhile_is_not_reported_failed(monkeypatch):
+    # Callback VNPay ghi SUCCESS giữa lúc đọc lô và lúc chuyển FAILED: bước chuyển không khớp gì
+    _, transactions_coll, _, notifier = _patch_batch(monkeypatch, {"trip-1": _trip()}, failed_ids=[])
+
+    counts = await reconcile_payments.reconcile_batch([_transaction()], "run-1")
+
+    assert counts["notified"] == 0
+    notifier.enqueue_payment_statuses.assert_awaited_once_with([])
+    assert transactions_coll.find.call_args.args[0] == {"_id": {"$in": ["oid-TXN_1"]}, "status": "FAILED"}
+
+
+def test_query_skips_already_reconciled_transactions():
+    query = reconcile_payments.build_query(reconcile_payments.datetime.now(reconcile_payments.timezone.utc))
+    assert query["reconciled_at"] is None
+
+
+@pytest.mark.asyncio
+async def test_dry_run_writes_nothing(monkeypatch):
+    monkeypatch.setattr(reconcile_payments, "fetch_trips", AsyncMock(return_value={"trip-1": _trip()}))
+    get_transactions = AsyncMock()
+    monkeypatch.setattr(reconcile_payments, "get_transactions_collection", get_transactions)
+    counts = await reconcile_payments.reconcile_batch([_transaction()], "run-1", dry_run=True)
+    assert counts[IssueKind.EXPIRED] == 1
+    get_transactions.assert_not_awaited()
@@ -0,0 +1,173 @@
+"""
+Unit tests cho quyết toán tài xế theo ngày (settlement.py) của PaymentService.
+Chạy với: pytest tests/test_paymentservice_settlement.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+from datetime import date, datetime, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from fastapi.testclient import TestClient
+
+payment_service_path = os.path.join(os.path.dirname(__file__), "..", "PaymentService")
+
+
+def _load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(payment_service_path, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")
+payment_models = _load("payment_models", "models.py")
+payment_schemas = _load("payment_schemas", "schemas.py")
+with patch.dict(sys.modules, {"models": payment_models, "database": MagicMock(), "crud": MagicMock(), "pricing": MagicMock()}):
+    settlement = _load("payment_settlement", "settlement.py")
+settlement_stub = MagicMock()
+with patch.dict(sys.modules, {"models": payment_models, "schemas": payment_schemas, "database": MagicMock(), "crud": MagicMock(),
+                              "payment_jobs": MagicMock(), "trip_notifier": MagicMock(), "ledger": MagicMock(),
+                              "settlement": settlement_stub, "ipn_dedup": MagicMock()}):
+    payment_main = _load("payment_main", "main.py")
+
+
+def test_pipeline_covers_one_utc_day_and_resumes_after_checkpoint():
+    pipeline = settlement.build_pipeline(date(2026, 10, 18), after_driver_id="d500")
+
+    match = pipeline[0]["$match"]
+    assert match["transaction_type"] == "EARNING" and match["status"] == "SUCCESS"
+    assert match["created_at"] == {
+        "$gte": datetime(2026, 10, 18, tzinfo=timezone.utc),
+        "$lt": datetime(2026, 10, 19, tzinfo=timezone.utc),
+    }
+    assert match["user_id"] == {"$gt": "d500"}
+    assert pipeline[-1] == {"$sort": {"_id": 1}}
+
+
+def test_settlement_record_derives_commission_from_net_earnings():
+    row = {"_id": "d1", "net_earnings": 160000.0, "transaction_count": 3, "trip_count": 3}
+
+    record = settlement.settlement_record(date(2026, 10, 18), row, 0.20, datetime.now(timezone.utc))
+
+    assert record["net_payout"] == 160000.0
+    assert record["gross_fare"] == 200000.0
+    assert record["commission"] == 40000.0
+    assert record["settlement_date"] == "2026-10-18" and record["driver_id"] == "d1"
+
+
+class _AsyncCursor:
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.rows:
+            raise StopAsyncIteration
+        return self.rows.pop(0)
+
+
+@pytest.mark.asyncio
+async def test_settle_day_resumes_after_checkpoint(monkeypatch):
+    transactions_coll, settlements_coll, runs_coll = MagicMock(), MagicMock(), MagicMock()
+    transactions_coll.aggregate = MagicMock(return_value=_AsyncCursor([
+        {"_id": "d600", "net_earnings": 80000.0, "transaction_count": 1, "trip_count": 1}
+    ]))
+    settlements_coll.bulk_write = AsyncMock()
+    runs_coll.find_one = AsyncMock(return_value={
+        "_id": "2026-10-18", "status": "RUNNING", "last_driver_id": "d500",
+        "drivers": 500, "net_payout": 1000000.0, "commission": 250000.0
+    })
+    runs_coll.update_one = AsyncMock()
+    monkeypatch.setattr(settlement, "get_transactions_collection", AsyncMock(return_value=transactions_coll))
+    monkeypatch.setattr(settlement, "get_settlements_collection", AsyncMock(return_value=settlements_coll))
+    monkeypatch.setattr(settlement, "get_settlement_runs_collection", AsyncMock(return_value=runs_coll))
+    monkeypatch.setattr(settlement.pricing, "get_plan", MagicMock(return_value=MagicMock(commission_rate=0.20)))
+
+    result = await settlement.settle_day(date(2026, 10, 18))
+
+    pipeline = transactions_coll.aggregate.call_args.args[0]
+    assert pipeline[0]["$match"]["user_id"] == {"$gt": "d500"}
+    assert result["drivers"] == 501 and result["net_payout"] == 1080000.0 and result["commission"] == 270000.0
+    [op] = settlements_coll.bulk_write.await_args.args[0]
+    assert op._filter["_id"] == "2026-10-18:d600"
+    checkpoint = runs_coll.update_one.await_args_list[0].args[1]["$set"]
+    assert checkpoint["last_driver_id"] == "d600" and checkpoint["drivers"] == 501
+
+
+def _settlements(records):
+    coll = MagicMock()
+    find = MagicMock()
+    find.sort.return_value.limit.return_value.to_list = AsyncMock(side_effect=[records, []])
+    coll.find = MagicMock(return_value=find)
+    coll.bulk_write = AsyncMock()
+    return coll
+
+
+@pytest.mark.asyncio
+async def test_payout_uses_fixed_transaction_id_per_settlement(monkeypatch):
+    coll = _settlements([{"_id": "2026-10-18:d1", "driver_id": "d1", "net_payout": 160000.0,
+                          "settlement_date": "2026-10-18", "status": "PENDING"}])
+    monkeypatch.setattr(settlement, "get_settlements_collection", AsyncMock(return_value=coll))
+    monkeypatch.setattr(settlement.crud, "debit_driver_wallet", AsyncMock(return_value={"balance": 0.0}))
+
+    counts = await settlement.payout_day(date(2026, 10, 18))
+
+    assert counts == {"paid": 1, "failed": 0}
+    assert settlement.crud.debit_driver_wallet.await_args.args[:3] == ("d1", 160000.0, "PAYOUT_2026-10-18:d1")
+    [op] = coll.bulk_write.await_args.args[0]
+    assert op._filter == {"_id": "2026-10-18:d1", "status": "PENDING"} and op._doc["$set"]["status"] == "PAID"
+
+
+@pytest.mark.asyncio
+async def test_payout_retry_failed_picks_up_failed_records(monkeypatch):
+    coll = _settlements([{"_id": "2026-10-18:d2", "driver_id": "d2", "net_payout": 50000.0,
+                          "settlement_date": "2026-10-18", "status": "FAILED"}])
+    monkeypatch.setattr(settlement, "get_settlements_collection", AsyncMock(return_value=coll))
+    monkeypatch.setattr(settlement.crud, "debit_driver_wallet", AsyncMock(return_value={"balance": 0.0}))
+
+    counts = await settlement.payout_day(date(2026, 10, 18), retry_failed=True)
+
+    assert coll.find.call_args.args[0]["status"] == {"$in": ["PENDING", "FAILED"]}
+    assert counts == {"paid": 1, "failed": 0}
+    settlement.crud.debit_driver_wallet.assert_awaited_once()
+    [op] = coll.bulk_write.await_args.args[0]
+    assert op._filter == {"_id": "2026-10-18:d2", "status": "FAILED"} and op._doc["$set"]["status"] == "PAID"
+
+
+@pytest.mark.asyncio
+async def test_driver_settlements_read_only_the_response_fields(monkeypatch):
+    cursor = MagicMock()
+    cursor.sort.return_value = cursor
+    cursor.limit.return_value = cursor
+    cursor.to_list = AsyncMock(return_value=[])
+    settlements_coll = MagicMock(find=MagicMock(return_value=cursor))
+    monkeypatch.setattr(settlement, "get_settlements_collection", AsyncMock(return_value=settlements_coll))
+
+    await settlement.get_driver_settlements("d1", limit=10)
+
+    query, projection = settlements_coll.find.call_args.args
+    assert query == {"driver_id": "d1"} and "trip_ids" not in projection
+    assert set(projection) <= set(payment_schemas.SettlementItem.model_fields)
+    cursor.limit.assert_called_once_with(10)
+
+
+def test_settlements_endpoint_bounds_limit_and_hides_extra_fields():
+    settlement_stub.get_driver_settlements = AsyncMock(return_value=[{
+        "_id": "2026-10-18:d1", "settlement_date": "2026-10-18", "status": "PAID", "net_payout": 80000.0,
+        "gross_fare": 100000.0, "commission": 20000.0, "transaction_count": 2, "trip_count": 2,
+        "updated_at": datetime(2026, 10, 19, tzinfo=timezone.utc), "trip_ids": ["t1", "t2"]
+    }])
+    client = TestClient(payment_main.app)
+
+    assert client.get("/v1/wallets/d1/settlements", params={"limit": -1}).status_code == 422
+    assert client.get("/v1/wallets/d1/settlements", params={"limit": 0}).status_code == 422
+    response = client.get("/v1/wallets/d1/settlements")
+
+    assert response.status_code == 200
+    [item] = response.json()
+    assert item["settlement_id"] == "2026-10-18:d1" and "trip_ids" not in item
+    settlement_stub.get_driver_settlements.assert_awaited_once_with("d1", 30)
@@ -0,0 +1,234 @@
+"""
+Unit tests cho run_in_transaction (fallback khi MongoDB không hỗ trợ transaction) và
+_apply_wallet_change trên đường ghi tuần tự, và các index unique bắt buộc khi khởi động của PaymentService.
+Chạy với: pytest tests/test_paymentservice_transactions.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+from unittest.mock import AsyncMock, MagicMock, patch
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")
+
+payment_service_path = os.path.join(os.path.dirname(__file__), "..", "PaymentService")
+
+
+def _load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(payment_service_path, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+payment_database = _load("payment_database", "database.py")
+payment_models = _load("payment_models", "models.py")
+payment_schemas = _load("payment_schemas", "schemas.py")
+with patch.dict(sys.modules, {"models": payment_models, "schemas": payment_schemas, "database": MagicMock(),
+                              "ledger": MagicMock(), "trip_cache": MagicMock(), "trip_notifier": MagicMock(), "pricing": MagicMock()}):
+    crud = _load("payment_crud_wallet", "crud.py")
+
+
+class FakeTransaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession(FakeTransaction):
+    def start_transaction(self):
+        return FakeTransaction()
+
+
+class FakeClient:
+    def __init__(self):
+        self.sessions = 0
+
+    async def start_session(self):
+        self.sessions += 1
+        return FakeSession()
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(payment_database, "client", client)
+    monkeypatch.setattr(payment_database, "_transactions_supported", None)
+    return client
+
+
+@pytest.mark.asyncio
+async def test_falls_back_to_standalone_writes_when_unsupported(fake_client):
+    sessions_seen = []
+
+    async def callback(session):
+        sessions_seen.append(session)
+        if session is not None:
+            raise OperationFailure("Transaction numbers are only allowed on a replica set member or mongos", code=20)
+        return "ok"
+
+    assert await payment_database.run_in_transaction(callback) == "ok"
+    assert await payment_database.run_in_transaction(callback) == "ok"
+    # Lần đầu thử transaction rồi fallback; lần sau đi thẳng đường standalone
+    assert sessions_seen[0] is not None and sessions_seen[1:] == [None, None]
+    assert fake_client.sessions == 1
+
+
+@pytest.mark.asyncio
+async def test_retries_transient_write_conflicts(fake_client):
+    attempts = []
+
+    async def callback(session):
+        attempts.append(session)
+        if len(attempts) == 1:
+            raise OperationFailure("WriteConflict", code=112, details={"errorLabels": ["TransientTransactionError"]})
+        return "ok"
+
+    assert await payment_database.run_in_transaction(callback) == "ok"
+    assert len(attempts) == 2 and all(session is not None for session in attempts)
+
+
+@pytest.mark.asyncio
+async def test_other_errors_are_not_swallowed(fake_client):
+    async def callback(session):
+        raise OperationFailure("E11000 duplicate key", code=11000)
+
+    with pytest.raises(OperationFailure):
+        await payment_database.run_in_transaction(callback)
+
+
+class FakeTransactions:
+    """'transactions' với unique index transaction_id, như trên MongoDB standalone (không có session)."""
+
+    def __init__(self, existing=()):
+        self.rows = {transaction_id: {"transaction_id": transaction_id} for transaction_id in existing}
+
+    async def insert_one(self, document, session=None):
+        if document["transaction_id"] in self.rows:
+            raise DuplicateKeyError("E11000", details={"keyPattern": {"transaction_id": 1}})
+        self.rows[document["transaction_id"]] = dict(document)
+
+    async def update_one(self, filter_, update, session=None):
+        self.rows[filter_["transaction_id"]].update(update["$set"])
+
+    async def delete_one(self, filter_, session=None):
+        self.rows.pop(filter_["transaction_id"], None)
+
+
+WALLET = {"_id": "w1", "driver_id": "d1", "balance": 50000.0, "ledger_seq": 1}
+
+
+@pytest.fixture
+def standalone_wallet(monkeypatch):
+    wallets = MagicMock()
+    wallets.find_one_and_update = AsyncMock(return_value=dict(WALLET))
+    transactions = FakeTransactions(existing=["TOPUP_1", "PAYOUT_2026-10-18:d1"])
+    monkeypatch.setattr(crud, "get_wallets_collection", AsyncMock(return_value=wallets))
+    monkeypatch.setattr(crud, "get_transactions_collection", AsyncMock(return_value=transactions))
+    monkeypatch.setattr(crud, "run_in_transaction", lambda callback: callback(None))
+    monkeypatch.setattr(crud.ledger, "append_postings", AsyncMock())
+    return wallets, transactions
+
+
+def _entry(transaction_id):
+    return payment_models.Transaction(transaction_id=transaction_id, user_id="d1", amount=50000.0,
+                                      transaction_type=payment_models.TransactionType.TOPUP,
+                                      status=payment_models.TransactionStatus.SUCCESS)
+
+
+@pytest.mark.asyncio
+async def test_duplicate_transaction_is_rejected_before_wallet_is_touched(standalone_wallet):
+    wallets, transactions = standalone_wallet
+
+    with pytest.raises(DuplicateKeyError):
+        await crud._apply_wallet_change("d1", 50000.0, _entry("TOPUP_1"))
+
+    wallets.find_one_and_update.assert_not_awaited()
+    crud.ledger.append_postings.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_first_wallet_upsert_race_only_reruns_wallet_update(standalone_wallet):
+    wallets, transactions = standalone_wallet
+    wallets.find_one_and_update.side_effect = [
+        DuplicateKeyError("E11000", details={"keyPattern": {"driver_id": 1}}), dict(WALLET)
+    ]
+
+    result = await crud._apply_wallet_change("d1", 50000.0, _entry("TOPUP_2"))
+
+    assert result["balance"] == 50000.0
+    assert wallets.find_one_and_update.await_count == 2
+    crud.ledger.append_postings.assert_awaited_once()
+    assert transactions.rows["TOPUP_2"]["balance_after"] == 50000.0 and transactions.rows["TOPUP_2"]["wallet_id"] == "w1"
+
+
+@pytest.mark.asyncio
+async def test_insufficient_balance_releases_claimed_transaction(standalone_wallet):
+    wallets, transactions = standalone_wallet
+    wallets.find_one_and_update.return_value = None
+
+    assert await crud._apply_wallet_change("d1", -50000.0, _entry("PAYOUT_1"), require_balance=True) is None
+    assert "PAYOUT_1" not in transactions.rows
+
+
+@pytest.mark.asyncio
+async def test_repeated_payout_is_not_debited_twice(standalone_wallet, monkeypatch):
+    wallets, transactions = standalone_wallet
+    monkeypatch.setattr(crud, "get_or_create_wallet", AsyncMock(return_value={"driver_id": "d1", "balance": 0.0}))
+
+    wallet = await crud.debit_driver_wallet("d1", 160000.0, "PAYOUT_2026-10-18:d1")
+
+    # Lần chạy trước đã ghi PAYOUT: coi như đã chi trả, không trừ ví lần nữa
+    assert wallet == {"driver_id": "d1", "balance": 0.0}
+    wallets.find_one_and_update.assert_not_awaited()
+
+
+def _raise(error):
+    raise error
+
+
+@pytest.fixture
+def index_collections(monkeypatch):
+    """Mọi get_*_collection của database trả về collection giả; create_index thành công trừ khi test đổi."""
+    collections = {}
+
+    def getter(name):
+        collection = MagicMock(create_index=AsyncMock(), index_information=AsyncMock(return_value={}))
+        collection.name = name
+        collections[name] = collection
+        return AsyncMock(return_value=collection)
+
+    for attr in dir(payment_database):
+        if attr.startswith("get_") and attr.endswith("_collection"):
+            monkeypatch.setattr(payment_database, attr, getter(attr[len("get_"):-len("_collection")]))
+    return collections
+
+
+@pytest.mark.asyncio
+async def test_startup_fails_without_transaction_id_unique_index(index_collections):
+    transactions = index_collections["transactions"]
+    transactions.create_index.side_effect = lambda keys, **kwargs: (
+        _raise(OperationFailure("partial index not supported")) if kwargs.get("unique") else None
+    )
+
+    with pytest.raises(OperationFailure):
+        await payment_database.create_payment_indexes()
+
+
+@pytest.mark.asyncio
+async def test_existing_unique_index_is_accepted_and_other_index_errors_do_not_skip_the_rest(index_collections):
+    transactions = index_collections["transactions"]
+    transactions.create_index.side_effect = OperationFailure("cannot create index on non-empty collection")
+    transactions.index_information.return_value = {
+        "_id_": {"key": [("_id", 1)]},
+        "transaction_id_1": {"key": [("transaction_id", 1)], "unique": True},
+    }
+
+    await payment_database.create_payment_indexes()
+
+    # Lỗi ở transactions không làm bỏ qua index của các collection sau
+    assert index_collections["payment_jobs"].create_index.await_args_list[0].args == ("trip_id",)
+    assert index_collections["reconciliation_issues"].create_index.await_count == 1
\ No newline at end of file
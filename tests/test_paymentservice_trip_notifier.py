@@ -0,0 +1,76 @@
+"""
+Unit tests cho outbox thông báo trạng thái thanh toán gửi TripService (trip_notifier) của PaymentService.
+Chạy với: pytest tests/test_paymentservice_trip_notifier.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+from pymongo import DeleteOne, UpdateOne
+
+os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")
+payment_service_path = os.path.join(os.path.dirname(__file__), "..", "PaymentService")
+
+spec = importlib.util.spec_from_file_location("payment_trip_notifier", os.path.join(payment_service_path, "trip_notifier.py"))
+trip_notifier = importlib.util.module_from_spec(spec)
+with patch.dict(sys.modules, {"database": MagicMock()}):
+    spec.loader.exec_module(trip_notifier)
+
+
+def _notification(trip_id, attempts=0, version=1):
+    return {"_id": trip_id, "payload": {"status": "SUCCESS", "transaction_id": f"TXN_{trip_id}"},
+            "attempts": attempts, "version": version, "status": trip_notifier.NotificationStatus.PENDING}
+
+
+@pytest.fixture
+def notifications(monkeypatch):
+    coll = MagicMock()
+    coll.bulk_write = AsyncMock()
+    monkeypatch.setattr(trip_notifier, "get_trip_notifications_collection", AsyncMock(return_value=coll))
+    return coll
+
+
+@pytest.mark.asyncio
+async def test_enqueue_coalesces_updates_per_trip(notifications):
+    await trip_notifier.enqueue_payment_status("trip-1", "TXN_1", "FAILED")
+
+    op = notifications.bulk_write.await_args.args[0][0]
+    assert isinstance(op, UpdateOne) and op._filter == {"_id": "trip-1"} and op._upsert is True
+    assert op._doc["$set"]["payload"] == {"status": "FAILED", "transaction_id": "TXN_1"}
+    assert op._doc["$set"]["attempts"] == 0 and op._doc["$inc"] == {"version": 1}
+
+
+@pytest.mark.asyncio
+async def test_flush_deletes_delivered_and_backs_off_failed(monkeypatch, notifications):
+    batch = [_notification("ok"), _notification("down", attempts=2)]
+    monkeypatch.setattr(trip_notifier, "claim_batch", AsyncMock(return_value=batch))
+    monkeypatch.setattr(trip_notifier, "deliver", AsyncMock(side_effect=[None, "ConnectError: refused"]))
+
+    counts = await trip_notifier.flush_once()
+
+    assert counts == {"claimed": 2, "delivered": 1, "failed": 1}
+    ops = notifications.bulk_write.await_args.args[0]
+    assert len(notifications.bulk_write.await_args_list) == 1
+    assert isinstance(ops[0], DeleteOne) and ops[0]._filter["_id"] == "ok" and ops[0]._filter["version"] == 1
+    retry = ops[2]
+    assert isinstance(retry, UpdateOne) and retry._filter["_id"] == "down"
+    assert retry._doc["$set"]["attempts"] == 3
+    delay = retry._doc["$set"]["available_at"] - datetime.now(timezone.utc)
+    assert 7 <= delay.total_seconds() <= 8
+
+
+def test_notification_is_dead_after_max_attempts():
+    now = datetime.now(timezone.utc)
+    notification = _notification("gone", attempts=trip_notifier.NOTIFY_MAX_ATTEMPTS - 1)
+    update = trip_notifier._result_ops(notification, "token", "HTTP 404: Not Found", now)[0]._doc["$set"]
+    assert update["status"] == trip_notifier.NotificationStatus.DEAD
+    assert "available_at" not in update
+
+
+@pytest.mark.asyncio
+async def test_flush_with_nothing_due_does_not_write(monkeypatch, notifications):
+    monkeypatch.setattr(trip_notifier, "claim_batch", AsyncMock(return_value=[]))
+    assert (await trip_notifier.flush_once())["claimed"] == 0
+    notifications.bulk_write.assert_not_awaited()
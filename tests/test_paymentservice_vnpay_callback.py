@@ -0,0 +1,90 @@
+"""
+Unit tests cho callback VNPay (crud.handle_vnpay_return) và cache chi tiết chuyến đi của PaymentService.
+Chạy với: pytest tests/test_paymentservice_vnpay_callback.py
+"""
+import pytest
+import sys
+import os
+import hashlib
+import hmac
+import importlib.util
+from urllib.parse import quote_plus
+from unittest.mock import AsyncMock, MagicMock, patch
+
+os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")
+payment_service_path = os.path.join(os.path.dirname(__file__), "..", "PaymentService")
+
+
+def _load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(payment_service_path, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+payment_models = _load("payment_models", "models.py")
+payment_schemas = _load("payment_schemas", "schemas.py")
+trip_cache_module = _load("payment_trip_cache", "trip_cache.py")
+payment_pricing = _load("payment_pricing", "pricing.py")
+with patch.dict(sys.modules, {"models": payment_models, "schemas": payment_schemas, "database": MagicMock(),
+                              "ledger": MagicMock(), "trip_cache": trip_cache_module, "trip_notifier": MagicMock(), "pricing": payment_pricing}):
+    crud = _load("payment_crud", "crud.py")
+
+
+def _signed_callback(txn_ref, response_code="00"):
+    params = {"vnp_TxnRef": txn_ref, "vnp_ResponseCode": response_code, "vnp_TransactionNo": "123"}
+    hash_data = "&".join(f"{k}={quote_plus(str(v))}" for k, v in sorted(params.items()))
+    params["vnp_SecureHash"] = hmac.new(crud.VNP_HASH_SECRET.encode("utf-8"), hash_data.encode("utf-8"), hashlib.sha512).hexdigest()
+    return params
+
+
+def _patch_transaction(monkeypatch, transaction):
+    monkeypatch.setattr(crud, "VNP_HASH_SECRET", "test-secret")
+    coll = MagicMock()
+    coll.find_one_and_update = AsyncMock(return_value=transaction)
+    monkeypatch.setattr(crud, "get_transactions_collection", AsyncMock(return_value=coll))
+    credit = AsyncMock(return_value={"driver_id": transaction.get("driver_id")})
+    monkeypatch.setattr(crud, "credit_driver_wallet", credit)
+    return credit
+
+
+@pytest.mark.asyncio
+async def test_callback_uses_driver_stored_on_transaction(monkeypatch):
+    credit = _patch_transaction(monkeypatch, {"transaction_id": "T1", "trip_id": "trip-1", "driver_id": "drv-1", "amount": 100000})
+    get_trip_details = AsyncMock()
+    monkeypatch.setattr(crud, "get_trip_details", get_trip_details)
+
+    assert await crud.handle_vnpay_return(_signed_callback("T1")) is True
+    get_trip_details.assert_not_awaited()
+    driver_id, earning, trip_id = credit.await_args.args
+    assert (driver_id, trip_id) == ("drv-1", "trip-1")
+    assert earning == pytest.approx(100000 * (1 - payment_pricing.get_plan().commission_rate))
+
+
+@pytest.mark.asyncio
+async def test_legacy_transaction_falls_back_to_cached_trip_details(monkeypatch):
+    credit = _patch_transaction(monkeypatch, {"transaction_id": "T2", "trip_id": "trip-2", "amount": 100000})
+    get_trip_details = AsyncMock(return_value={"driver_id": "drv-2", "fare": {"actual": 120000}})
+    monkeypatch.setattr(crud, "get_trip_details", get_trip_details)
+    monkeypatch.setattr(crud, "trip_cache", trip_cache_module.TripDetailsCache(ttl_seconds=60, max_entries=10))
+
+    await crud.handle_vnpay_return(_signed_callback("T2"))
+    await crud.handle_vnpay_return(_signed_callback("T2"))
+
+    assert get_trip_details.await_count == 1
+    assert credit.await_args.args[0] == "drv-2"
+    assert credit.await_args.args[1] == pytest.approx(120000 * (1 - payment_pricing.get_plan().commission_rate))
+
+
+def test_cache_evicts_least_recently_used_and_expired(monkeypatch):
+    cache = trip_cache_module.TripDetailsCache(ttl_seconds=10, max_entries=2)
+    now = [1000.0]
+    monkeypatch.setattr(trip_cache_module.time, "monotonic", lambda: now[0])
+    cache.set("a", {"driver_id": "1"})
+    cache.set("b", {"driver_id": "2"})
+    cache.get("a")
+    cache.set("c", {"driver_id": "3"})
+    assert cache.get("b") is None and cache.get("a") is not None
+
+    now[0] += 11
+    assert cache.get("a") is None
@@ -0,0 +1,108 @@
+"""
+Unit tests cho cache chuyến đi đang hoạt động trong Redis (active_trip_cache) của TripService.
+Chạy với: pytest tests/test_tripservice_active_trip_cache.py
+"""
+import json
+import pytest
+import sys
+import os
+import importlib.util
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import fakeredis
+from bson import ObjectId
+
+from conftest import trip_database_stub
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+
+
+def _load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(trip_service_path, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+trip_models = _load("trip_models", "models.py")
+with patch.dict(sys.modules, {"database": trip_database_stub(), "models": trip_models}):
+    sys.modules["schemas"] = _load("trip_schemas", "schemas.py")
+    sys.modules["fast_response"] = _load("trip_fast_response", "fast_response.py")
+    active_trip_cache = _load("trip_active_trip_cache", "active_trip_cache.py")
+
+TRIP_ID = str(ObjectId())
+T0 = datetime(2026, 10, 19, 8, 0, tzinfo=timezone.utc)
+
+
+def _trip(status, updated_at):
+    return {
+        "_id": TRIP_ID,
+        "passenger_id": "p1",
+        "driver_id": "d1",
+        "vehicle_type": "4_SEATER",
+        "status": status,
+        "pickup": {"address": "UIT", "location": {"type": "Point", "coordinates": [106.80, 10.87]}},
+        "dropoff": {"address": "Bến Thành", "location": {"type": "Point", "coordinates": [106.70, 10.77]}},
+        "created_at": T0,
+        "updated_at": updated_at,
+        "fare": {"estimated": 52000.0},
+    }
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(active_trip_cache, "redis_client", client)
+    return client
+
+
+async def _cached_status():
+    cached = await active_trip_cache.get_json(TRIP_ID)
+    return json.loads(cached)["status"] if cached else None
+
+
+@pytest.mark.asyncio
+async def test_write_through_replaces_cached_trip(redis):
+    await active_trip_cache.refresh(_trip("ACCEPTED", T0))
+    await active_trip_cache.refresh(_trip("ON_TRIP", T0 + timedelta(seconds=30)))
+
+    assert await _cached_status() == "ON_TRIP"
+    assert await redis.ttl(f"trip:active:{{{TRIP_ID}}}") > 0
+
+
+@pytest.mark.asyncio
+async def test_finished_trip_is_evicted(redis):
+    await active_trip_cache.refresh(_trip("ON_TRIP", T0))
+    await active_trip_cache.refresh(_trip("COMPLETED", T0 + timedelta(minutes=20)))
+
+    assert await _cached_status() is None
+
+
+@pytest.mark.asyncio
+async def test_stale_populate_cannot_resurrect_completed_trip(redis):
+    # GET đọc chuyến (ACCEPTED) từ Mongo, rồi chuyến được hoàn thành và xóa khỏi cache trước khi GET ghi cache
+    stale_read = _trip("ACCEPTED", T0)
+    await active_trip_cache.refresh(_trip("COMPLETED", T0 + timedelta(minutes=20)))
+
+    await active_trip_cache.populate(stale_read)
+
+    assert await _cached_status() is None
+
+
+@pytest.mark.asyncio
+async def test_older_write_through_does_not_overwrite_newer(redis):
+    await active_trip_cache.refresh(_trip("ON_TRIP", T0 + timedelta(seconds=30)))
+    await active_trip_cache.refresh(_trip("ACCEPTED", T0))
+
+    assert await _cached_status() == "ON_TRIP"
+
+
+@pytest.mark.asyncio
+async def test_evict_many_blocks_reads_that_started_before_it(redis):
+    await active_trip_cache.refresh(_trip("PENDING", T0))
+
+    await active_trip_cache.evict_many([TRIP_ID])
+    await active_trip_cache.populate(_trip("PENDING", T0))
+
+    assert await _cached_status() is None
@@ -0,0 +1,111 @@
+"""
+Unit tests cho lưu trữ chuyến đi (archive_trips) và ghi vào chuyến đã lưu trữ của TripService.
+Chạy với: pytest tests/test_tripservice_archive.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from bson import ObjectId
+
+from conftest import trip_database_stub
+
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+
+
+def _load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(trip_service_path, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+if trip_service_path not in sys.path:
+    sys.path.insert(0, trip_service_path)
+
+trip_models = _load("trip_models", "models.py")
+with patch.dict(sys.modules, {"database": trip_database_stub(), "models": trip_models}):
+    trip_schemas = _load("trip_schemas", "schemas.py")
+    sys.modules["schemas"] = trip_schemas
+    archive_trips = _load("trip_archive_trips", "archive_trips.py")
+    trip_crud = _load("trip_crud_archive", "crud.py")
+
+TRIP_ID = str(ObjectId())
+
+
+def test_compact_trip_keeps_route_info_valid():
+    trip = {"_id": TRIP_ID, "notified_driver_ids": ["d1"],
+            "route_info": {"distance": 1200.0, "duration": 300.0, "geometry": "a" * 5000}}
+
+    archived = archive_trips.compact_trip(trip, datetime.now(timezone.utc))
+
+    assert "notified_driver_ids" not in archived
+    assert trip_models.RouteInfo(**archived["route_info"]).geometry == ""
+    assert archived["route_info"]["distance"] == 1200.0
+
+
+@pytest.fixture
+def tiers(monkeypatch):
+    hot, archive = MagicMock(), MagicMock()
+    hot.find_one_and_update = AsyncMock(return_value=None)
+    archive.find_one_and_update = AsyncMock()
+    monkeypatch.setattr(trip_crud, "trips_collection", hot)
+    monkeypatch.setattr(trip_crud, "trips_archive_collection", archive)
+    monkeypatch.setattr(trip_crud, "reload_trip", AsyncMock(side_effect=lambda trip_id: {"_id": trip_id}))
+    monkeypatch.setattr(trip_crud.trip_stats, "record_trip_change", AsyncMock())
+    return hot, archive
+
+
+@pytest.mark.asyncio
+async def test_payment_status_for_archived_trip_is_written_to_archive(tiers):
+    hot, archive = tiers
+    archive.find_one_and_update.return_value = {"_id": ObjectId(TRIP_ID), "status": "COMPLETED"}
+
+    trip = await trip_crud.update_payment_status(
+        TRIP_ID, trip_schemas.PaymentUpdate(status=trip_models.PaymentStatusEnum.SUCCESS, transaction_id="TXN_1")
+    )
+
+    assert trip == {"_id": TRIP_ID}
+    update = archive.find_one_and_update.await_args.args[1]["$set"]
+    assert update["payment.status"] == "SUCCESS" and update["payment.transaction_id"] == "TXN_1"
+
+
+@pytest.mark.asyncio
+async def test_rating_only_written_once(tiers):
+    hot, archive = tiers
+    archive.find_one_and_update.return_value = None  # đã có đánh giá (hoặc không tồn tại) ở cả hai nơi
+
+    trip = await trip_crud.add_trip_rating(TRIP_ID, trip_schemas.RatingCreate(stars=5))
+
+    assert trip is None
+    assert hot.find_one_and_update.await_args.args[0]["rating"] is None
+    trip_crud.trip_stats.record_trip_change.assert_not_awaited()
+
+
+def _cursor(docs):
+    cursor = MagicMock()
+    cursor.sort.return_value = cursor
+    cursor.limit.return_value = cursor
+    cursor.to_list = AsyncMock(side_effect=lambda length: docs[:length])
+    return cursor
+
+
+@pytest.mark.asyncio
+async def test_trip_in_both_tiers_is_listed_once(monkeypatch):
+    # Lô đang lưu trữ: t2 đã chép sang archive nhưng chưa bị xóa khỏi 'trips'
+    t1, t2, t3 = (ObjectId() for _ in range(3))
+    hot = [{"_id": t1, "created_at": 3, "status": "ON_TRIP"}, {"_id": t2, "created_at": 2, "status": "COMPLETED"}]
+    archived = [{"_id": t2, "created_at": 2, "status": "COMPLETED", "archived_at": 9}, {"_id": t3, "created_at": 1}]
+    monkeypatch.setattr(trip_crud, "trips_collection", MagicMock(find=MagicMock(return_value=_cursor(hot))))
+    monkeypatch.setattr(trip_crud, "trips_archive_collection", MagicMock(find=MagicMock(return_value=_cursor(archived))))
+
+    first_page = await trip_crud.get_trips_by_passenger("p1", skip=0, limit=2)
+    second_page = await trip_crud.get_trips_by_passenger("p1", skip=2, limit=2)
+
+    assert [trip["_id"] for trip in first_page] == [t1, t2]
+    assert "archived_at" not in first_page[1]  # bản trong 'trips' được ưu tiên
+    assert [trip["_id"] for trip in second_page] == [t3]
@@ -0,0 +1,85 @@
+"""
+Unit tests cho cache thông tin tài xế của TripService.
+Chạy với: pytest tests/test_tripservice_driver_cache.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+
+from conftest import trip_database_stub
+
+sys.modules.setdefault('database', trip_database_stub())
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+spec = importlib.util.spec_from_file_location("trip_driver_cache", os.path.join(trip_service_path, "driver_cache.py"))
+trip_driver_cache = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(trip_driver_cache)
+
+DriverDetailsCache = trip_driver_cache.DriverDetailsCache
+
+
+class FakeRedis:
+    """Fake Redis tối giản (get/set/delete/publish)."""
+
+    def __init__(self):
+        self.store = {}
+        self.published = []
+
+    async def get(self, key):
+        return self.store.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.store[key] = value
+
+    async def delete(self, key):
+        self.store.pop(key, None)
+
+    async def publish(self, channel, message):
+        self.published.append((channel, message))
+
+
+@pytest.mark.asyncio
+async def test_local_cache_evicts_least_recently_used():
+    cache = DriverDetailsCache(ttl_seconds=60, max_entries=2)
+    await cache.set("d1", {"name": "A"})
+    await cache.set("d2", {"name": "B"})
+    assert await cache.get("d1") == {"name": "A"}  # d1 thành mới dùng gần nhất
+
+    await cache.set("d3", {"name": "C"})
+
+    assert await cache.get("d2") is None
+    assert await cache.get("d1") == {"name": "A"}
+    assert await cache.get("d3") == {"name": "C"}
+
+
+@pytest.mark.asyncio
+async def test_local_cache_expires_after_ttl(monkeypatch):
+    cache = DriverDetailsCache(ttl_seconds=10, max_entries=10)
+    now = [1000.0]
+    monkeypatch.setattr(trip_driver_cache.time, "monotonic", lambda: now[0])
+
+    await cache.set("d1", {"name": "A"})
+    now[0] += 11
+
+    assert await cache.get("d1") is None
+
+
+@pytest.mark.asyncio
+async def test_redis_tier_is_shared_and_invalidated():
+    redis = FakeRedis()
+    writer = DriverDetailsCache(ttl_seconds=60, max_entries=10, redis=redis)
+    reader = DriverDetailsCache(ttl_seconds=60, max_entries=10, redis=redis)
+
+    await writer.set("d1", {"name": "A"})
+    assert await reader.get("d1") == {"name": "A"}
+
+    await writer.invalidate("d1")
+    reader.evict_local("d1")  # mô phỏng sự kiện pub/sub tới replica khác
+
+    assert await reader.get("d1") is None
+    assert redis.published == [(trip_driver_cache.DRIVER_INVALIDATION_CHANNEL, "d1")]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -5,17 +5,13 @@ Chạy với: pytest tests/test_tripservice_fare.py
 import pytest
 import sys
 import os
+from unittest.mock import AsyncMock, MagicMock
 
-# Mock database dependencies để tránh import conflicts
-from unittest.mock import MagicMock
-
-# Tạo mock database module
-class MockDatabase:
-    trips_collection = MagicMock()
-    ratings_collection = MagicMock()
+# Mock database dependencies để tránh import conflicts (stub dùng chung trong conftest.py)
+from conftest import trip_database_stub
 
 # Thêm mock vào sys.modules để crud.py import được
-sys.modules['database'] = MockDatabase()
+sys.modules['database'] = trip_database_stub()
 
 # Import trực tiếp bằng sys.path để tránh conflict
 trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
@@ -90,6 +86,29 @@ class TestTripServiceFare:
         assert fare_seven >= 30000
 
 
+@pytest.mark.asyncio
+async def test_address_trip_request_applies_and_stores_surge(monkeypatch):
+    """Đặt chuyến theo địa chỉ (/trips/) cũng nhân surge của ô điểm đón và lưu hệ số cho PaymentService."""
+    coords = {"UIT": (106.80, 10.87), "Bến Thành": (106.70, 10.77)}
+    monkeypatch.setattr(trip_crud, "get_coordinates", AsyncMock(side_effect=lambda address: coords[address]))
+    monkeypatch.setattr(trip_crud, "get_route_info", AsyncMock(return_value={"distance": 5000, "duration": 900, "geometry": ""}))
+    get_multiplier = AsyncMock(return_value=1.5)
+    monkeypatch.setattr(trip_crud.surge, "get_multiplier", get_multiplier)
+    monkeypatch.setattr(trip_crud, "trips_collection", MagicMock(insert_one=AsyncMock(return_value=MagicMock(inserted_id="t1"))))
+    monkeypatch.setattr(trip_crud.trip_stats, "record_trip_change", AsyncMock())
+    request = trip_schemas.TripRequest(
+        passenger_id="p1", pickup={"address": "UIT"}, dropoff={"address": "Bến Thành"},
+        vehicle_type=VehicleTypeEnum.FOUR_SEATER
+    )
+
+    trip = await trip_crud.create_trip_request(request)
+
+    get_multiplier.assert_awaited_once_with(106.80, 10.87)
+    assert trip["surge_multiplier"] == 1.5
+    assert trip["fare"]["estimated"] == calculate_estimated_fare(5000, VehicleTypeEnum.FOUR_SEATER, 1.5)
+    assert trip["fare"]["estimated"] > calculate_estimated_fare(5000, VehicleTypeEnum.FOUR_SEATER)
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
 
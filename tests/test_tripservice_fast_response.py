@@ -0,0 +1,84 @@
+"""
+Unit tests cho đường serialize nhanh (trusted_dump + orjson) của TripService.
+Chạy với: pytest tests/test_tripservice_fast_response.py
+"""
+import json
+import sys
+import os
+import importlib.util
+from datetime import datetime
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+
+
+def _load(module_name, file_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(trip_service_path, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+if 'models' not in sys.modules:
+    sys.modules['models'] = _load("trip_models", "models.py")
+trip_schemas = _load("trip_schemas", "schemas.py")
+fast_response = _load("trip_fast_response", "fast_response.py")
+
+
+def _trip_doc():
+    created_at = datetime(2024, 5, 1, 8, 30, 0, 250000)
+    return {
+        "_id": ObjectId(),
+        "passenger_id": "p1",
+        "driver_id": "d1",
+        "vehicle_type": "4_SEATER",
+        "status": "ON_TRIP",
+        "pickup": {"address": "UIT", "location": {"type": "Point", "coordinates": [106.80, 10.87]}},
+        "dropoff": {"address": "Bến Thành", "location": {"type": "Point", "coordinates": [106.70, 10.77]}},
+        "startTime": created_at,
+        "created_at": created_at,
+        "fare": {"estimated": 52000.0, "actual": None, "discount": 0.0, "tax": 0.0},
+        "payment": {"method": "Cash", "status": "PENDING", "transaction_id": None, "paid_at": None},
+        "history": [{"status": "PENDING", "timestamp": created_at}],
+        "notified_driver_ids": ["d1", "d2"],
+        "offer_sent_at": created_at,
+    }
+
+
+def test_trusted_dump_matches_validated_json():
+    doc = _trip_doc()
+    validated = {**doc, "_id": str(doc["_id"])}
+    expected = jsonable_encoder(trip_schemas.TripResponse(**validated), by_alias=True)
+
+    actual = json.loads(fast_response.dumps(fast_response.trusted_dump(trip_schemas.TripResponse, doc)))
+
+    assert actual == expected
+
+
+def test_trusted_dump_drops_internal_fields_and_fills_defaults():
+    data = fast_response.trusted_dump(trip_schemas.TripResponse, _trip_doc())
+
+    assert "notified_driver_ids" not in data
+    assert "offer_sent_at" not in data
+    assert isinstance(data["_id"], str)
+    assert data["rating"] is None
+    assert data["history"][0]["status"] == "PENDING"
+
+
+def test_trusted_response_serializes_lists():
+    docs = [_trip_doc(), _trip_doc()]
+    summaries = [
+        {"_id": d["_id"], "passenger_id": d["passenger_id"], "driver_id": d["driver_id"], "status": d["status"],
+         "pickup_address": d["pickup"]["address"], "dropoff_address": d["dropoff"]["address"],
+         "estimated_fare": 52000.0, "actual_fare": None, "created_at": d["created_at"],
+         "startTime": d["startTime"], "endTime": None}
+        for d in docs
+    ]
+
+    response = fast_response.trusted_response(trip_schemas.TripSummaryResponse, summaries)
+    body = json.loads(response.body)
+
+    assert [item["_id"] for item in body] == [str(d["_id"]) for d in docs]
+    assert body[0]["created_at"] == "2024-05-01T08:30:00.250000"
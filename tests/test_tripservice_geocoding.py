@@ -0,0 +1,132 @@
+"""
+Unit tests cho cache geocoding của TripService.
+Chạy với: pytest tests/test_tripservice_geocoding.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import fakeredis
+import httpx
+
+from conftest import trip_database_stub
+
+sys.modules.setdefault('database', trip_database_stub())
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+spec = importlib.util.spec_from_file_location("trip_geocoding", os.path.join(trip_service_path, "geocoding.py"))
+trip_geocoding = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(trip_geocoding)
+
+
+def _load_crud():
+    if trip_service_path not in sys.path:
+        sys.path.insert(0, trip_service_path)
+    modules = {}
+    with patch.dict(sys.modules, {"database": trip_database_stub()}):
+        for name in ("models", "schemas", "crud"):
+            spec = importlib.util.spec_from_file_location(f"trip_geocode_{name}", os.path.join(trip_service_path, f"{name}.py"))
+            modules[name] = importlib.util.module_from_spec(spec)
+            sys.modules[name] = modules[name]
+            spec.loader.exec_module(modules[name])
+    return modules["crud"]
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        ("  Đại học   Công nghệ Thông tin ,  TP.HCM. ", "đại học công nghệ thông tin, tp.hcm"),
+        ("Vincom Center,Quận 1", "vincom center, quận 1"),
+    ],
+)
+def test_normalize_address(raw, expected):
+    assert trip_geocoding.normalize_address(raw) == expected
+
+
+@pytest.mark.asyncio
+async def test_cache_hits_on_equivalent_addresses():
+    cache = trip_geocoding.GeocodeCache(ttl_seconds=60, max_entries=10)
+    await cache.set("Sân bay Tân Sơn Nhất", (106.66, 10.81))
+
+    assert await cache.get("  sân bay   tân sơn nhất. ") == (106.66, 10.81)
+    assert await cache.get("Chợ Bến Thành") is None
+
+
+@pytest.mark.asyncio
+async def test_warm_set_entries_survive_lru_eviction():
+    cache = trip_geocoding.GeocodeCache(ttl_seconds=60, max_entries=1)
+    await cache.save_places([("Landmark 81", (106.72, 10.79))])
+    await cache.set("A", (1.0, 1.0))
+    await cache.set("B", (2.0, 2.0))
+
+    assert await cache.get("A") is None
+    assert await cache.get("landmark 81") == (106.72, 10.79)
+
+
+@pytest.mark.asyncio
+async def test_batch_marks_rate_limited_address_not_found(monkeypatch):
+    crud = _load_crud()
+    rate_limited = httpx.HTTPStatusError(
+        "429", request=httpx.Request("GET", "https://api.mapbox.com"), response=httpx.Response(429)
+    )
+
+    async def fake_get_coordinates(address):
+        if address == "B":
+            raise rate_limited
+        return (1.0, 2.0)
+
+    monkeypatch.setattr(crud, "get_coordinates", fake_get_coordinates)
+    results = await crud.geocode_addresses(["A", "B"])
+
+    assert [r["found"] for r in results] == [True, False]
+    assert results[0]["longitude"] == 1.0
+
+
+@pytest.mark.asyncio
+async def test_warm_set_is_bounded_and_mongo_hits_go_to_lru():
+    places = MagicMock(find_one=AsyncMock(return_value={"_id": "vincom", "coordinates": [106.70, 10.78]}))
+    cache = trip_geocoding.GeocodeCache(ttl_seconds=60, max_entries=2, places_collection=places, warm_limit=1)
+    places.bulk_write = AsyncMock()
+    await cache.save_places([("Landmark 81", (106.72, 10.79)), ("Bitexco", (106.70, 10.77))])
+
+    assert await cache.get("Vincom") == (106.70, 10.78)
+    assert list(cache._warm) == ["landmark 81"]
+    # Bitexco vượt warm_limit, Vincom đọc từ MongoDB: cả hai nằm trong LRU (max_entries=2)
+    assert set(cache._entries) == {"bitexco", "vincom"}
+
+
+@pytest.mark.asyncio
+async def test_not_found_address_skips_mongo_and_mapbox_until_it_expires(monkeypatch):
+    places = MagicMock(find_one=AsyncMock(return_value=None))
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    cache = trip_geocoding.GeocodeCache(ttl_seconds=60, max_entries=10, redis=redis, places_collection=places,
+                                        negative_ttl_seconds=30)
+    crud = _load_crud()
+    monkeypatch.setattr(crud, "geocode_cache", cache)
+    monkeypatch.setattr(crud, "MAPBOX_ACCESS_TOKEN", "pk.test")
+    mapbox_calls = []
+
+    def handler(request):
+        mapbox_calls.append(request)
+        return httpx.Response(200, json={"features": []})
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(crud.httpx, "AsyncClient", lambda: real_client(transport=httpx.MockTransport(handler)))
+
+    assert await crud.get_coordinates("Số 0 đường Không Tồn Tại") is None
+    assert await crud.get_coordinates("số 0 đường không tồn tại") is None
+
+    assert len(mapbox_calls) == 1 and places.find_one.await_count == 1
+    key = f"{trip_geocoding.GEOCODE_KEY_PREFIX}số 0 đường không tồn tại"
+    assert await redis.get(key) == trip_geocoding.NOT_FOUND_MARKER
+    assert 0 < await redis.ttl(key) <= 30
+    # Replica khác (bộ nhớ trống) đọc được marker từ Redis
+    other = trip_geocoding.GeocodeCache(ttl_seconds=60, max_entries=10, redis=redis, places_collection=places)
+    assert await other.get("Số 0 đường Không Tồn Tại") == trip_geocoding.NOT_FOUND
+    assert places.find_one.await_count == 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
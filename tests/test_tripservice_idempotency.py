@@ -0,0 +1,128 @@
+"""
+Unit tests cho Idempotency-Key của TripService.
+Chạy với: pytest tests/test_tripservice_idempotency.py
+"""
+import asyncio
+import pytest
+import sys
+import os
+import importlib.util
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock
+
+from pymongo.errors import DuplicateKeyError
+
+from conftest import trip_database_stub
+
+sys.modules.setdefault('database', trip_database_stub())
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+spec = importlib.util.spec_from_file_location("trip_idempotency", os.path.join(trip_service_path, "idempotency.py"))
+trip_idempotency = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(trip_idempotency)
+
+
+class InMemoryStore:
+    def __init__(self):
+        self.records = {}
+
+    async def claim(self, key, fingerprint):
+        if key in self.records:
+            return False
+        self.records[key] = {"state": trip_idempotency.IN_PROGRESS, "fingerprint": fingerprint}
+        return True
+
+    async def get(self, key):
+        return self.records.get(key)
+
+    async def complete(self, key, fingerprint, response):
+        self.records[key] = {"state": trip_idempotency.DONE, "fingerprint": fingerprint, "response": response}
+
+    async def release(self, key):
+        self.records.pop(key, None)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_duplicates_run_handler_once():
+    manager = trip_idempotency.IdempotencyManager(InMemoryStore())
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"trip_id": "t1"}
+
+    results = await asyncio.gather(*[
+        manager.run("trip-create:p1", "key-1", {"a": 1}, handler) for _ in range(5)
+    ])
+
+    assert len(calls) == 1
+    assert [r[0] for r in results] == [{"trip_id": "t1"}] * 5
+    assert sorted(r[1] for r in results) == [False, True, True, True, True]
+
+    # Retry sau khi hoàn tất: trả response đã lưu
+    response, replayed = await manager.run("trip-create:p1", "key-1", {"a": 1}, handler)
+    assert replayed is True and response == {"trip_id": "t1"} and len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_reused_key_with_different_payload_is_rejected():
+    manager = trip_idempotency.IdempotencyManager(InMemoryStore())
+
+    async def handler():
+        return {"ok": True}
+
+    await manager.run("trip-complete:t1", "key-2", {"distance_km": 5}, handler)
+    with pytest.raises(trip_idempotency.HTTPException) as exc_info:
+        await manager.run("trip-complete:t1", "key-2", {"distance_km": 7}, handler)
+    assert exc_info.value.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_failed_handler_releases_key_for_retry():
+    store = InMemoryStore()
+    manager = trip_idempotency.IdempotencyManager(store)
+
+    async def failing():
+        raise ValueError("Mapbox down")
+
+    with pytest.raises(ValueError):
+        await manager.run("trip-create:p1", "key-3", {}, failing)
+    assert store.records == {}
+
+
+@pytest.mark.asyncio
+async def test_expired_in_progress_claim_can_be_reclaimed():
+    collection = MagicMock()
+    collection.insert_one = AsyncMock(side_effect=DuplicateKeyError("idem"))
+    collection.find_one_and_update = AsyncMock(return_value={"_id": "k", "state": trip_idempotency.IN_PROGRESS})
+    store = trip_idempotency.MongoIdempotencyStore(collection, ttl_seconds=86400, lease_seconds=60)
+
+    assert await store.claim("k", "fp-2") is True
+    filter_, update = collection.find_one_and_update.await_args.args
+    assert filter_["state"] == trip_idempotency.IN_PROGRESS and "$lte" in filter_["expires_at"]
+    lease = update["$set"]["expires_at"] - datetime.now(timezone.utc)
+    assert timedelta(seconds=50) < lease <= timedelta(seconds=60)
+
+    # Hết lease nhưng TTL monitor chưa xóa: request đang chờ được báo thử lại thay vì chờ tới hết TTL
+    collection.find_one = AsyncMock(return_value={
+        "_id": "k", "state": trip_idempotency.IN_PROGRESS, "fingerprint": "fp-1",
+        "expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)
+    })
+    assert await store.get("k") is None
+
+
+@pytest.mark.asyncio
+async def test_redis_claim_uses_lease_and_completion_uses_ttl():
+    redis = MagicMock()
+    redis.set = AsyncMock(return_value=True)
+    store = trip_idempotency.RedisIdempotencyStore(redis, ttl_seconds=86400, lease_seconds=60)
+
+    await store.claim("k", "fp")
+    assert redis.set.await_args.kwargs == {"nx": True, "ex": 60}
+    await store.complete("k", "fp", {"ok": True})
+    assert redis.set.await_args.kwargs == {"ex": 86400}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,124 @@
+"""
+Unit tests cho xếp hạng tài xế theo ETA tới điểm đón (pickup_eta) của TripService.
+Chạy với: pytest tests/test_tripservice_pickup_eta.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import fakeredis
+import httpx
+
+from conftest import trip_database_stub
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+
+
+def _load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(trip_service_path, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+if trip_service_path not in sys.path:
+    sys.path.insert(0, trip_service_path)
+
+with patch.dict(sys.modules, {"database": trip_database_stub()}):
+    sys.modules["surge"] = _load("trip_surge_eta", "surge.py")
+    pickup_eta = _load("trip_pickup_eta", "pickup_eta.py")
+
+PICKUP = (106.8030, 10.8700)  # UIT
+NEAR = {"driver_id": "near", "longitude": 106.8040, "latitude": 10.8710}
+FAR = {"driver_id": "far", "longitude": 106.7000, "latitude": 10.7800}
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(pickup_eta, "redis_client", client)
+    return client
+
+
+@pytest.fixture
+def mapbox(monkeypatch):
+    """Giả lập Mapbox Matrix: trả 'durations' cho các sources theo thứ tự; ghi lại các request."""
+    monkeypatch.setattr(pickup_eta, "MAPBOX_ACCESS_TOKEN", "pk.test")
+    requests = []
+    durations = {}
+
+    def handler(request):
+        requests.append(request)
+        coordinates = request.url.path.rsplit("/", 1)[1].split(";")[1:]
+        return httpx.Response(200, json={"durations": [[durations[c]] for c in coordinates]})
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(pickup_eta.httpx, "AsyncClient", lambda: real_client(transport=httpx.MockTransport(handler)))
+    return requests, durations
+
+
+def _coordinate(driver):
+    return f"{driver['longitude']},{driver['latitude']}"
+
+
+@pytest.mark.asyncio
+async def test_one_matrix_call_ranks_by_eta_not_distance(redis, mapbox):
+    requests, durations = mapbox
+    # Tài xế gần theo đường chim bay nhưng phải đi vòng (một chiều, qua cầu) nên tới chậm hơn
+    durations.update({_coordinate(NEAR): 900.0, _coordinate(FAR): 600.0})
+
+    ranked = await pickup_eta.rank_drivers_by_eta(*PICKUP, [NEAR, FAR])
+
+    assert [(d["driver_id"], d["eta_seconds"]) for d in ranked] == [("far", 600), ("near", 900)]
+    [request] = requests
+    assert request.url.params["sources"] == "1;2" and request.url.params["destinations"] == "0"
+    assert request.url.path.endswith(f"/{PICKUP[0]},{PICKUP[1]};{_coordinate(NEAR)};{_coordinate(FAR)}")
+
+
+@pytest.mark.asyncio
+async def test_cached_cells_skip_mapbox(redis, mapbox):
+    requests, durations = mapbox
+    durations.update({_coordinate(NEAR): 120.0, _coordinate(FAR): 600.0})
+    await pickup_eta.rank_drivers_by_eta(*PICKUP, [NEAR])
+
+    # Chuyến sau gần đó: tài xế 'near' đã có trong hash của ô đón, chỉ hỏi Mapbox cho 'far'
+    ranked = await pickup_eta.rank_drivers_by_eta(PICKUP[0] + 0.0001, PICKUP[1], [FAR, NEAR])
+
+    assert [d["eta_seconds"] for d in ranked] == [120, 600]
+    assert len(requests) == 2 and requests[1].url.params["sources"] == "1"
+    origin_key = f"{pickup_eta.ETA_KEY_PREFIX}{pickup_eta.cell_of(*PICKUP, pickup_eta.ETA_ORIGIN_CELL_BITS)}"
+    assert await redis.hlen(origin_key) == 2
+    assert 0 < await redis.ttl(origin_key) <= pickup_eta.ETA_CACHE_TTL_SECONDS
+
+
+@pytest.mark.asyncio
+async def test_falls_back_to_haversine_without_token_or_redis(monkeypatch):
+    monkeypatch.setattr(pickup_eta, "MAPBOX_ACCESS_TOKEN", None)
+    monkeypatch.setattr(pickup_eta, "redis_client", None)
+
+    ranked = await pickup_eta.rank_drivers_by_eta(*PICKUP, [FAR, NEAR])
+
+    assert [d["driver_id"] for d in ranked] == ["near", "far"]
+    assert ranked[0]["eta_seconds"] == round(pickup_eta.local_eta_seconds(NEAR["longitude"], NEAR["latitude"], *PICKUP))
+
+
+@pytest.mark.asyncio
+async def test_mapbox_error_falls_back_and_is_not_cached(redis, monkeypatch):
+    monkeypatch.setattr(pickup_eta, "MAPBOX_ACCESS_TOKEN", "pk.test")
+    client = MagicMock()
+    client.__aenter__ = AsyncMock(return_value=client)
+    client.__aexit__ = AsyncMock(return_value=False)
+    client.get = AsyncMock(side_effect=httpx.ConnectError("mapbox down"))
+    monkeypatch.setattr(pickup_eta.httpx, "AsyncClient", lambda: client)
+
+    ranked = await pickup_eta.rank_drivers_by_eta(*PICKUP, [NEAR])
+
+    assert ranked[0]["eta_seconds"] == round(pickup_eta.local_eta_seconds(NEAR["longitude"], NEAR["latitude"], *PICKUP))
+    assert await redis.keys(f"{pickup_eta.ETA_KEY_PREFIX}*") == []
+
+
+def test_haversine_distance():
+    # UIT -> Bến Thành khoảng 15km
+    assert 14000 < pickup_eta.haversine_meters(106.8030, 10.8700, 106.6980, 10.7725) < 16000
@@ -0,0 +1,81 @@
+"""
+Unit tests cho bảng giá dùng chung (pricing.py) của TripService và PaymentService.
+Chạy với: pytest tests/test_tripservice_pricing.py
+"""
+import pytest
+import os
+import json
+import importlib.util
+from datetime import datetime, timezone
+
+root = os.path.join(os.path.dirname(__file__), "..")
+trip_pricing_path = os.path.join(root, "TripService", "pricing.py")
+payment_pricing_path = os.path.join(root, "PaymentService", "pricing.py")
+
+spec = importlib.util.spec_from_file_location("shared_pricing", trip_pricing_path)
+pricing = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(pricing)
+
+
+def _plan(**overrides):
+    return pricing.CompiledPlan({**pricing.DEFAULT_PLAN, **overrides})
+
+
+def test_services_ship_identical_pricing_module():
+    with open(trip_pricing_path, "rb") as trip_file, open(payment_pricing_path, "rb") as payment_file:
+        assert trip_file.read() == payment_file.read()
+
+
+def test_quote_matches_trip_estimate_and_splits_commission():
+    fare = _plan().quote(5, "4_SEATER")
+    assert fare.total_fare == 70000
+    assert fare.commission_amount == pytest.approx(14000)
+    assert fare.driver_earning == pytest.approx(56000)
+
+
+def test_unknown_vehicle_type_uses_default_and_minimum_fare_applies():
+    plan = _plan(vehicle_types={
+        **pricing.DEFAULT_PLAN["vehicle_types"],
+        "2_SEATER": {"base_fare": 5000, "per_km": 8000, "minimum_fare": 12000},
+    })
+    assert plan.quote(3, None).vehicle_type == "4_SEATER"
+    assert plan.quote(0.1, "2_SEATER").total_fare == 12000
+
+
+def test_time_bands_use_local_hour_and_wrap_past_midnight():
+    plan = _plan(time_bands=[
+        {"start_hour": 7, "end_hour": 9, "multiplier": 1.5, "vehicle_types": ["4_SEATER"]},
+        {"start_hour": 22, "end_hour": 2, "multiplier": 2.0},
+    ])
+    # 00:30 UTC = 07:30 giờ Việt Nam
+    rush = datetime(2026, 10, 19, 0, 30, tzinfo=timezone.utc)
+    assert plan.quote(5, "4_SEATER", rush).total_fare == 105000
+    assert plan.quote(5, "2_SEATER", rush).time_multiplier == 1.0
+    # 17:00 UTC = 00:00 giờ Việt Nam, naive datetime được hiểu là UTC
+    assert plan.quote(5, "7_SEATER", datetime(2026, 10, 19, 17, 0)).total_fare == 210000
+
+
+def test_invalid_plan_is_rejected():
+    with pytest.raises(ValueError):
+        _plan(commission_rate=1.5)
+    with pytest.raises(ValueError):
+        _plan(default_vehicle_type="BUS")
+
+
+def test_plan_file_is_reloaded_when_changed(tmp_path, monkeypatch):
+    path = tmp_path / "pricing.json"
+    path.write_text(json.dumps({**pricing.DEFAULT_PLAN, "version": "v1"}))
+    monkeypatch.setattr(pricing, "PRICING_PLAN_FILE", str(path))
+    monkeypatch.setattr(pricing, "PRICING_RELOAD_SECONDS", 0)
+    monkeypatch.setattr(pricing, "_plan_mtime", None)
+    monkeypatch.setattr(pricing, "_next_check", 0.0)
+    assert pricing.get_plan().version == "v1"
+
+    path.write_text(json.dumps({**pricing.DEFAULT_PLAN, "version": "v2", "commission_rate": 0.25}))
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1_000_000))
+    assert pricing.get_plan().version == "v2"
+    assert pricing.quote(5, "4_SEATER").commission_rate == 0.25
+
+    path.write_text("{not json")
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1_000_000))
+    assert pricing.get_plan().version == "v2"
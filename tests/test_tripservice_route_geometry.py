@@ -0,0 +1,51 @@
+"""
+Unit tests cho rút gọn polyline (route_geometry.py) của TripService.
+Chạy với: pytest tests/test_tripservice_route_geometry.py
+"""
+import os
+import importlib.util
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+spec = importlib.util.spec_from_file_location("trip_route_geometry", os.path.join(trip_service_path, "route_geometry.py"))
+route_geometry = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(route_geometry)
+
+# Ví dụ chuẩn trong tài liệu Encoded Polyline Algorithm Format
+GOOGLE_EXAMPLE = "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+GOOGLE_POINTS = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+
+
+def test_decode_reference_polyline():
+    assert route_geometry.decode_polyline(GOOGLE_EXAMPLE) == GOOGLE_POINTS
+
+
+def test_encode_reference_polyline():
+    assert route_geometry.encode_polyline(GOOGLE_POINTS) == GOOGLE_EXAMPLE
+
+
+def test_simplify_drops_points_on_a_straight_street():
+    # 50 điểm gần như thẳng hàng (lệch < 1m) giữa hai đầu đường
+    points = [(10.77 + i * 0.0001, 106.70 + (0.000001 if i % 2 else 0)) for i in range(50)]
+
+    simplified = route_geometry.simplify_points(points, tolerance_m=2.0)
+
+    assert simplified == [points[0], points[-1]]
+
+
+def test_simplify_keeps_corners():
+    points = [(10.770, 106.700), (10.771, 106.700), (10.772, 106.700), (10.772, 106.701), (10.772, 106.702)]
+
+    simplified = route_geometry.simplify_points(points, tolerance_m=2.0)
+
+    assert simplified == [(10.770, 106.700), (10.772, 106.700), (10.772, 106.702)]
+
+
+def test_simplify_polyline_shrinks_and_keeps_endpoints():
+    points = [(10.77 + i * 0.00005, 106.70 + i * 0.00005) for i in range(200)] + [(10.79, 106.69)]
+    encoded = route_geometry.encode_polyline(points)
+
+    simplified = route_geometry.simplify_polyline(encoded)
+    decoded = route_geometry.decode_polyline(simplified)
+
+    assert len(simplified) < len(encoded) / 10
+    assert decoded[0] == points[0] and decoded[-1] == points[-1]
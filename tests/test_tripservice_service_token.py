@@ -0,0 +1,68 @@
+"""
+Unit tests cho ServiceTokenManager của TripService.
+Chạy với: pytest tests/test_tripservice_service_token.py
+"""
+import asyncio
+import pytest
+import sys
+import os
+import importlib.util
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+spec = importlib.util.spec_from_file_location("trip_service_token", os.path.join(trip_service_path, "service_token.py"))
+trip_service_token = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(trip_service_token)
+
+ServiceTokenManager = trip_service_token.ServiceTokenManager
+
+
+def _make_manager(monkeypatch, tokens):
+    """Tạo manager với _fetch_token giả lập, đếm số lần gọi UserService."""
+    manager = ServiceTokenManager("http://userservice/auth/token", "tripsvc", "secret")
+    calls = []
+
+    async def fake_fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        token = tokens[len(calls) - 1]
+        manager._token = token
+        manager._expires_at = trip_service_token.datetime.now(trip_service_token.timezone.utc) + manager.default_lifetime
+        return token
+
+    monkeypatch.setattr(manager, "_fetch_token", fake_fetch)
+    return manager, calls
+
+
+@pytest.mark.asyncio
+async def test_concurrent_callers_share_one_refresh(monkeypatch):
+    manager, calls = _make_manager(monkeypatch, ["token-1"])
+
+    tokens = await asyncio.gather(*[manager.get_token() for _ in range(20)])
+
+    assert tokens == ["token-1"] * 20
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_invalidate_ignores_stale_rejected_token(monkeypatch):
+    manager, calls = _make_manager(monkeypatch, ["token-1", "token-2"])
+    await manager.get_token()
+
+    manager.invalidate("old-token")
+    assert await manager.get_token() == "token-1"
+
+    manager.invalidate("token-1")
+    assert await manager.get_token() == "token-2"
+    assert len(calls) == 2
+
+
+def test_read_jwt_expiry_from_payload():
+    # payload {"exp": 2000000000}
+    token = "eyJhbGciOiJIUzI1NiJ9.eyJleHAiOjIwMDAwMDAwMDB9.sig"
+    expiry = trip_service_token._read_jwt_expiry(token)
+    assert int(expiry.timestamp()) == 2000000000
+    assert trip_service_token._read_jwt_expiry("not-a-jwt") is None
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,68 @@
+"""
+Unit tests cho sparse fieldsets (?fields=a,b,c) của các endpoint đọc chuyến đi trong TripService.
+Chạy với: pytest tests/test_tripservice_sparse_fields.py
+"""
+import json
+import pytest
+import sys
+import os
+import importlib.util
+from datetime import datetime
+from unittest.mock import patch
+
+from fastapi import HTTPException
+
+from conftest import trip_database_stub
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+if trip_service_path not in sys.path:
+    sys.path.insert(0, trip_service_path)
+
+with patch.dict(sys.modules, {"database": trip_database_stub()}):
+    spec = importlib.util.spec_from_file_location("trip_main", os.path.join(trip_service_path, "main.py"))
+    trip_main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(trip_main)
+
+schemas = trip_main.schemas
+
+
+def test_parse_fields_always_includes_id_and_accepts_id_alias():
+    assert trip_main._parse_fields(None, trip_main.SUMMARY_FIELD_PATHS) is None
+    assert trip_main._parse_fields("status, id,status,", trip_main.SUMMARY_FIELD_PATHS) == ["_id", "status"]
+
+
+def test_parse_fields_rejects_unknown_field():
+    with pytest.raises(HTTPException) as exc_info:
+        trip_main._parse_fields("status,route_geometry,password", trip_main.SUMMARY_FIELD_PATHS)
+
+    assert exc_info.value.status_code == 400
+    assert "route_geometry, password" in exc_info.value.detail
+
+
+def test_summary_field_paths_cover_the_summary_schema():
+    # Thêm field vào TripSummaryResponse mà quên SUMMARY_FIELD_PATHS thì projection sẽ bỏ sót nó
+    schema_fields = {field.alias or name for name, field in schemas.TripSummaryResponse.model_fields.items()}
+    assert set(trip_main.SUMMARY_FIELD_PATHS) == schema_fields
+
+
+def test_summary_projection_reads_only_needed_paths():
+    assert trip_main._summary_projection(["_id", "status", "pickup_address"]) == {
+        "_id": 1, "status": 1, "pickup.address": 1
+    }
+    default = trip_main._summary_projection(None)
+    assert default["fare.estimated"] == 1 and default["dropoff.address"] == 1
+    assert "route" not in default and "history" not in default
+
+
+def test_selected_fields_are_the_only_keys_in_the_response():
+    summary = {
+        "_id": "t1", "passenger_id": "p1", "driver_id": "d1", "status": "PENDING",
+        "pickup_address": "UIT", "dropoff_address": "Bến Thành", "estimated_fare": 52000.0,
+        "actual_fare": None, "created_at": datetime(2026, 10, 19, 8, 0), "startTime": None, "endTime": None
+    }
+    selected = trip_main._parse_fields("status", trip_main.SUMMARY_FIELD_PATHS)
+
+    response = trip_main.trusted_response(schemas.TripSummaryResponse, [summary], fields=selected)
+
+    assert json.loads(response.body) == [{"_id": "t1", "status": "PENDING"}]
+
@@ -0,0 +1,57 @@
+"""
+Unit tests cho surge pricing theo ô (surge.py) của TripService.
+Chạy với: pytest tests/test_tripservice_surge.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+
+from conftest import trip_database_stub
+
+sys.modules.setdefault('database', trip_database_stub())
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+sys.path.insert(0, trip_service_path)
+if 'models' not in sys.modules:
+    spec = importlib.util.spec_from_file_location("trip_models", os.path.join(trip_service_path, "models.py"))
+    trip_models = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(trip_models)
+    sys.modules['models'] = trip_models
+
+spec = importlib.util.spec_from_file_location("trip_surge", os.path.join(trip_service_path, "surge.py"))
+surge = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(surge)
+
+
+def test_geo_score_matches_redis_geoadd():
+    # Ví dụ trong tài liệu Redis: GEOADD Sicily 13.361389 38.115556 "Palermo"
+    assert surge.geo_score(13.361389, 38.115556) == 3479099956230698
+
+
+def test_nearby_points_share_a_cell_and_distant_points_do_not():
+    ben_thanh = surge.cell_of(106.6980, 10.7725)
+    assert surge.cell_of(106.6990, 10.7730) == ben_thanh
+    assert surge.cell_of(106.8030, 10.8700) != ben_thanh  # UIT, cách ~15km
+
+
+def test_cell_from_score_is_prefix_of_score():
+    score = surge.geo_score(106.6980, 10.7725)
+    assert surge.cell_from_score(float(score)) == surge.cell_of(106.6980, 10.7725)
+
+
+def test_compute_multipliers_only_surges_when_demand_exceeds_supply():
+    multipliers = surge.compute_multipliers(
+        supply={"a": 10, "b": 2, "c": 0},
+        demand={"a": 5, "b": 6, "c": 1, "d": 20}
+    )
+
+    assert "a" not in multipliers          # cung dồi dào
+    assert multipliers["b"] == 2.0         # 6 / 2 = 3 -> 1 + 0.5 * 2
+    assert "c" not in multipliers          # nhu cầu quá nhỏ
+    assert multipliers["d"] == surge.SURGE_MAX_MULTIPLIER
+
+
+@pytest.mark.asyncio
+async def test_get_multiplier_without_redis_is_neutral():
+    assert await surge.get_multiplier(106.6980, 10.7725, record_demand=True) == 1.0
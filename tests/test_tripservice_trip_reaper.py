@@ -0,0 +1,78 @@
+"""
+Unit tests cho job hủy chuyến PENDING quá hạn (trip_reaper.py) của TripService.
+Chạy với: pytest tests/test_tripservice_trip_reaper.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock
+
+from conftest import trip_database_stub
+
+sys.modules.setdefault('database', trip_database_stub())
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+sys.path.insert(0, trip_service_path)
+if 'models' not in sys.modules:
+    spec = importlib.util.spec_from_file_location("trip_models", os.path.join(trip_service_path, "models.py"))
+    trip_models = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(trip_models)
+    sys.modules['models'] = trip_models
+
+spec = importlib.util.spec_from_file_location("trip_reaper", os.path.join(trip_service_path, "trip_reaper.py"))
+trip_reaper = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(trip_reaper)
+
+
+def _cursor(docs):
+    cursor = MagicMock()
+    cursor.sort.return_value = cursor
+    cursor.limit.return_value = cursor
+    cursor.to_list = AsyncMock(return_value=docs)
+    return cursor
+
+
+@pytest.fixture
+def collections(monkeypatch):
+    trips = MagicMock()
+    trips.update_many = AsyncMock()
+    stats = MagicMock(record_trip_changes=AsyncMock())
+    cache = MagicMock(evict_many=AsyncMock())
+    monkeypatch.setattr(trip_reaper, "trips_collection", trips)
+    monkeypatch.setattr(trip_reaper, "trip_stats", stats)
+    monkeypatch.setattr(trip_reaper, "active_trip_cache", cache)
+    return trips, stats, cache
+
+
+@pytest.mark.asyncio
+async def test_reap_batch_skips_trips_accepted_in_between(collections):
+    trips, stats, cache = collections
+    candidates = [
+        {"_id": "t1", "passenger_id": "p1", "driver_id": "", "status": "PENDING", "fare": {"estimated": 1}},
+        {"_id": "t2", "passenger_id": "p2", "driver_id": "", "status": "PENDING", "fare": {"estimated": 1}},
+    ]
+    # t2 được tài xế nhận giữa find và update_many nên không có trong lần find xác nhận
+    trips.find.side_effect = [_cursor(candidates), _cursor([{"_id": "t1"}])]
+
+    reaped = await trip_reaper.reap_batch(datetime.now(timezone.utc))
+
+    assert reaped == 1
+    update_filter, update = trips.update_many.call_args.args
+    assert update_filter["status"] == "PENDING"
+    assert update["$set"]["status"] == "CANCELLED"
+    assert update["$set"]["cancellation"]["cancelled_by"] == "SYSTEM"
+    changes = list(stats.record_trip_changes.call_args.args[0])
+    assert [(before["_id"], after["status"]) for before, after in changes] == [("t1", "CANCELLED")]
+    cache.evict_many.assert_awaited_once_with(["t1"])
+
+
+@pytest.mark.asyncio
+async def test_reap_batch_without_candidates_does_not_write(collections):
+    trips, stats, cache = collections
+    trips.find.return_value = _cursor([])
+
+    assert await trip_reaper.reap_batch(datetime.now(timezone.utc)) == 0
+    trips.update_many.assert_not_called()
+    stats.record_trip_changes.assert_not_called()
@@ -0,0 +1,72 @@
+"""
+Unit tests cho thống kê chuyến đi incremental (trip_stats) của TripService.
+Chạy với: pytest tests/test_tripservice_trip_stats.py
+"""
+import pytest
+import sys
+import os
+import importlib.util
+
+from conftest import trip_database_stub
+
+sys.modules.setdefault('database', trip_database_stub())
+
+trip_service_path = os.path.join(os.path.dirname(__file__), "..", "TripService")
+spec = importlib.util.spec_from_file_location("trip_models", os.path.join(trip_service_path, "models.py"))
+trip_models = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(trip_models)
+sys.modules['models'] = trip_models
+
+spec = importlib.util.spec_from_file_location("trip_stats_module", os.path.join(trip_service_path, "trip_stats.py"))
+trip_stats = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(trip_stats)
+
+
+def _trip(**overrides):
+    trip = {"passenger_id": "p1", "driver_id": "", "status": "PENDING", "fare": {"estimated": 50000, "actual": None}}
+    trip.update(overrides)
+    return trip
+
+
+def test_new_trip_counts_only_for_passenger():
+    delta = trip_stats.compute_stats_delta(None, _trip())
+    assert delta == {"passenger:p1": {"total_trips": 1}}
+
+
+def test_assign_driver_moves_trip_into_driver_stats():
+    before = _trip()
+    after = _trip(driver_id="d1", status="ACCEPTED")
+    delta = trip_stats.compute_stats_delta(before, after)
+    assert delta == {"driver:d1": {"total_trips": 1}}
+
+
+def test_fare_update_on_completed_trip_adds_revenue():
+    before = _trip(driver_id="d1", status="COMPLETED")
+    after = _trip(driver_id="d1", status="COMPLETED", fare={"estimated": 50000, "actual": 62000})
+    delta = trip_stats.compute_stats_delta(before, after)
+    assert delta == {
+        "passenger:p1": {"total_revenue": 62000},
+        "driver:d1": {"total_revenue": 62000},
+    }
+
+
+def test_repeated_status_update_is_not_double_counted():
+    trip = _trip(driver_id="d1", status="CANCELLED")
+    assert trip_stats.compute_stats_delta(trip, dict(trip)) == {}
+
+
+def test_delete_reverts_contribution():
+    trip = _trip(driver_id="d1", status="COMPLETED", rating={"stars": 4})
+    delta = trip_stats.compute_stats_delta(trip, None)
+    assert delta["driver:d1"] == {"total_trips": -1, "completed_trips": -1, "rating_sum": -4, "rating_count": -1}
+
+
+def test_stats_document_to_response_computes_average():
+    doc = {"total_trips": 3, "completed_trips": 2, "cancelled_trips": 1, "total_revenue": 100000, "rating_sum": 9, "rating_count": 2}
+    response = trip_stats.stats_document_to_response(doc)
+    assert response["average_rating"] == 4.5
+    assert trip_stats.stats_document_to_response(None)["average_rating"] is None
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])